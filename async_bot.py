@@ -0,0 +1,449 @@
+"""
+Асинхронный режим работы бота.
+
+Альтернатива потокам UserHandler, Reminder и блокирующему циклу
+BotLongPollTimeoutHandled.listen модуля eat_bot: long polling,
+отправка сообщений и напоминания работают в одном цикле событий
+asyncio, поэтому медленные запросы к VK API не занимают потоков
+и тысячи отправок могут ожидать ответа одновременно.
+
+Хранилище остается синхронным: метод task_handler объекта
+user.User выполняется в пуле потоков asyncio.to_thread и не
+блокирует цикл событий.  Задачи одного пользователя выполняются
+по порядку, а их ответы объединяет delivery.ReplyBuffer.
+
+Режим включается в settings.runtime_config ('mode': 'asyncio')
+и требует пакета aiohttp.
+
+"""
+
+
+import time
+import asyncio
+import functools
+import logging
+
+import aiohttp
+from vk_api.exceptions import ApiError
+
+from Work import message_handler, config, user, settings, eat_bot
+from Work import delivery, texts, rate_limit, snapshot, metrics
+from Work.reminder_index import SLOT_MINUTES
+
+
+API_URL = 'https://api.vk.com/method/'
+API_VERSION = '5.131'
+
+
+class AsyncApiError(Exception):
+    """Ошибка, которую вернул VK API.
+
+    Attributes:
+        method - название вызванного метода;
+        code - код ошибки VK API;
+        error - словарь с описанием ошибки из ответа.
+
+    """
+
+    def __init__(self, method, error):
+        super().__init__(f"[{error.get('error_code')}] "
+                         f"{error.get('error_msg')} ({method})")
+        self.method = method
+        self.code = error.get('error_code')
+        self.error = error
+
+
+class AsyncVkApi:
+    """Асинхронный клиент VK API.
+
+    Attributes:
+        session - объект aiohttp.ClientSession;
+        token - токен сообщества;
+        limiter - объект rate_limit.AsyncRateLimiter.
+
+    Methods:
+        method - вызывает метод VK API.
+
+    """
+
+    def __init__(self, session, token, max_concurrent=1000, limiter=None):
+        """
+        Args:
+            session - объект aiohttp.ClientSession;
+            token - токен сообщества;
+            max_concurrent - наибольшее число одновременных запросов;
+            limiter - объект rate_limit.AsyncRateLimiter.
+
+        """
+        self.session = session
+        self.token = token
+        self.limiter = limiter or rate_limit.AsyncRateLimiter()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def method(self, method, values=None,
+                     priority=rate_limit.PRIORITY_REPLY):
+        """Вызывает метод VK API и возвращает поле response ответа."""
+
+        values = dict(values or {})
+        values.setdefault('v', API_VERSION)
+        values.setdefault('access_token', self.token)
+
+        await self.limiter.acquire(priority)
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                async with self.session.post(API_URL + method,
+                                             data=values) as response:
+                    data = await response.json(content_type=None)
+            except Exception:
+                metrics.API_ERRORS.inc(method=method)
+                raise
+            finally:
+                metrics.API_SECONDS.observe(time.monotonic() - started,
+                                            method=method)
+
+        if 'error' in data:
+            metrics.API_ERRORS.inc(method=method)
+            raise AsyncApiError(method, data['error'])
+        return data['response']
+
+
+class AsyncLongPoll:
+    """Асинхронный Bots Long Poll.
+
+    Повторяет логику vk_api.bot_longpoll.VkBotLongPoll и обработку
+    ошибок BotLongPollTimeoutHandled.
+
+    Attributes:
+        api - объект AsyncVkApi;
+        group_id - id сообщества;
+        wait - время ожидания ответа сервера в секундах;
+        backoff_base, backoff_max - задержки после ошибок
+            соединения (см. eat_bot.backoff_delay);
+        cursor - объект cursor.LongPollCursor или None.
+
+    """
+
+    logger = logging.getLogger('bot.async.longPolling')
+
+    def __init__(self, api, group_id, wait=25, backoff_base=1.0,
+                 backoff_max=60.0, cursor=None):
+        self.api = api
+        self.group_id = group_id
+        self.wait = wait
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cursor = cursor
+
+        self.server = None
+        self.key = None
+        self.ts = cursor.position() if cursor is not None else None
+        # с сохраненным ts сервер выдаст пропущенные события
+
+    async def update_longpoll_server(self, update_ts=True):
+        response = await self.api.method('groups.getLongPollServer',
+                                         {'group_id': self.group_id})
+        self.server = response['server']
+        self.key = response['key']
+
+        if update_ts:
+            self.ts = response['ts']
+
+    async def check(self):
+        """Получает события от сервера один раз.
+
+        Return:
+            список событий в виде словарей из ответа сервера.
+
+        """
+
+        ts = self.ts
+        values = {'act': 'a_check', 'key': self.key, 'ts': ts,
+                  'wait': self.wait}
+
+        async with self.api.session.get(
+                self.server, params=values,
+                timeout=aiohttp.ClientTimeout(total=self.wait + 10)
+        ) as response:
+            response = await response.json(content_type=None)
+
+        if 'failed' not in response:
+            self.ts = response['ts']
+            if self.cursor is not None:
+                return self.cursor.begin(ts, response['ts'],
+                                         response['updates'])
+            return response['updates']
+
+        metrics.LONGPOLL_ERRORS.inc(kind=f"failed_{response['failed']}")
+        self.logger.warning('Long poll failed %s, ts %s.',
+                            response['failed'], self.ts)
+
+        if response['failed'] == 1:
+            self.ts = response['ts']
+
+        elif response['failed'] == 2:
+            await self.update_longpoll_server(update_ts=False)
+
+        elif response['failed'] == 3:
+            await self.update_longpoll_server()
+
+        return []
+
+    async def listen(self):
+        outage = None  # time.monotonic() начала сбоя
+        failures = 0  # ошибок подряд, требующих задержки
+
+        while True:
+            try:
+                if self.server is None:
+                    await self.update_longpoll_server(
+                        update_ts=self.ts is None)
+                events = await self.check()
+
+            except asyncio.TimeoutError:
+                metrics.LONGPOLL_ERRORS.inc(kind='timeout')
+                self.logger.warning('Read timeout error from VK, '
+                                    'retrying at once.')
+                outage = outage or time.monotonic()
+                continue
+
+            except aiohttp.ClientConnectionError:
+                metrics.LONGPOLL_ERRORS.inc(kind='connection')
+                delay = eat_bot.backoff_delay(failures, self.backoff_base,
+                                              self.backoff_max)
+                self.logger.exception('Connection interrupted from '
+                                      'server/PC, retry in %.1f s.', delay)
+
+            except Exception:
+                metrics.LONGPOLL_ERRORS.inc(kind='unknown')
+                delay = eat_bot.backoff_delay(failures, self.backoff_base,
+                                              self.backoff_max)
+                self.logger.exception('Unknown exception, retry in '
+                                      '%.1f s.', delay)
+                self.server = None  # новый сервер и ключ
+
+            else:
+                if outage is not None:
+                    duration = time.monotonic() - outage
+                    metrics.LONGPOLL_OUTAGE_SECONDS.observe(duration)
+                    metrics.LONGPOLL_RECOVERED_EVENTS.inc(len(events))
+                    self.logger.warning(
+                        'Long poll recovered after %.1f s, %i events.',
+                        duration, len(events))
+                    outage, failures = None, 0
+
+                for event in events:
+                    yield event
+                continue
+
+            outage = outage or time.monotonic()
+            failures += 1
+            await asyncio.sleep(delay)
+
+
+class SendFacade:
+    """Замена vk_api.vk_api.VkApiMethod для объектов user.User.
+
+    user.User и потоки отправки delivery.ReplyBuffer вызывают
+    vk.messages.send(...) вне цикла событий; вызов ставит запрос в
+    цикл и ждет ответа VK, чтобы ReplyBuffer, как и в режиме
+    потоков, отмечал событие обработанным только после отправки.
+    Ошибка VK API передается как vk_api.exceptions.ApiError.
+
+    Attributes:
+        api - объект AsyncVkApi;
+        loop - цикл событий, в котором выполняются запросы.
+
+    """
+
+    def __init__(self, api, loop):
+        self.api = api
+        self.loop = loop
+
+    @property
+    def messages(self):
+        return self
+
+    def send(self, **values):
+        future = asyncio.run_coroutine_threadsafe(
+            self.api.method('messages.send', values), self.loop)
+        try:
+            return future.result()
+        except AsyncApiError as error:
+            raise ApiError(None, error.method, values, False,
+                           error.error) from error
+
+
+class AsyncBot:
+    """Цикл событий бота: long polling, задачи и напоминания.
+
+    Attributes:
+        api - объект AsyncVkApi;
+        longpoll - объект AsyncLongPoll;
+        client - ссылка на класс user.User.
+
+    Methods:
+        run - слушает события и запускает напоминания;
+        handle - выполняет задачу пользователя;
+        remind - отправляет напоминания пачками по расписанию.
+
+    """
+
+    _LOCKS_COUNT = 256
+    logger = logging.getLogger('bot.async')
+
+    def __init__(self, api, group_id, longpoll_config=None, cursor=None,
+                 reply_config=None):
+        self.api = api
+        self.cursor = cursor
+        self.reply_config = reply_config or {}
+        self.longpoll = AsyncLongPoll(api, group_id, cursor=cursor,
+                                      **(longpoll_config or {}))
+        self.client = user.User
+
+        self._vk = None
+        self._locks = [asyncio.Lock() for _ in range(self._LOCKS_COUNT)]
+        # задачи одного пользователя выполняются по порядку
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        """Запускает корутину, сохраняя ссылку на задачу."""
+
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def handle(self, client):
+        """Выполняет задачу client (user.User) в пуле потоков."""
+
+        async with self._locks[client.user_id % self._LOCKS_COUNT]:
+            metrics.QUEUE_WAIT_SECONDS.observe(
+                time.monotonic() - client.created)
+            self.logger.debug(
+                "Take task: '%s' with data: %s", client.status, client.values)
+            try:
+                await asyncio.to_thread(client.task_handler)
+            except Exception:
+                self.logger.exception('Some exception in AsyncBot.handle')
+            finally:
+                if client.done is not None:
+                    client.done()
+
+    async def remind(self):
+        """
+        Спит до ближайшего времени напоминания из расписания
+        user.User.schedule и отправляет напоминания пачками.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.client.schedule.on_add = (
+            lambda: loop.call_soon_threadsafe(wakeup.set))
+        # set eating выполняется в потоке пула
+
+        while True:
+            due = self.client.schedule.pop_due(self._is_active)
+
+            for clock in due:
+                persons = self.client.reminders.get(clock // SLOT_MINUTES)
+                metrics.REMINDER_FANOUT.observe(len(persons))
+                self.logger.debug('Reminder in %02i:%02i has clients: %s.',
+                                  clock // 60, clock % 60, persons)
+
+                codes = delivery.pack(delivery.build_calls(
+                    [(person, texts.reminder_text) for person in persons]))
+                for code in codes:
+                    self._spawn(self._execute(code))
+
+            if not due:
+                try:
+                    await asyncio.wait_for(wakeup.wait(),
+                                           self.client.schedule.delay())
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+
+    def _is_active(self, clock):
+        return self.client.reminders.is_active(clock // SLOT_MINUTES)
+
+    async def _execute(self, code):
+        try:
+            errors = delivery.count_errors(
+                await self.api.method('execute', {'code': code},
+                                      rate_limit.PRIORITY_REMINDER))
+        except Exception:
+            self.logger.exception('Batch sending failed.')
+        else:
+            if errors:
+                metrics.DELIVERY_FAILED.inc(errors)
+                self.logger.warning(
+                    'Batch sending: %i messages failed.', errors)
+
+    async def run(self):
+        self._vk = delivery.ReplyBuffer(
+            SendFacade(self.api, asyncio.get_running_loop()),
+            **self.reply_config)
+        self._vk.name = 'ThreadReplyBuffer'
+        self._vk.start()
+        self._spawn(self.remind())
+
+        async for event in self.longpoll.listen():
+
+            if event['type'] == 'message_new':
+                user_id = event['object']['message']['from_id']
+                message = event['object']['message']['text']
+                metrics.LONGPOLL_LAG_SECONDS.observe(
+                    max(time.time() - event['object']['message']['date'], 0))
+                self.logger.info(
+                    "New message '%s' from [%s].", message, user_id)
+
+                task = message_handler.task(message)  # (status, [v1, v2...])
+                self.logger.info(
+                    "Create task: '%s' with data: %s.", task[0], str(task[1]))
+
+                client = self.client(self._vk, user_id, task)
+                if self.cursor is not None:
+                    client.done = functools.partial(
+                        self._vk.after, user_id,
+                        functools.partial(self.cursor.done,
+                                          event.get('event_id')))
+                    # после отправки ответов задачи
+                self._spawn(self.handle(client))
+
+            elif self.cursor is not None:
+                self.cursor.done(event.get('event_id'))
+
+
+async def run(state):
+    writer = snapshot.SnapshotWriter(state, user.User.storage,
+                                     user.User.reminders,
+                                     settings.snapshot_config['interval'])
+    writer.name = 'ThreadSnapshot'
+    writer.start()
+    metrics.start_server(settings.metrics_config)
+    position = eat_bot.start_cursor()
+
+    async with aiohttp.ClientSession() as session:
+        api = AsyncVkApi(
+            session, config.group_token,
+            settings.runtime_config['max_concurrent_sends'],
+            rate_limit.AsyncRateLimiter(**settings.rate_limit_config)
+        )
+        try:
+            await AsyncBot(api, config.group_id, settings.longpoll_config,
+                           position, settings.reply_config).run()
+        finally:
+            state.save(user.User.storage, user.User.reminders)
+            # в том числе профили из кэша, еще не записанные в хранилище
+            position.save()
+
+
+def main():
+    """Запускает бота в асинхронном режиме."""
+
+    eat_bot.config_logging()
+    logging.getLogger('bot.async').info('START BOT (asyncio)')
+    state = eat_bot.config_storage()
+
+    asyncio.run(run(state))
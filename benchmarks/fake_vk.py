@@ -0,0 +1,241 @@
+"""
+Поддельный VK API для нагрузочных тестов.
+
+Работает в том же процессе, что и бот:
+    - методы API (https://api.vk.ru/method/...) обслуживает
+      транспортный адаптер requests FakeVkAdapter, который
+      подключается к сессии vk_api.VkApi.http;
+    - Bots Long Poll обслуживает локальный HTTP-сервер на
+      127.0.0.1, адрес которого возвращает groups.getLongPollServer.
+
+События сообщений добавляются через FakeVk.push_message; ответы
+бота (messages.send с user_id) сопоставляются с сообщениями
+пользователя по порядку и дают задержку ответа (объединенный ответ
+отвечает на столько сообщений, сколько в нем частей через
+delivery.REPLY_SEPARATOR), а рассылки через
+execute подсчитываются отдельно.  Методы API могут отвечать с
+задержкой latency и с вероятностью error_rate возвращать ошибку 6
+(too many requests), которую vk_api повторяет сам.
+
+Классы:
+    FakeVk - состояние поддельного VK и статистика;
+    FakeVkAdapter - транспортный адаптер requests для методов API.
+
+"""
+
+
+import re
+import json
+import time
+import random
+import threading
+import collections
+import http.server
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from Work.delivery import REPLY_SEPARATOR
+
+
+API_HOSTS = ('https://api.vk.ru/', 'https://api.vk.com/')
+
+_RECIPIENTS = re.compile(r'"peer_ids": "([\d,]+)"|"user_id": (\d+)')
+
+
+class FakeVk:
+    """Состояние поддельного VK.
+
+    Attributes:
+        group_id - id сообщества;
+        latency - задержка ответа методов API в секундах;
+        error_rate - доля вызовов API, отвечающих ошибкой 6;
+        batch - наибольшее число событий в одном ответе long poll;
+        latencies - список задержек ответов на сообщения в
+            секундах;
+        counters - collections.Counter: 'messages' (отправлено
+            событий), 'replies', 'unexpected' (messages.send без
+            ожидающего сообщения), 'execute', 'broadcast'
+            (получателей в execute), 'errors' (вызовов с ошибкой),
+            'polls'.
+
+    Methods:
+        start - запускает сервер long poll;
+        stop - останавливает его;
+        push_message - добавляет событие нового сообщения;
+        pending - число сообщений, ожидающих ответа;
+        handle_method - обрабатывает вызов метода API.
+
+    """
+
+    def __init__(self, group_id=1, latency=0.0, error_rate=0.0, batch=100):
+        self.group_id = group_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batch = batch
+
+        self.latencies = []
+        self.counters = collections.Counter()
+
+        self._events = []  # вся история: ts события - номер + 1
+        self._sent = collections.defaultdict(collections.deque)
+        # {user_id: [момент отправки сообщения, ]}
+        self._condition = threading.Condition()
+        self._server = None
+
+    @property
+    def server_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/poll'
+
+    def start(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urllib.parse.parse_qs(
+                    urllib.parse.urlparse(self.path).query)
+                body = json.dumps(fake.poll(int(query['ts'][0]),
+                                            int(query['wait'][0])))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                       Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         name='ThreadFakeVk', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def push_message(self, user_id, text):
+        """Добавляет событие message_new от пользователя."""
+
+        with self._condition:
+            number = self.counters['messages'] + 1
+            self.counters['messages'] = number
+            self._events.append({
+                'type': 'message_new',
+                'object': {'message': {
+                    'date': int(time.time()), 'from_id': user_id,
+                    'peer_id': user_id, 'id': number, 'out': 0,
+                    'text': text, 'attachments': [], 'fwd_messages': [],
+                    'conversation_message_id': number, 'important': False,
+                    'is_hidden': False, 'random_id': 0}},
+                'group_id': self.group_id,
+                'event_id': f'{number:x}'
+            })
+            self._sent[user_id].append(time.monotonic())
+            self._condition.notify_all()
+
+    def pending(self):
+        with self._condition:
+            return sum(map(len, self._sent.values()))
+
+    def poll(self, ts, wait):
+        """Ответ Bots Long Poll: ждет события до wait секунд.
+
+        События не удаляются после выдачи: запрос с прежним ts
+        выдает их снова, как после перезапуска бота в VK.
+
+        """
+
+        start = ts - 1
+        with self._condition:
+            self.counters['polls'] += 1
+            self._condition.wait_for(lambda: len(self._events) > start,
+                                     wait)
+
+            updates = self._events[start:start + self.batch]
+            return {'ts': str(start + len(updates) + 1),
+                    'updates': updates}
+
+    def handle_method(self, method, values):
+        """Возвращает ответ VK API (словарь) на вызов метода."""
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'groups.getLongPollServer':
+            return {'response': {'key': 'key', 'server': self.server_url,
+                                 'ts': str(len(self._events) + 1)}}
+
+        if self.error_rate and random.random() < self.error_rate:
+            with self._condition:
+                self.counters['errors'] += 1
+            return {'error': {'error_code': 6,
+                              'error_msg': 'Too many requests per second',
+                              'request_params': []}}
+
+        if method == 'messages.send':
+            now = time.monotonic()
+            parts = values['message'].count(REPLY_SEPARATOR) + 1
+            with self._condition:
+                self.counters['sends'] += 1
+                sent = self._sent.get(int(values['user_id']))
+                for _ in range(parts):
+                    if sent:
+                        self.latencies.append(now - sent.popleft())
+                        self.counters['replies'] += 1
+                    else:
+                        self.counters['unexpected'] += 1
+            return {'response': 1}
+
+        if method == 'execute':
+            results = []
+            for peer_ids, user_id in _RECIPIENTS.findall(values['code']):
+                if peer_ids:
+                    ids = peer_ids.split(',')
+                    results.append([{'peer_id': int(peer), 'message_id': 1}
+                                    for peer in ids])
+                else:
+                    ids = [user_id]
+                    results.append(1)
+                with self._condition:
+                    self.counters['broadcast'] += len(ids)
+            with self._condition:
+                self.counters['execute'] += 1
+            return {'response': results}
+
+        return {'response': 1}
+
+
+class FakeVkAdapter(requests.adapters.BaseAdapter):
+    """Транспортный адаптер requests, передающий вызовы API в FakeVk.
+
+    Подключается к сессии: session.mount(host, FakeVkAdapter(fake))
+    для каждого host из API_HOSTS.
+
+    """
+
+    def __init__(self, fake):
+        super().__init__()
+        self.fake = fake
+
+    def send(self, request, **kwargs):
+        method = urllib.parse.urlparse(request.url).path.rsplit('/', 1)[1]
+        body = request.body or ''
+        if isinstance(body, bytes):
+            body = body.decode()
+        values = {key: value[0] for key, value
+                  in urllib.parse.parse_qs(body).items()}
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(
+            self.fake.handle_method(method, values)).encode()
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
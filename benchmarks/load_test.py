@@ -0,0 +1,240 @@
+"""
+Нагрузочный тест бота целиком.
+
+Запускает eat_bot.main (BotLongPollTimeoutHandled, ShardedQueue,
+UserHandler, Reminder, user.User и хранилище из settings) во
+временной папке против поддельного VK API (benchmarks.fake_vk),
+посылает сообщения users пользователей в заданной пропорции команд
+и выводит пропускную способность, задержку ответа (p50, p99, max)
+и глубину очереди задач.
+
+Запуск из папки, в которой лежит пакет Work:
+    python -m Work.benchmarks.load_test --users 200 --messages 5000
+    python -m Work.benchmarks.load_test --mix add=5,give=3,help=1 \\
+        --latency 0.02 --error-rate 0.01 --api-rate 1000
+    python -m Work.benchmarks.load_test --high-water 200
+
+Сообщения, не принятые в очередь (high_water), получают ответ
+«бот занят» не чаще раза в busy_interval секунд, поэтому остальные
+из них попадают в lost.
+
+"""
+
+
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from Work import eat_bot, rate_limit, settings, metrics
+from Work.benchmarks.fake_vk import FakeVk, FakeVkAdapter, API_HOSTS
+
+
+DEFAULT_MIX = {'add': 5, 'sub': 1, 'give': 3, 'eating': 1, 'help': 1,
+               'error': 1}
+
+
+def _eating_time():
+    """Время напоминания через 5-10 минут (кратное 5 минутам)."""
+
+    minutes = (time.localtime().tm_hour * 60 + time.localtime().tm_min
+               + 10) // 5 * 5 % (24 * 60)
+    return f'{minutes // 60:02}:{minutes % 60:02}'
+
+
+COMMANDS = {
+    'add': lambda: f'add {random.randint(50, 999)}',
+    'sub': lambda: 'sub 50',
+    'give': lambda: random.choice(('give today', 'give week', 'give all')),
+    'eating': lambda: f'set eating {_eating_time()}',
+    'help': lambda: 'help',
+    'error': lambda: 'hello',
+}
+
+
+def parse_mix(text):
+    """Разбирает пропорцию команд вида 'add=5,give=3,help=1'."""
+
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name not in COMMANDS:
+            raise ValueError(f'unknown command in mix: {name}')
+        mix[name] = int(weight)
+    return mix
+
+
+def percentile(values, part):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * part), len(values) - 1)]
+
+
+class _ObservedQueue(eat_bot.ShardedQueue):
+    """ShardedQueue, запоминающая созданные очереди для замеров."""
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances.append(self)
+
+
+def run(users=100, messages=2000, rate=0.0, mix=None, threads_count=None,
+        latency=0.0, error_rate=0.0, api_rate=0, high_water=None,
+        timeout=120.0):
+    """Запускает бота и прогоняет через него сообщения.
+
+    Args:
+        users - число пользователей;
+        messages - число сообщений после начальных 'set time';
+        rate - сообщений в секунду (0 - без ограничения);
+        mix - словарь {команда из COMMANDS: вес};
+        threads_count - постоянное число потоков UserHandler (None -
+            пул по нагрузке из settings.pool_config);
+        latency, error_rate - задержка и доля ошибок поддельного API;
+        api_rate - лимит запросов к API в секунду (0 - из
+            settings.rate_limit_config);
+        high_water - размер очереди задач до ответов «бот занят»
+            (None - из settings.backpressure_config, 0 - без
+            ограничения);
+        timeout - сколько секунд ждать ответов.
+
+    Return:
+        словарь с результатами замеров.
+
+    """
+
+    os.chdir(tempfile.mkdtemp(prefix='eat_bot_load_'))
+    # логи, хранилище и снимки бота - во временной папке
+
+    if api_rate:
+        settings.rate_limit_config = {'rate': api_rate, 'burst': api_rate}
+    if high_water is not None:
+        settings.backpressure_config = dict(settings.backpressure_config,
+                                            high_water=high_water)
+
+    fake = FakeVk(latency=latency, error_rate=error_rate)
+    fake.start()
+
+    vk_session = rate_limit.LimitedVkApi(
+        token='fake-token',
+        limiter=rate_limit.RateLimiter(**settings.rate_limit_config)
+    )
+    adapter = FakeVkAdapter(fake)
+    for host in API_HOSTS:
+        vk_session.http.mount(host, adapter)
+
+    eat_bot.ShardedQueue = _ObservedQueue
+    threading.Thread(target=eat_bot.main, args=(threads_count, vk_session),
+                     name='ThreadBot', daemon=True).start()
+
+    while not _ObservedQueue.instances or not fake.counters['polls']:
+        time.sleep(0.01)
+    turn = _ObservedQueue.instances[-1]
+
+    depths = []
+    sizes = []
+    senders = []
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            depths.append(turn.depth())
+            sizes.append(metrics.POOL_SIZE.value())
+            senders.append(metrics.REPLY_SENDERS.value())
+
+    threading.Thread(target=sample, name='ThreadSampler', daemon=True).start()
+
+    mix = mix or DEFAULT_MIX
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    clock = time.strftime('%H:%M')
+
+    started = time.monotonic()
+    for user_id in range(1, users + 1):
+        fake.push_message(user_id, f'set time {clock}')
+    for i, name in enumerate(random.choices(names, weights, k=messages)):
+        if rate:
+            delay = started + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        fake.push_message(random.randint(1, users), COMMANDS[name]())
+    pushed = time.monotonic()
+
+    while fake.pending() and time.monotonic() - pushed < timeout:
+        time.sleep(0.01)
+    finished = time.monotonic()
+    done.set()
+    fake.stop()
+
+    replies = fake.counters['replies']
+    return {
+        'messages': fake.counters['messages'],
+        'replies': replies,
+        'lost': fake.pending(),
+        'rejected': metrics.TASKS_REJECTED.value(),
+        'seconds': finished - started,
+        'throughput': replies / (finished - started),
+        'sends': fake.counters['sends'],
+        'p50': percentile(fake.latencies, 0.5),
+        'p99': percentile(fake.latencies, 0.99),
+        'max': max(fake.latencies, default=float('nan')),
+        'depth_mean': sum(depths) / len(depths) if depths else 0,
+        'depth_max': max(depths, default=0),
+        'threads_max': max(sizes, default=0),
+        'senders_max': max(senders, default=0),
+        'api_errors': fake.counters['errors'],
+        'unexpected': fake.counters['unexpected'],
+        'broadcast': fake.counters['broadcast'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='сообщений в секунду, 0 - без ограничения')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='например add=5,give=3,help=1')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='постоянное число потоков, по умолчанию - '
+                             'пул по нагрузке')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='задержка ответа API в секундах')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='доля вызовов API с ошибкой 6')
+    parser.add_argument('--api-rate', type=float, default=0,
+                        help='лимит запросов к API в секунду')
+    parser.add_argument('--high-water', type=int, default=None,
+                        help='задач в очереди до ответов «бот занят»')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    result = run(args.users, args.messages, args.rate, args.mix,
+                 args.threads, args.latency, args.error_rate,
+                 args.api_rate, args.high_water, args.timeout)
+
+    print(f"messages {result['messages']}, replies {result['replies']}, "
+          f"lost {result['lost']}, rejected {result['rejected']}, "
+          f"{result['seconds']:.2f} s")
+    print(f"throughput {result['throughput']:.1f} replies/s "
+          f"in {result['sends']} messages.send calls")
+    print(f"latency p50 {result['p50'] * 1000:.1f} ms, "
+          f"p99 {result['p99'] * 1000:.1f} ms, "
+          f"max {result['max'] * 1000:.1f} ms")
+    print(f"queue depth mean {result['depth_mean']:.1f}, "
+          f"max {result['depth_max']}, "
+          f"threads max {result['threads_max']}, "
+          f"reply senders max {result['senders_max']}")
+    print(f"api errors injected {result['api_errors']}, "
+          f"unexpected sends {result['unexpected']}, "
+          f"broadcast recipients {result['broadcast']}")
+
+
+if __name__ == '__main__':
+    main()
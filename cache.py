@@ -0,0 +1,316 @@
+"""
+Модуль кэша профилей пользователей.
+
+Предоставляет класс ProfileCache - обертку над хранилищем
+storage.Storage, которая держит в памяти часовой пояс, время
+напоминаний, сумму калорий за текущий день и индекс сумм по
+дням последних активных пользователей.  Изменения профиля
+записываются в хранилище не сразу, а пачками потоком
+CacheFlusher (write-behind).
+
+"""
+
+
+import threading
+import collections
+import logging
+
+from Work.storage import Storage
+
+
+class CacheEntry:
+    """Закэшированные данные пользователя.
+
+    Attributes:
+        zone - часовой пояс или None;
+        times - список времен напоминаний 'HH:MM';
+        day - день (datetime.date.toordinal()), за который известна
+            сумма total;
+        total - сумма калорий за day или None, если записей нет;
+        history - индекс history.DailyIndex сумм по дням или None,
+            если он еще не построен.
+
+    """
+
+    __slots__ = ('zone', 'times', 'day', 'total', 'history')
+
+    def __init__(self, zone, times):
+        self.zone = zone
+        self.times = times
+        self.day = None
+        self.total = None
+        self.history = None
+
+
+class CacheFlusher(threading.Thread):
+    """Поток, записывающий измененные профили в хранилище.
+
+    Просыпается раз в interval секунд или когда накопилось
+    batch_size измененных профилей.
+
+    Attributes:
+        cache - объект ProfileCache;
+        interval - наибольшее время между записями в секундах.
+
+    """
+
+    _logger = logging.getLogger('bot.cache.CacheFlusher')
+
+    def __init__(self, cache, interval):
+        super().__init__()
+        self.cache = cache
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.cache.flush()
+            except Exception:
+                self._logger.exception('Some exception in CacheFlusher.')
+
+
+class ProfileCache(Storage):
+    """LRU-кэш профилей с отложенной записью.
+
+    Реализует интерфейс storage.Storage и передает в хранилище
+    backend только то, чего нет в памяти.  save_zone и add_times
+    меняют запись в кэше и помечают ее измененной; измененные
+    записи сохраняются через backend.save_profiles пачками.
+    Запись, вытесненная из кэша до сохранения, остается в словаре
+    измененных до ближайшей записи, а во время записи пачки - в
+    словаре записываемых, пока save_profiles не вернется.
+
+    Attributes:
+        backend - хранилище storage.Storage;
+        max_entries - наибольшее число профилей в памяти;
+        batch_size - число измененных профилей, при котором запись
+            начинается, не дожидаясь interval.
+
+    """
+
+    _logger = logging.getLogger('bot.cache')
+
+    def __init__(self, backend, max_entries=10000, flush_interval=1.0,
+                 batch_size=100):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+
+        self._entries = collections.OrderedDict()  # {user_id: CacheEntry}
+        self._dirty = {}  # {user_id: CacheEntry}
+        self._flushing = {}  # {user_id: CacheEntry} записываемой пачки
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # удаление пользователя не должно пересекаться с записью пачки
+
+        self._flusher = CacheFlusher(self, flush_interval)
+        self._flusher.name = 'ThreadCacheFlusher'
+        self._flusher.start()
+
+    def _get(self, user_id):
+        """Возвращает запись пользователя, загружая ее при промахе.
+
+        Return:
+            объект CacheEntry или None, если пользователя нет.
+
+        """
+
+        with self._lock:
+            entry = self._find(user_id)
+            if entry is not None:
+                self._put(user_id, entry)
+                return entry
+
+        profile = self.backend.load_profile(user_id)
+        if profile is None:
+            return None
+
+        with self._lock:
+            entry = self._find(user_id)
+            # другой поток мог загрузить запись раньше
+            if entry is None:
+                entry = CacheEntry(*profile)
+            self._put(user_id, entry)
+        return entry
+
+    def _find(self, user_id):
+        """
+        Ищет запись в кэше, в измененных и в записываемой пачке:
+        хранилище может еще не содержать последних изменений.
+
+        Вызывается под self._lock.
+
+        """
+
+        return (self._entries.get(user_id) or self._dirty.get(user_id) or
+                self._flushing.get(user_id))
+
+    def _put(self, user_id, entry):
+        """Кладет запись в начало очереди LRU, вытесняя старые.
+
+        Вызывается под self._lock.
+
+        """
+
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _mark_dirty(self, user_id, entry):
+        with self._lock:
+            self._dirty[user_id] = entry
+            dirty_count = len(self._dirty)
+
+        if dirty_count >= self.batch_size:
+            self._flusher.wakeup.set()
+
+    def load_profile(self, user_id):
+        entry = self._get(user_id)
+        if entry is None:
+            return None
+        return entry.zone, list(entry.times)
+
+    def create(self, user_id):
+        self.backend.create(user_id)
+
+        with self._lock:
+            self._put(user_id, CacheEntry(None, []))
+
+    def save_zone(self, user_id, zone):
+        entry = self._get(user_id)
+        entry.zone = zone
+        self._mark_dirty(user_id, entry)
+
+    def add_times(self, user_id, times):
+        entry = self._get(user_id)
+        entry.times = entry.times + list(times)
+        self._mark_dirty(user_id, entry)
+
+    def save_profiles(self, profiles):
+        for user_id, (zone, times) in profiles.items():
+            entry = self._get(user_id) or CacheEntry(zone, times)
+            entry.zone, entry.times = zone, list(times)
+            self._mark_dirty(user_id, entry)
+
+    def add_calories(self, user_id, day, values):
+        self.backend.add_calories(user_id, day, values)
+
+        entry = self._get(user_id)
+        if entry is None:
+            return
+
+        with self._lock:
+            if entry.day == day:
+                entry.total = (entry.total or 0) + sum(values)
+            else:
+                entry.day = None
+                # сумма за новый день будет загружена при запросе
+
+            if entry.history is not None:
+                entry.history.add(day, sum(values))
+
+    def get_calories(self, user_id, day=None):
+        return self.backend.get_calories(user_id, day)
+
+    def get_total(self, user_id, day):
+        entry = self._get(user_id)
+        with self._lock:
+            if entry.day == day:
+                return entry.total
+
+        total = self.backend.get_total(user_id, day)
+        with self._lock:
+            entry.day, entry.total = day, total
+        return total
+
+    def get_totals(self, user_id, day=None):
+        return self.backend.get_totals(user_id, day)
+
+    def get_stats(self, user_id, first, last):
+        entry = self._get(user_id)
+        with self._lock:
+            history = entry.history
+        if history is None:
+            history = self.backend.history(user_id)
+            # строится один раз, дальше обновляется в add_calories
+            with self._lock:
+                if entry.history is None:
+                    entry.history = history
+                history = entry.history
+
+        with self._lock:
+            return history.query(first, last)
+
+    def delete(self, user_id):
+        with self._flush_lock:
+            with self._lock:
+                self._entries.pop(user_id, None)
+                self._dirty.pop(user_id, None)
+
+            self.backend.delete(user_id)
+
+    def user_ids(self):
+        self.flush()
+        return self.backend.user_ids()
+
+    def changed_since(self, timestamp):
+        self.flush()
+        return self.backend.changed_since(timestamp)
+
+    def prime(self, profiles):
+        """
+        Заполняет кэш профилями из словаря {user_id: (zone, times)}
+        (например, из снимка состояния), не помечая их измененными.
+
+        """
+
+        with self._lock:
+            for user_id, (zone, times) in profiles.items():
+                if (user_id not in self._dirty and
+                        user_id not in self._flushing):
+                    self._put(user_id, CacheEntry(zone, list(times)))
+
+    def profiles(self):
+        """Возвращает словарь {user_id: (zone, times)} профилей в кэше."""
+
+        with self._lock:
+            entries = dict(self._flushing)
+            entries.update(self._entries)
+            entries.update(self._dirty)
+            return {user_id: (entry.zone, list(entry.times))
+                    for user_id, entry in entries.items()}
+
+    def flush(self):
+        """Записывает измененные профили в хранилище одной пачкой."""
+
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                self._flushing = dirty
+
+            if not dirty:
+                return
+
+            try:
+                self.backend.save_profiles({
+                    user_id: (entry.zone, list(entry.times))
+                    for user_id, entry in dirty.items()
+                })
+                self.backend.flush()
+            except Exception:
+                with self._lock:
+                    for user_id, entry in dirty.items():
+                        self._dirty.setdefault(user_id, entry)
+                raise
+                # несохраненные профили попадут в следующую пачку
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+        self._logger.debug('Flushed %i profiles.', len(dirty))
@@ -0,0 +1,280 @@
+"""
+Режим нескольких процессов-обработчиков.
+
+Один процесс с потоками упирается в GIL.  В этом режиме процесс
+диспетчера только слушает события Bots Long Poll
+(eat_bot.BotLongPollTimeoutHandled) и передает каждое сообщение
+(user_id, текст, время, id события) через очередь
+multiprocessing.Queue одному из count процессов-обработчиков,
+выбранному по id пользователя функцией owner.
+Процесс-обработчик - это обычный бот из eat_bot.start_handling
+(очередь задач, пул UserHandler, Reminder) со своей частью
+пользователей:
+    - хранилище общее (файлы пользователей или база SQLite в
+    режиме WAL), но каждый пользователь меняется только своим
+    процессом;
+    - индекс напоминаний и снимок состояния у каждого процесса
+    свои: файлы settings.reminders_config['path'] и
+    settings.snapshot_config['path'] с окончанием
+    '.<index>-of-<count>';
+    - лимит запросов к VK API (settings.rate_limit_config) общий
+    для сообщества и делится между процессами поровну;
+    - логи процесса index пишутся в свои файлы с тем же
+    окончанием ('logs/bot.<index>-of-<count>.log'), диспетчера - в
+    logs/bot.log и logs/err_bot.log;
+    - сервер метрик процесса index слушает порт
+    settings.metrics_config['port'] + 1 + index, диспетчера -
+    сам порт;
+    - позицию long poll (cursor.LongPollCursor) хранит диспетчер;
+    процесс-обработчик сообщает id события через свой канал done
+    (multiprocessing.Pipe), когда задача выполнена;
+    - канал done закрывается, когда процесс-обработчик завершается,
+    поэтому диспетчер замечает упавший процесс и перезапускает
+    его, передавая новому процессу сообщения, которые упавший не
+    успел выполнить;
+    - процессы-обработчики не реагируют на SIGINT: при остановке
+    бота диспетчер кладет в их очереди None, и каждый процесс
+    сначала выполняет все задачи своей очереди, но не дольше
+    settings.runtime_config['drain_timeout'] секунд; события
+    невыполненных задач остаются необработанными и будут
+    получены снова после перезапуска бота.
+
+Пользователи распределяются согласованным хешированием (jump
+consistent hash), поэтому при изменении числа процессов с n на
+n + 1 к новому процессу переходит только 1/(n + 1) пользователей,
+а остальные остаются на своих.  При изменении числа процессов
+индексы напоминаний собираются заново из хранилища (снимки с
+другим окончанием не подходят).
+
+Режим включается в settings.runtime_config ('mode': 'processes',
+'processes': число процессов-обработчиков).
+
+Функции:
+    owner - номер процесса-обработчика для пользователя;
+    worker_main - точка входа процесса-обработчика;
+    main - запускает диспетчер и процессы-обработчики.
+
+"""
+
+
+import os
+import time
+import signal
+import logging
+import functools
+import threading
+import multiprocessing
+import multiprocessing.connection
+
+from vk_api.bot_longpoll import VkBotEventType
+
+from Work import config, user, settings, storage, eat_bot, rate_limit
+from Work import snapshot, metrics
+
+
+def owner(user_id, count):
+    """
+    Возвращает номер процесса-обработчика (от 0 до count - 1) для
+    пользователя по алгоритму jump consistent hash (Lamping, Veach).
+
+    """
+
+    key = user_id & 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < count:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def worker_main(index, count, inbox, done, threads_count=None,
+                drain_timeout=30.0):
+    """Обрабатывает сообщения пользователей процесса index.
+
+    Args:
+        index - номер процесса-обработчика;
+        count - число процессов-обработчиков;
+        inbox - очередь multiprocessing.Queue с кортежами
+            (user_id, message, date, event_id); None завершает
+            процесс после выполнения всех полученных задач;
+        done - конец канала multiprocessing.Pipe, в который
+            передается event_id выполненной задачи;
+        threads_count - постоянное число потоков UserHandler (None -
+            пул по нагрузке из settings.pool_config);
+        drain_timeout - наибольшее время ожидания задач после None
+            в секундах.
+
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Ctrl+C получает вся группа процессов; останавливает диспетчер
+
+    eat_bot.config_logging(f'.{index}-of-{count}')
+    logger = logging.getLogger('bot.cluster')
+    logger.info('START WORKER %i/%i (pid %i)', index + 1, count,
+                os.getpid())
+
+    state = eat_bot.config_storage(
+        owns=lambda user_id: owner(user_id, count) == index,
+        suffix=f'.{index}-of-{count}')
+    writer = snapshot.SnapshotWriter(state, user.User.storage,
+                                     user.User.reminders,
+                                     settings.snapshot_config['interval'])
+    writer.name = 'ThreadSnapshot'
+    writer.start()
+    metrics.start_server(dict(
+        settings.metrics_config,
+        port=settings.metrics_config['port'] + 1 + index))
+
+    limits = settings.rate_limit_config
+    vk_session = rate_limit.LimitedVkApi(
+        token=config.group_token,
+        limiter=rate_limit.RateLimiter(limits['rate'] / count,
+                                       max(limits['burst'] // count, 1))
+    )
+    accept, drain = eat_bot.start_handling(vk_session, threads_count)
+    sending = threading.Lock()  # канал общий для потоков отправки
+
+    def finished(event_id):
+        with sending:
+            done.send(event_id)
+
+    try:
+        for user_id, message, date, event_id in iter(inbox.get, None):
+            accept(user_id, message, date,
+                   functools.partial(finished, event_id))
+        drain(drain_timeout)
+    finally:
+        state.save(user.User.storage, user.User.reminders)
+        # в том числе профили из кэша, еще не записанные в хранилище
+        logger.info('STOP WORKER %i/%i', index + 1, count)
+        eat_bot.stop_logging()
+        # процессы multiprocessing не вызывают функции atexit
+
+
+def main(count=None, threads_count=None):
+    """Запускает диспетчер и count процессов-обработчиков.
+
+    Args:
+        count - число процессов-обработчиков (по умолчанию -
+            settings.runtime_config['processes'] или число ядер);
+        threads_count - постоянное число потоков UserHandler в
+            каждом процессе (None - пул по нагрузке).
+
+    """
+
+    count = (count or settings.runtime_config['processes'] or
+             os.cpu_count())
+    drain_timeout = settings.runtime_config['drain_timeout']
+
+    eat_bot.config_logging()
+    logger = logging.getLogger('bot.cluster')
+    logger.info('START BOT (%i processes)', count)
+
+    storage.create_storage(settings.storage_config)
+    # миграции базы выполняются один раз, до запуска процессов
+
+    context = multiprocessing.get_context('spawn')
+    inboxes = [None] * count
+    workers = [None] * count
+    unfinished = [{} for _ in range(count)]
+    # {event_id: сообщение} переданных процессу и еще не выполненных
+    receivers = {}  # {конец канала done: номер процесса}
+    lock = threading.Lock()  # inboxes, workers, unfinished и receivers
+    stopping = threading.Event()
+
+    def start_worker(index):
+        inboxes[index] = context.Queue()
+        receiver, sender = context.Pipe(duplex=False)
+        workers[index] = context.Process(
+            target=worker_main,
+            args=(index, count, inboxes[index], sender, threads_count,
+                  drain_timeout),
+            name=f'Worker-{index}')
+        workers[index].start()
+        sender.close()
+        # канал закроется, когда завершится процесс
+        receivers[receiver] = index
+        for item in unfinished[index].values():
+            inboxes[index].put(item)
+
+    for index in range(count):
+        start_worker(index)
+
+    metrics.start_server(settings.metrics_config)
+    vk_session = rate_limit.LimitedVkApi(token=config.group_token)
+    position = eat_bot.start_cursor()
+
+    def exited(receiver):
+        with lock:
+            index = receivers.pop(receiver)
+            receiver.close()
+            workers[index].join()
+            if stopping.is_set():
+                return
+
+            logger.error('Worker %i/%i died (exit code %s), restarting with '
+                         '%i unfinished messages.', index + 1, count,
+                         workers[index].exitcode, len(unfinished[index]))
+            metrics.WORKER_RESTARTS.inc()
+            inboxes[index].cancel_join_thread()
+            # очередь упавшего процесса никто не прочитает
+            start_worker(index)
+
+    def mark_done():
+        while True:
+            with lock:
+                if not receivers:
+                    return  # все процессы завершились при остановке
+                ready = list(receivers)
+
+            for receiver in multiprocessing.connection.wait(ready, 1.0):
+                try:
+                    event_id = receiver.recv()
+                except EOFError:
+                    exited(receiver)
+                    # id, переданные до падения, уже прочитаны
+                    continue
+                with lock:
+                    unfinished[receivers[receiver]].pop(event_id, None)
+                position.done(event_id)
+
+    marker = threading.Thread(target=mark_done, name='ThreadDone')
+    marker.start()
+    longpoll = eat_bot.BotLongPollTimeoutHandled(
+        vk_session, config.group_id, cursor=position,
+        **settings.longpoll_config)
+
+    try:
+        for event in longpoll.listen():
+            if event.type == VkBotEventType.MESSAGE_NEW:
+                user_id = event.obj.message['from_id']
+                index = owner(user_id, count)
+                item = (user_id, event.obj.message['text'],
+                        event.obj.message['date'], event.raw.get('event_id'))
+                with lock:
+                    if item[3] is not None:
+                        unfinished[index][item[3]] = item
+                    inboxes[index].put(item)
+                # put не блокирует: сообщения передает поток очереди
+            else:
+                position.done(event.raw.get('event_id'))
+    finally:
+        stopping.set()
+        with lock:
+            for inbox in inboxes:
+                inbox.put(None)
+
+        deadline = time.monotonic() + 2 * drain_timeout
+        # запуск процесса, выполнение задач и запись снимка
+        for index, worker in enumerate(workers):
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                logger.error('Worker %i/%i did not stop, terminating.',
+                             index + 1, count)
+                worker.terminate()
+                worker.join()
+
+        marker.join()
+        position.save()
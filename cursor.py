@@ -0,0 +1,218 @@
+"""
+Модуль хранимой позиции Bots Long Poll.
+
+VK хранит события long poll некоторое время после их выдачи,
+поэтому бот, запомнивший последний обработанный ts, после
+перезапуска может запросить события, пришедшие, пока он не
+работал.  LongPollCursor отслеживает, какие события выданы
+сервером и какие из них уже обработаны (задача выполнена, а ответ
+отправлен или отброшен после неудачных попыток), и хранит на диске:
+    - ts, начиная с которого есть необработанные события;
+    - окно id последних обработанных событий, чтобы при повторной
+    выдаче пропустить уже обработанные.
+Файл перезаписывается целиком не чаще раза в interval секунд
+потоком CursorWriter и при остановке бота.
+
+Классы:
+    LongPollCursor - позиция long poll и окно обработанных событий;
+    CursorWriter - поток, периодически записывающий позицию.
+
+"""
+
+
+import os
+import time
+import threading
+import collections
+import logging
+
+
+class LongPollCursor:
+    """Позиция Bots Long Poll и окно обработанных событий.
+
+    Каждый ответ сервера - пачка событий, полученная запросом с
+    некоторым ts.  Пока в пачке есть необработанные события,
+    позиция (ts) не сдвигается дальше ts ее запроса.
+
+    Attributes:
+        path - путь к файлу позиции;
+        window - сколько id обработанных событий помнить.
+
+    Methods:
+        load - читает позицию из файла;
+        begin - регистрирует пачку событий и убирает повторы;
+        done - отмечает событие обработанным;
+        position - возвращает ts для продолжения;
+        save - записывает позицию, если она изменилась.
+
+    """
+
+    _logger = logging.getLogger('bot.cursor')
+
+    def __init__(self, path, window=1000):
+        self.path = path
+        self.window = window
+
+        self._ts = None  # ts после полностью обработанных пачек
+        self._next_ts = None  # ts из последнего ответа сервера
+        self._batches = collections.OrderedDict()
+        # {номер пачки: [ts запроса, число необработанных событий]}
+        self._pending = {}  # {event_id: номер пачки}
+        self._done = collections.deque()  # id обработанных событий
+        self._done_ids = set()
+        self._numbers = 0
+        self._changed = False
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()  # запись файла
+
+    def load(self):
+        """Читает позицию из файла.
+
+        Return:
+            сохраненный ts или None, если файла нет или он
+            поврежден.
+
+        """
+
+        try:
+            with open(self.path, 'r') as file:
+                ts = file.readline().strip().split('=', 1)[1]
+                ids = file.readline().strip().split('=', 1)[1]
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._logger.exception('Cursor file is corrupted, ignoring it.')
+            return None
+
+        with self._lock:
+            self._ts = ts
+            for event_id in filter(None, ids.split(',')):
+                self._remember(event_id)
+
+        self._logger.info('Cursor loaded: ts %s, %i recent events.',
+                          ts, len(self._done))
+        return ts
+
+    def _remember(self, event_id):
+        self._done.append(event_id)
+        self._done_ids.add(event_id)
+        if len(self._done) > self.window:
+            self._done_ids.discard(self._done.popleft())
+
+    def begin(self, ts, next_ts, events):
+        """Регистрирует пачку событий, полученную запросом с ts.
+
+        Args:
+            ts - ts запроса;
+            next_ts - ts из ответа (для следующего запроса);
+            events - список событий; id события - в поле event_id
+                его словаря raw (объекты VkBotEvent) или самого
+                словаря.
+
+        Return:
+            список событий без уже обработанных и уже выданных.
+
+        """
+
+        fresh = []
+        with self._lock:
+            number = self._numbers
+            self._numbers += 1
+
+            pending = 0
+            for event in events:
+                event_id = getattr(event, 'raw', event).get('event_id')
+                if event_id is not None:
+                    if (event_id in self._done_ids or
+                            event_id in self._pending):
+                        continue  # повтор после перезапуска
+                    self._pending[event_id] = number
+                    pending += 1
+                fresh.append(event)
+
+            if pending:
+                self._batches[number] = [ts, pending]
+
+            if not self._batches:
+                self._ts = next_ts
+            self._next_ts = next_ts
+            self._changed = True
+
+        return fresh
+
+    def done(self, event_id):
+        """Отмечает событие event_id обработанным."""
+
+        with self._lock:
+            number = self._pending.pop(event_id, None)
+            if number is None:
+                return
+            self._remember(event_id)
+
+            batch = self._batches[number]
+            batch[1] -= 1
+            if not batch[1]:
+                del self._batches[number]
+                if not self._batches:
+                    self._ts = self._next_ts
+            self._changed = True
+
+    def position(self):
+        """
+        Возвращает ts, с которого нужно продолжить, чтобы не
+        потерять необработанные события.
+
+        """
+
+        with self._lock:
+            return self._position()
+
+    def _position(self):
+        if self._batches:
+            return next(iter(self._batches.values()))[0]
+        return self._ts
+
+    def save(self):
+        """Записывает позицию в файл, если она изменилась."""
+
+        with self._file_lock:
+            with self._lock:
+                if not self._changed:
+                    return
+                ts = self._position()
+                text = f"ts={ts}\nids={','.join(self._done)}\n"
+                self._changed = False
+
+            if ts is None:
+                return
+
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(text)
+            os.replace(temp_path, self.path)
+
+
+class CursorWriter(threading.Thread):
+    """Поток, записывающий позицию раз в interval секунд.
+
+    Attributes:
+        cursor - объект LongPollCursor;
+        interval - период записи в секундах.
+
+    """
+
+    _logger = logging.getLogger('bot.cursor.CursorWriter')
+
+    def __init__(self, cursor, interval):
+        super().__init__()
+        self.cursor = cursor
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.cursor.save()
+            except Exception:
+                self._logger.exception('Some exception in CursorWriter.')
@@ -0,0 +1,391 @@
+"""
+Модуль пакетной отправки сообщений.
+
+Вместо отдельного запроса messages.send на каждого получателя
+сообщения собираются в вызовы messages.send с параметром peer_ids
+(до 100 получателей одного текста), а вызовы упаковываются по 25 в
+один запрос execute.  Так напоминание для 500 пользователей стоит
+одного запроса к VK API вместо 500.
+
+Ответы одному пользователю, появившиеся почти одновременно
+(несколько команд в одном сообщении или подряд), объединяются
+буфером ReplyBuffer в одно сообщение.
+
+Функции:
+    build_calls - собирает вызовы messages.send для сообщений;
+    pack - делит вызовы на код VKScript для запросов execute;
+    send_many - отправляет сообщения через execute;
+    merge - объединяет тексты в сообщения допустимой длины.
+
+Классы:
+    ReplyBuffer - поток, объединяющий ответы одному пользователю.
+
+"""
+
+
+import json
+import time
+import heapq
+import queue
+import logging
+import threading
+
+from vk_api.utils import get_random_id
+from vk_api.exceptions import ApiError
+
+from Work import metrics
+
+
+PEER_IDS_LIMIT = 100  # получателей в одном messages.send
+EXECUTE_LIMIT = 25  # вызовов API в одном execute
+MESSAGE_LIMIT = 4096  # символов в одном сообщении VK
+REPLY_SEPARATOR = '\n\n—\n\n'  # между объединенными ответами
+
+
+def build_calls(messages):
+    """Собирает параметры вызовов messages.send.
+
+    Сообщения с одинаковым текстом для нескольких пользователей
+    объединяются в вызовы с peer_ids, остальные отправляются с
+    user_id.
+
+    Args:
+        messages - список кортежей (user_id, text).
+
+    Return:
+        список словарей параметров messages.send.
+
+    """
+
+    recipients = {}  # {text: [user_id, ...]}
+    for user_id, text in messages:
+        recipients.setdefault(text, []).append(user_id)
+
+    calls = []
+    for text, user_ids in recipients.items():
+        if len(user_ids) == 1:
+            calls.append({'user_id': user_ids[0], 'message': text,
+                          'random_id': get_random_id()})
+            continue
+
+        for i in range(0, len(user_ids), PEER_IDS_LIMIT):
+            calls.append({
+                'peer_ids': ','.join(map(str, user_ids[i:i+PEER_IDS_LIMIT])),
+                'message': text,
+                'random_id': get_random_id()
+            })
+
+    return calls
+
+
+def pack(calls):
+    """Упаковывает вызовы messages.send в код VKScript.
+
+    Args:
+        calls - список словарей параметров messages.send.
+
+    Return:
+        список строк кода для параметра code метода execute, каждая
+        строка содержит не больше EXECUTE_LIMIT вызовов.
+
+    """
+
+    codes = []
+    for i in range(0, len(calls), EXECUTE_LIMIT):
+        body = ','.join(
+            f'API.messages.send({json.dumps(call, ensure_ascii=False)})'
+            for call in calls[i:i+EXECUTE_LIMIT]
+        )
+        codes.append(f'return [{body}];')
+
+    return codes
+
+
+def count_errors(response):
+    """Считает неудачные отправки в ответе execute."""
+
+    errors = 0
+    for result in response or []:
+        if isinstance(result, list):
+            errors += sum(1 for item in result if 'error' in item)
+            # ответ messages.send с peer_ids
+        elif not result:
+            errors += 1
+    return errors
+
+
+def send_many(vk, messages):
+    """Отправляет сообщения пачками через execute.
+
+    Args:
+        vk - объект vk_api.vk_api.VkApiMethod;
+        messages - список кортежей (user_id, text).
+
+    Return:
+        количество сделанных запросов к VK API.
+
+    """
+
+    logger = logging.getLogger('bot.delivery')
+
+    codes = pack(build_calls(messages))
+    for code in codes:
+        try:
+            errors = count_errors(vk.execute(code=code))
+        except Exception:
+            logger.exception('Batch sending failed.')
+        else:
+            if errors:
+                metrics.DELIVERY_FAILED.inc(errors)
+                logger.warning('Batch sending: %i messages failed.', errors)
+
+    return len(codes)
+
+
+def merge(texts, limit=MESSAGE_LIMIT):
+    """Объединяет тексты в сообщения не длиннее limit символов.
+
+    Тексты идут по порядку через REPLY_SEPARATOR; текст длиннее
+    limit делится на части по limit символов.
+
+    Args:
+        texts - список строк.
+
+    Return:
+        список сообщений.
+
+    """
+
+    messages = []
+    for text in texts:
+        for i in range(0, max(len(text), 1), limit):
+            piece = text[i:i+limit]
+            if (messages and len(messages[-1]) + len(REPLY_SEPARATOR)
+                    + len(piece) <= limit):
+                messages[-1] += REPLY_SEPARATOR + piece
+            else:
+                messages.append(piece)
+
+    return messages
+
+
+class ReplyBuffer(threading.Thread):
+    """Поток, объединяющий ответы одному пользователю.
+
+    Заменяет vk_api.vk_api.VkApiMethod для объектов user.User:
+    вызов messages.send(user_id=..., message=...) не отправляет
+    сообщение, а добавляет текст в буфер пользователя.  Через
+    window секунд после первого текста поток объединяет тексты
+    буфера (merge) и передает их потокам отправки, которые
+    отправляют их одним запросом messages.send.  Пока ответ
+    пользователю отправляется, его новые тексты ждут в буфере,
+    поэтому ответы приходят по порядку.  Вызовы с другими
+    параметрами (клавиатура, вложения) передаются vk сразу.
+
+    Потоки отправки ждут ответа VK, поэтому их число следует за
+    нагрузкой: поток запускается, когда отправок больше, чем
+    свободных потоков (не больше max_senders), и завершается после
+    idle_time секунд без отправок.
+
+    После ошибки сети отправка повторяется до attempts раз с
+    растущей задержкой; если все попытки неудачны, ответ
+    считается потерянным, а функции after все равно вызываются,
+    чтобы событие не осталось необработанным навсегда.
+
+    Attributes:
+        vk - объект vk_api.vk_api.VkApiMethod;
+        window - время накопления ответов в секундах;
+        limit - наибольшая длина сообщения;
+        max_senders - наибольшее число потоков отправки;
+        idle_time - секунд простоя, после которых поток отправки
+            завершается;
+        attempts - наибольшее число попыток отправки сообщения;
+        retry_delay - задержка перед первым повтором в секундах,
+            удваивается с каждой попыткой.
+
+    Methods:
+        send - добавляет ответ в буфер пользователя;
+        after - вызывает функцию после отправки ответов;
+        flush - отправляет все ответы и ждет отправки;
+        senders - возвращает число потоков отправки.
+
+    """
+
+    _logger = logging.getLogger('bot.delivery.ReplyBuffer')
+
+    def __init__(self, vk, window=0.1, limit=MESSAGE_LIMIT, max_senders=32,
+                 idle_time=5.0, attempts=3, retry_delay=1.0):
+        super().__init__()
+        self.vk = vk
+        self.window = window
+        self.limit = limit
+        self.max_senders = max_senders
+        self.idle_time = idle_time
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+
+        self._texts = {}  # {user_id: [текст, ]}
+        self._waiting = {}  # {user_id: [функция после отправки, ]}
+        self._due = []  # куча [(время отправки, user_id), ]
+        self._sending = {}  # {user_id: [функция после отправки, ]}
+        # пользователи, которым идет ответ
+        self._condition = threading.Condition()
+
+        self._jobs = queue.SimpleQueue()  # (user_id, [текст, ])
+        self._senders = 0
+        self._idle = 0  # потоков отправки, ожидающих работу
+        self._senders_lock = threading.Lock()
+        self.daemon = True
+
+    @property
+    def messages(self):
+        return self
+
+    def send(self, **values):
+        if 'user_id' not in values or set(values) - {'user_id', 'message',
+                                                      'random_id'}:
+            return self.vk.messages.send(**values)
+
+        user_id = values['user_id']
+        with self._condition:
+            texts = self._texts.get(user_id)
+            if texts is not None:
+                texts.append(values['message'])
+                return
+
+            self._texts[user_id] = [values['message']]
+            if user_id not in self._sending:
+                heapq.heappush(self._due,
+                               (time.monotonic() + self.window, user_id))
+                self._condition.notify_all()
+
+    def after(self, user_id, callback):
+        """
+        Вызывает callback без аргументов, когда отправлены все
+        ответы пользователю user_id, добавленные до вызова (сразу,
+        если таких нет).  callback вызывается и тогда, когда
+        ответ не удалось отправить (см. _deliver).
+
+        """
+
+        with self._condition:
+            if user_id in self._texts:
+                self._waiting.setdefault(user_id, []).append(callback)
+                return
+            if user_id in self._sending:
+                self._sending[user_id].append(callback)
+                return
+        callback()
+
+    def flush(self):
+        """Отправляет все ответы из буфера и ждет их отправки."""
+
+        with self._condition:
+            self._due = [(0, user_id) for _, user_id in self._due]
+            heapq.heapify(self._due)
+            self._condition.notify_all()
+            self._condition.wait_for(
+                lambda: not self._texts and not self._sending)
+
+    def senders(self):
+        return self._senders
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(
+                        max(self._due[0][0] - time.monotonic(), 0)
+                        if self._due else None)
+
+                _, user_id = heapq.heappop(self._due)
+                texts = self._texts.pop(user_id)
+                self._sending[user_id] = self._waiting.pop(user_id, [])
+
+            self._jobs.put((user_id, texts))
+            with self._senders_lock:
+                if (self._jobs.qsize() > self._idle and
+                        self._senders < self.max_senders):
+                    self._senders += 1
+                    threading.Thread(target=self._send_loop,
+                                     name=f'ThreadReply-{self._senders}',
+                                     daemon=True).start()
+                    metrics.REPLY_SENDERS.set(self._senders)
+
+    def _send_loop(self):
+        """Цикл потока отправки; завершается после простоя."""
+
+        while True:
+            with self._senders_lock:
+                self._idle += 1
+            try:
+                user_id, texts = self._jobs.get(timeout=self.idle_time)
+            except queue.Empty:
+                with self._senders_lock:
+                    self._idle -= 1
+                    if self._jobs.empty():
+                        self._senders -= 1
+                        metrics.REPLY_SENDERS.set(self._senders)
+                        return
+                continue
+            with self._senders_lock:
+                self._idle -= 1
+
+            self._flush(user_id, texts)
+
+    def _flush(self, user_id, texts):
+        """Отправляет тексты texts пользователю user_id."""
+
+        try:
+            messages = merge(texts, self.limit)
+            if len(messages) < len(texts):
+                metrics.REPLIES_COALESCED.inc(len(texts) - len(messages))
+
+            for message in messages:
+                self._deliver(user_id, message)
+        finally:
+            with self._condition:
+                callbacks = self._sending.pop(user_id)
+                if user_id in self._texts:
+                    heapq.heappush(self._due, (time.monotonic(), user_id))
+                # тексты, пришедшие во время отправки, уже ждали
+                self._condition.notify_all()
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                self._logger.exception('Some exception in ReplyBuffer.')
+
+    def _deliver(self, user_id, message):
+        """
+        Отправляет сообщение, повторяя попытку после ошибки сети.
+
+        random_id один для всех попыток, поэтому VK не покажет
+        сообщение дважды, если ответ на удачный запрос потерялся.
+
+        """
+
+        random_id = get_random_id()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.vk.messages.send(user_id=user_id, random_id=random_id,
+                                      message=message)
+                return
+            except ApiError:
+                metrics.DELIVERY_FAILED.inc()
+                self._logger.exception('Reply to [%s] rejected by VK.',
+                                       user_id)
+                return  # повтор не поможет
+            except Exception:
+                if attempt == self.attempts:
+                    metrics.DELIVERY_FAILED.inc()
+                    self._logger.exception('Reply to [%s] failed after %i '
+                                           'attempts, dropped.',
+                                           user_id, attempt)
+                    return
+
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                self._logger.warning('Reply to [%s] failed, retry in '
+                                     '%.1f s.', user_id, delay, exc_info=True)
+                time.sleep(delay)
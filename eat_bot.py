@@ -12,11 +12,31 @@
         модуля message_handler;
         - команда и значения передаются классу user.User модуля
         user и кладутся в очередь users_queue;
-        - очередь users_queue обрабатывается потоками UserHandler,
-        которые извлекаются объекты из очереди и вызывают их метод
-        task_handler, который выполняет введенную пользователем
-        команду;
-        - поток Reminder отправляет пользователю напоминания.
+        - очередь users_queue (ShardedQueue) раскладывает задачи по
+        шардам по id пользователя; потоки UserHandler забирают из
+        нее шарды с задачами и вызывают метод task_handler задачи,
+        выполняющий введенную пользователем команду; задачи одного
+        пользователя всегда попадают в один шард, который
+        обрабатывается одним потоком за раз, и выполняются по
+        порядку;
+        - поток UserHandlerPool меняет число потоков UserHandler
+        по глубине очереди и времени выполнения задач
+        (settings.pool_config);
+        - поток Reminder отправляет пользователям напоминания
+        пачками через метод execute VK API;
+        - ответы на команды одному пользователю, появившиеся в
+        течение settings.reply_config['window'] секунд, поток
+        delivery.ReplyBuffer отправляет одним сообщением.
+
+    Перегрузка (settings.backpressure_config):
+        - цикл long polling никогда не ждет очередь: шарды
+        users_queue не ограничены по размеру;
+        - когда в очереди reminder_water задач, поток Reminder
+        откладывает напоминания до reminder_defer секунд, а затем
+        пропускает их, освобождая VK API для ответов;
+        - когда в очереди high_water задач, новые сообщения не
+        ставятся в очередь: поток BusyReplier отвечает на них
+        сообщением texts.busy_text.
 
     Порядок работы с ботом:
         1. Пользователь первый отправляет сообщение - приветственное.
@@ -47,6 +67,17 @@
     Модули:
         message_handler - обрабатывает сообщения пользователя
         user - содержит класс для задачи от конкретного пользователя
+        storage - хранилища данных пользователей (файлы, SQLite)
+        cache - кэш профилей пользователей с отложенной записью
+        async_bot - асинхронный режим работы бота (asyncio)
+        cluster - режим нескольких процессов-обработчиков
+        delivery - пакетная отправка сообщений через execute
+        schedule - расписание срабатываний времен напоминаний
+        reminder_index - хранимый на диске индекс напоминаний
+        rate_limit - ограничение частоты запросов к VK API
+        snapshot - снимок состояния для быстрого запуска
+        metrics - метрики бота в формате Prometheus
+        cursor - хранимая позиция long poll
         texts - содержит тексты посылаемых ботом сообщений
         config - конфигурация бота
 
@@ -54,45 +85,273 @@
 
 
 import os
+import math
+import random
 import threading
 import queue
 import time
+import copy
+import atexit
+import functools
+import collections
 import logging.config
+import logging.handlers
 
 import vk_api
 from vk_api.bot_longpoll import *
+from vk_api.utils import get_random_id
 
-from Work import message_handler, config, user, settings
+from Work import message_handler, config, user, settings, storage, cache
+from Work import delivery, texts, reminder_index, rate_limit, snapshot
+from Work import loader, metrics, cursor
+from Work.reminder_index import SLOT_MINUTES
+
+
+_log_listener = None  # logging.handlers.QueueListener (см. config_logging)
+
+
+def backoff_delay(failures, base, cap):
+    """
+    Возвращает задержку перед повтором после failures неудач
+    подряд: случайное число от 0 до min(cap, base * 2**failures)
+    (экспоненциальная задержка с полным разбросом, чтобы процессы
+    не переподключались одновременно).
+
+    """
+
+    return random.uniform(0, min(cap, base * 2 ** failures))
 
 
 class BotLongPollTimeoutHandled(VkBotLongPoll):
     """Класс для прослушивания событий от VK API.
 
     Переопределяет класс VkBotLongPoll, чтобы ловить возникающие
-    ошибки.
+    ошибки и восстанавливаться по их виду:
+        - тайм-аут чтения (сервер не ответил за wait + 10 секунд) -
+        сразу повторный запрос;
+        - ответ failed 2 или 3 (истек ключ или потеряна история) -
+        сразу новый сервер и ключ groups.getLongPollServer;
+        - ошибка соединения - повтор через экспоненциально
+        растущую задержку со случайным разбросом (backoff_delay);
+        - прочие ошибки - такая же задержка, а затем новый сервер и
+        ключ.
+    Длительность каждого сбоя и число событий, полученных первым
+    ответом после него, попадают в метрики.
+
+    С позицией cursor (cursor.LongPollCursor) продолжает с
+    сохраненного ts, а не с текущего, и пропускает события, которые
+    уже были обработаны до перезапуска.
+
+    Attributes:
+        backoff_base - задержка после первой ошибки соединения в
+            секундах (до разброса);
+        backoff_max - наибольшая задержка в секундах;
+        cursor - объект cursor.LongPollCursor или None.
 
     """
 
     logger = logging.getLogger('bot.main.longPolling')
 
+    def __init__(self, vk, group_id, wait=25, backoff_base=1.0,
+                 backoff_max=60.0, cursor=None):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cursor = cursor
+        super().__init__(vk, group_id, wait)
+
+        if cursor is not None and cursor.position() is not None:
+            self.logger.info('Resuming long poll from ts %s (server ts '
+                             '%s).', cursor.position(), self.ts)
+            self.ts = cursor.position()
+
+    def check(self):
+        """
+        Получает события от сервера один раз.  Повторяет
+        VkBotLongPoll.check, считая ответы failed в метриках и
+        передавая события позиции cursor.
+
+        """
+
+        ts = self.ts
+        response = self.session.get(
+            self.url,
+            params={'act': 'a_check', 'key': self.key, 'ts': self.ts,
+                    'wait': self.wait},
+            timeout=self.wait + 10
+        ).json()
+
+        if 'failed' not in response:
+            self.ts = response['ts']
+            events = [self._parse_event(raw_event)
+                      for raw_event in response['updates']]
+            if self.cursor is not None:
+                events = self.cursor.begin(ts, response['ts'], events)
+            return events
+
+        failed = response['failed']
+        metrics.LONGPOLL_ERRORS.inc(kind=f'failed_{failed}')
+        self.logger.warning('Long poll failed %s, ts %s.', failed, self.ts)
+
+        if failed == 1:
+            self.ts = response['ts']  # часть событий могла пропасть
+        elif failed == 2:
+            self.update_longpoll_server(update_ts=False)
+        elif failed == 3:
+            self.update_longpoll_server()
+
+        return []
+
     def listen(self):
+        outage = None  # time.monotonic() начала сбоя
+        failures = 0  # ошибок подряд, требующих задержки
+        refresh = False  # запросить новый сервер и ключ
+
         while True:
             try:
-                for event in self.check():
-                    yield event
-            except requests.exceptions.ConnectionError:
-                self.logger.exception(
-                    'Connection interrupted from server/PC.')
-                time.sleep(15)
-                self.logger.error('Before sleeping.')
+                if refresh:
+                    self.update_longpoll_server(update_ts=False)
+                    refresh = False
+                events = self.check()
+
             except requests.exceptions.ReadTimeout:
-                self.logger.exception('Read timeout error from VK.')
-                time.sleep(15)
-                self.logger.error('Before sleeping.')
+                metrics.LONGPOLL_ERRORS.inc(kind='timeout')
+                self.logger.warning('Read timeout error from VK, '
+                                    'retrying at once.')
+                outage = outage or time.monotonic()
+                continue
+
+            except requests.exceptions.ConnectionError:
+                metrics.LONGPOLL_ERRORS.inc(kind='connection')
+                delay = backoff_delay(failures, self.backoff_base,
+                                      self.backoff_max)
+                self.logger.exception('Connection interrupted from '
+                                      'server/PC, retry in %.1f s.', delay)
+
             except Exception:
-                self.logger.exception('Unknown exception.')
-                time.sleep(15)
-                self.logger.error('Before sleeping.')
+                metrics.LONGPOLL_ERRORS.inc(kind='unknown')
+                delay = backoff_delay(failures, self.backoff_base,
+                                      self.backoff_max)
+                self.logger.exception('Unknown exception, retry in '
+                                      '%.1f s.', delay)
+                refresh = True
+
+            else:
+                if outage is not None:
+                    duration = time.monotonic() - outage
+                    metrics.LONGPOLL_OUTAGE_SECONDS.observe(duration)
+                    metrics.LONGPOLL_RECOVERED_EVENTS.inc(len(events))
+                    self.logger.warning(
+                        'Long poll recovered after %.1f s, %i events.',
+                        duration, len(events))
+                    outage, failures = None, 0
+
+                yield from events
+                continue
+
+            outage = outage or time.monotonic()
+            failures += 1
+            time.sleep(delay)
+
+
+class ShardedQueue:
+    """Очередь задач, разделенная на шарды по id пользователя.
+
+    Задачи одного пользователя всегда попадают в один и тот же
+    шард, а шард в каждый момент обрабатывается не больше чем одним
+    потоком UserHandler: поток забирает (get) номер шарда из
+    очереди готовых шардов и возвращает его (task_done) только
+    после выполнения задачи.  Поэтому команды пользователя
+    выполняются строго по порядку и никогда не выполняются
+    одновременно, а разные шарды работают параллельно любым
+    числом потоков (не больше числа шардов).
+
+    Шарды не ограничены по размеру, и put никогда не блокирует
+    вызывающий поток (цикл long polling): при переполнении задача
+    не принимается, и put сразу возвращает False.
+
+    Attributes:
+        shards - список очередей collections.deque;
+        high_water - число задач во всех шардах, после которого
+            новые задачи не принимаются (0 - без ограничения).
+
+    Methods:
+        put - кладет задачу в шард ее пользователя;
+        get - забирает задачу из готового шарда;
+        task_done - возвращает шард после выполнения задачи;
+        depth - возвращает число задач во всех шардах.
+
+    """
+
+    def __init__(self, shards_count, high_water=0):
+        """
+        Args:
+            shards_count - количество шардов;
+            high_water - число задач во всех шардах, после которого
+                новые задачи не принимаются (0 - без ограничения).
+
+        """
+        self.shards = [collections.deque() for _ in range(shards_count)]
+        self.high_water = high_water
+
+        self._ready = queue.Queue()  # номера шардов с задачами
+        self._claimed = [False] * shards_count
+        # шард в _ready или обрабатывается потоком
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def put(self, client):
+        """Кладет задачу client (user.User) в шард ее пользователя.
+
+        Return:
+            True, если задача принята; False, если в очереди уже
+            high_water задач.
+
+        """
+
+        index = client.user_id % len(self.shards)
+
+        with self._lock:
+            if self.high_water and self._depth >= self.high_water:
+                return False
+
+            self.shards[index].append(client)
+            self._depth += 1
+            if not self._claimed[index]:
+                self._claimed[index] = True
+                self._ready.put(index)
+
+        return True
+
+    def get(self, timeout=None):
+        """Забирает первую задачу готового шарда.
+
+        Шард остается занятым, пока не будет вызван
+        task_done(index).
+
+        Return:
+            кортеж (index, client): номер шарда и задача user.User.
+
+        Исключения:
+            queue.Empty, если за timeout секунд задач не появилось.
+
+        """
+
+        index = self._ready.get(timeout=timeout)
+        with self._lock:
+            self._depth -= 1
+            return index, self.shards[index].popleft()
+
+    def task_done(self, index):
+        """Возвращает шард index после выполнения его задачи."""
+
+        with self._lock:
+            if self.shards[index]:
+                self._ready.put(index)
+            else:
+                self._claimed[index] = False
+
+    def depth(self):
+        return self._depth
 
 
 class UserHandler(threading.Thread):
@@ -102,31 +361,42 @@ class UserHandler(threading.Thread):
     API, изменяет метод run для реализации обработки задач.
 
     Attributes:
-        q - очередь queue.Queue из задач;
+        turn - очередь задач ShardedQueue;
+        pool - пул потоков UserHandlerPool, которому поток сообщает
+            время выполнения задач и у которого спрашивает, не пора
+            ли завершиться.
 
     """
 
     logger = logging.getLogger('bot.main.UserHandler')
 
-    def __init__(self, q):
+    def __init__(self, turn, pool):
         """
         Args:
-            q - очередь queue.Queue для задач;
+            turn - очередь задач ShardedQueue;
+            pool - пул потоков UserHandlerPool.
 
         """
         super().__init__()
-        self.q = q
+        self.turn = turn
+        self.pool = pool
         self.daemon = True
 
     def run(self):
         """
         Забирает задачу из очереди и вызывает метод объекта задачи для
-        выполнения действий.
+        выполнения действий.  Завершается, когда пул уменьшается.
 
         """
 
-        while True:
-            client = self.q.get()  # user.User()
+        while not self.pool.retire(self):
+            try:
+                index, client = self.turn.get(timeout=1)  # user.User()
+            except queue.Empty:
+                continue
+
+            started = time.monotonic()
+            metrics.QUEUE_WAIT_SECONDS.observe(started - client.created)
             self.logger.debug(
                 "Take task: '%s' with data: %s", client.status, client.values)
             try:
@@ -134,162 +404,369 @@ class UserHandler(threading.Thread):
             except Exception:
                 self.logger.exception('Some exception in UserHandler')
             finally:
-                self.q.task_done()
+                if client.done is not None:
+                    client.done()
+                self.turn.task_done(index)
+                self.pool.task_finished(time.monotonic() - started)
+
+
+class UserHandlerPool(threading.Thread):
+    """Поток, меняющий число потоков UserHandler по нагрузке.
+
+    Каждые interval секунд оценивает, сколько потоков нужно, по
+    закону Литтла: потоки = (поток задач + depth / drain_time) *
+    среднее время задачи, где поток задач - задач в секунду за
+    прошедший интервал, depth - задач в очереди, а время задачи -
+    работа с хранилищем: ответы только кладутся в буфер
+    delivery.ReplyBuffer, у которого свои потоки отправки, число
+    которых следует за ожиданием ответа messages.send.  Пул
+    растет сразу до нужного размера, а уменьшается на один поток за
+    интервал, чтобы не пересоздавать потоки при колебаниях
+    нагрузки.  Размер всегда между min_threads и max_threads (и не
+    больше числа шардов очереди).
+
+    Attributes:
+        turn - очередь задач ShardedQueue;
+        min_threads, max_threads - границы размера пула;
+        interval - секунд между пересчетами размера;
+        drain_time - за сколько секунд пул должен разобрать очередь;
+        threads - список работающих потоков UserHandler.
+
+    Methods:
+        size - возвращает число потоков;
+        resize - пересчитывает размер пула;
+        retire - проверяет, должен ли поток завершиться;
+        task_finished - учитывает время выполненной задачи.
+
+    """
+
+    _logger = logging.getLogger('bot.main.UserHandlerPool')
+
+    def __init__(self, turn, min_threads, max_threads, interval=5.0,
+                 drain_time=2.0):
+        super().__init__()
+        self.turn = turn
+        self.min_threads = min(min_threads, len(turn.shards))
+        self.max_threads = max(min(max_threads, len(turn.shards)),
+                               self.min_threads)
+        self.interval = interval
+        self.drain_time = drain_time
+
+        self.threads = []
+        self._retiring = 0  # сколько потоков должно завершиться
+        self._done = 0  # задач выполнено за интервал
+        self._busy = 0.0  # секунд выполнения этих задач
+        self._service = 0.0  # среднее время задачи
+        self._depth = 0  # задач в очереди при прошлом пересчете
+        self._lock = threading.Lock()
+
+        self.daemon = True
+
+    def size(self):
+        with self._lock:
+            return len(self.threads) - self._retiring
+
+    def _grow(self, count):
+        for _ in range(count):
+            thr = UserHandler(self.turn, self)
+            thr.start()
+            self.threads.append(thr)
+
+    def start(self):
+        """Запускает min_threads потоков UserHandler и сам поток."""
+
+        with self._lock:
+            self._grow(self.min_threads)
+        super().start()
+
+    def retire(self, handler):
+        """
+        Возвращает True и убирает handler из пула, если пул
+        уменьшается.
+
+        """
+
+        with self._lock:
+            if not self._retiring:
+                return False
+            self._retiring -= 1
+            self.threads.remove(handler)
+            return True
+
+    def task_finished(self, seconds):
+        with self._lock:
+            self._done += 1
+            self._busy += seconds
+
+    def _needed(self, depth, done, busy):
+        size = len(self.threads) - self._retiring
+        if done:
+            self._service = busy / done
+        elif depth:
+            return size * 2  # задачи есть, но ни одна не выполнена
+
+        arrival = max(depth - self._depth + done, 0) / self.interval
+        return math.ceil((arrival + depth / self.drain_time) *
+                         self._service)
+
+    def resize(self):
+        """Пересчитывает размер пула по нагрузке за интервал."""
+
+        depth = self.turn.depth()
+
+        with self._lock:
+            done, busy = self._done, self._busy
+            self._done, self._busy = 0, 0.0
+
+            size = len(self.threads) - self._retiring
+            target = self._needed(depth, done, busy)
+            self._depth = depth
+
+            target = min(max(target, size - 1, self.min_threads),
+                         self.max_threads)
+            if target > size:
+                revived = min(self._retiring, target - size)
+                self._retiring -= revived
+                self._grow(target - size - revived)
+            elif target < size:
+                self._retiring += size - target
+
+        if target != size:
+            self._logger.info(
+                'Pool resized %i -> %i threads: %i tasks in queue, '
+                '%i done, %.3f s per task.', size, target, depth, done,
+                self._service)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.resize()
+            except Exception:
+                self._logger.exception('Some exception in UserHandlerPool.')
+
+
+class BusyReplier(threading.Thread):
+    """Класс потока для ответов на сообщения, не принятые в очередь.
+
+    Цикл long polling только кладет id пользователя в
+    неограниченную очередь q, а поток отвечает ему сообщением
+    texts.busy_text - не чаще одного раза в interval секунд, чтобы
+    при перегрузке не тратить запросы к VK API на повторные ответы.
+
+    Attributes:
+        vk - объект vk_api.vk_api.VkApiMethod;
+        q - очередь queue.Queue из id пользователей;
+        interval - наименьшее время между ответами одному
+            пользователю в секундах.
+
+    """
+
+    _logger = logging.getLogger('bot.main.BusyReplier')
+
+    def __init__(self, vk: vk_api.vk_api.VkApiMethod, interval=60):
+        super().__init__()
+        self.vk = vk
+        self.q = queue.Queue()
+        self.interval = interval
+
+        self._replied = {}  # {user_id: время последнего ответа}
+        self.daemon = True
+
+    def put(self, user_id):
+        """Ставит ответ пользователю в очередь, не блокируя."""
+        self.q.put(user_id)
+
+    def run(self):
+        while True:
+            user_id = self.q.get()
+
+            now = time.monotonic()
+            last = self._replied.get(user_id)
+            if last is not None and now - last < self.interval:
+                continue
+
+            if len(self._replied) > 10000:
+                self._replied = {
+                    client_id: moment
+                    for client_id, moment in self._replied.items()
+                    if now - moment < self.interval
+                }
+            self._replied[user_id] = now
+
+            try:
+                self.vk.messages.send(user_id=user_id,
+                                      random_id=get_random_id(),
+                                      message=texts.busy_text)
+            except Exception:
+                self._logger.exception('Some exception in BusyReplier.')
 
 
 class Reminder(threading.Thread):
     """Класс потока для отправки сообщений напоминаний пользователю.
 
     Является подклассом класса threading.Thread, наследует его
-    API и добавляет свои для реализации отправки задач с напоминанием
-    в очередь.
+    API и добавляет свои для реализации отправки напоминаний.
+    Напоминания всем пользователям одного времени отправляются
+    пачками через delivery.send_many, а не отдельными задачами.
+
+    Не опрашивает часы: спит до ближайшего времени напоминания с
+    пользователями из расписания user.User.schedule
+    (schedule.ReminderSchedule) и просыпается раньше, когда команда
+    set eating добавляет новое время.
+
+    Напоминания уступают ответам на команды: пока в очереди задач
+    turn не меньше reminder_water задач, напоминания откладываются,
+    а если очередь не разгрузилась за reminder_defer секунд -
+    пропускаются.
 
     Attributes:
         vk - объект vk_api.vk_api.VkApiMethod;
         client - ссылка на класс user.User;
-        q - очередь queue.Queue для задач;
-        times_min - список из целочисленных значений
-            времени суток в минутах с шагом в 5 минут;
-        _TASK - константа, кортеж, содержащий задачу и список
-            передаваемых значений в класс client;
+        wakeup - событие threading.Event, прерывающее сон;
+        turn - очередь задач ShardedQueue или None;
+        reminder_water - число задач в turn, при котором
+            напоминания откладываются (0 - не откладываются);
+        reminder_defer - наибольшая отсрочка в секундах;
         _logger - регистратор записей.
 
     Methods:
-        _set_times - создает список минут для проверки;
-        time_to_min - возвращает текущее время в минутах от полуночи;
-        time_to_hour_min - переводит время из минут в часы:минуты;
-        sleeper - спит, пока не наступит время проверки.
+        is_active - проверяет, есть ли пользователи у времени;
+        sleeper - спит, пока не наступит время напоминания;
+        defer - ждет, пока очередь задач перегружена;
+        remind - отправляет напоминания пользователям времени.
 
     """
 
-    _TASK = ('reminder', [None])
     _logger = logging.getLogger('bot.main.Reminder')
 
-    def __init__(self, vk: vk_api.vk_api.VkApiMethod, q):
+    def __init__(self, vk: vk_api.vk_api.VkApiMethod, turn=None,
+                 reminder_water=0, reminder_defer=0):
         """
         Args:
             vk - объект vk_api.vk_api.VkApiMethod;
-            q - очередь queue.Queue для задач;
+            turn - очередь задач ShardedQueue;
+            reminder_water - число задач в turn, при котором
+                напоминания откладываются (0 - не откладываются);
+            reminder_defer - наибольшая отсрочка в секундах.
 
         """
         super().__init__()
         self.vk = vk
         self.client = user.User
-        self.q = q
-        self.times_min = []
-
-        self.daemon = True
-
-    def _set_times(self):
-        """Создает список минут для проверки.
-
-        Записывает в times_min список времени суток в минутах в виде
-        целочисленных значений с интервалом в 5 минут от текущего
-        времени до полуночи.
-
-        """
-
-        now_min = self.time_to_min()
-
-        min_aliquot5 = now_min//5 * 5 + 5
-        if min_aliquot5 == 1440:
-            min_aliquot5 = 0
+        self.wakeup = threading.Event()
+        self.client.schedule.on_add = self.wakeup.set
 
-        self.times_min = [i for i in range(min_aliquot5, 24*60, 5)]
+        self.turn = turn
+        self.reminder_water = reminder_water
+        self.reminder_defer = reminder_defer
 
-    def time_to_min(self):
-        """Возвращает текущее целочисленное локальное время в минутах."""
-
-        now = time.localtime()
-        return now.tm_hour * 60 + now.tm_min
+        self.daemon = True
 
-    def time_to_hour_min(self, time_in_min):
-        """Преобразует время в минутах в время в часах-минутах.
+    def is_active(self, time_in_min):
+        """Проверяет, есть ли пользователи у времени напоминания."""
+        return self.client.reminders.is_active(time_in_min // SLOT_MINUTES)
 
-        Args:
-            time_in_min - целочисленное значение времени в минутах.
+    def sleeper(self):
+        """Спит, пока не придет время напоминания.
 
         Return:
-            возвращает строку вида HH:MM
+            возвращает список наступивших времен в минутах, у которых
+                есть пользователи.
 
         """
 
-        hour = time_in_min//60
-        minutes = time_in_min - hour*60
+        while True:
+            due = self.client.schedule.pop_due(self.is_active)
+            if due:
+                return due
+
+            self.wakeup.wait(self.client.schedule.delay())
+            self.wakeup.clear()
 
-        return f"{hour if hour > 9 else '0' + str(hour)}:" \
-               f"{minutes if minutes > 9 else '0' + str(minutes)}"
+    def run(self):
+        """Отправляет напоминания пользователям пачками."""
 
-    def sleeper(self, delay=5):
-        """Спит, пока не придет время для проверки.
+        while True:
+            for clock in self.sleeper():
+                # блокирует, пока не подойдет время напоминания
+                self._logger.debug('Reminder wake up.')
+                if self.defer(clock):
+                    self.remind(clock)
 
-        Спит с шагом в delay секунд до тех пор, пока не
-        подойдет следующее время.
+    def _overloaded(self):
+        return (self.turn is not None and self.reminder_water and
+                self.turn.depth() >= self.reminder_water)
 
-        Args:
-            delay - целочисленное значение, представлющее шаг сна.
+    def defer(self, clock):
+        """Ждет, пока очередь задач перегружена.
 
         Return:
-            возвращает целочисленное значение времени в минутах,
-                которое наступило (элемент списка times_min).
+            True, если напоминания времени clock можно отправлять;
+            False, если очередь не разгрузилась за reminder_defer
+            секунд и напоминания пропускаются.
 
         """
 
-        if not len(self.times_min):
-            self._set_times()
-
-        self._logger.debug('Times list: %s', str(self.times_min))
+        if not self._overloaded():
+            return True
 
-        while True:
-            step = self.times_min[0]
-            now = self.time_to_min()
-
-            if step - now < -5:
-                step += 24*60
+        metrics.REMINDERS_SHED.inc(action='deferred')
+        self._logger.warning('Reminder in %02i:%02i deferred: %i tasks '
+                             'in queue.', clock // 60, clock % 60,
+                             self.turn.depth())
 
-            if now < step:
-                time.sleep(delay)
-            else:
-                break
+        deadline = time.monotonic() + self.reminder_defer
+        while self._overloaded():
+            if time.monotonic() >= deadline:
+                metrics.REMINDERS_SHED.inc(action='dropped')
+                self._logger.warning('Reminder in %02i:%02i dropped.',
+                                     clock // 60, clock % 60)
+                return False
+            time.sleep(1)
 
-        return self.times_min.pop(0)
+        return True
 
-    def run(self):
-        """Помещает задачи напоминания в очередь."""
+    def remind(self, clock):
+        """
+        Отправляет напоминания пользователям времени clock (в
+        минутах от полуночи).
 
-        while True:
-            clock = self.sleeper()
-            # блокирует, пока не подойдет время для опроса
-            self._logger.debug('Reminder wake up.')
+        """
 
-            time_check = self.time_to_hour_min(clock)
-            try:
-                persons = self.client.users[time_check]
-                # {'14:55': {4112324, 234152}, }
+        try:
+            persons = self.client.reminders.get(clock // SLOT_MINUTES)
+            # array('q', [4112324, 234152])
+            metrics.REMINDER_FANOUT.observe(len(persons))
 
-                self._logger.debug(
-                    'Reminder in %s has clients: %s.',
-                    time_check, str(persons)
-                )
+            self._logger.debug(
+                'Reminder in %02i:%02i has clients: %s.',
+                clock // 60, clock % 60, persons
+            )
 
-                for person in persons:
-                    self.q.put(self.client(self.vk, person, self._TASK))
-            except Exception:
-                self._logger.exception('Some exception in Reminder.')
+            requests_count = delivery.send_many(
+                self.vk, [(person, texts.reminder_text)
+                          for person in persons])
+            self._logger.debug('Reminder in %02i:%02i sent in %i requests.',
+                               clock // 60, clock % 60, requests_count)
+        except Exception:
+            self._logger.exception('Some exception in Reminder.')
 
 
-def start_threads(turn, vk, threads_count=4):
+def start_threads(turn, vk, min_threads, max_threads):
     """Запускает потоки для обработки задач и поток для напоминаний.
 
     Args:
-        turn - очередь queue.Queue, которую будут просматривать потоки;
-        vk - объект vk_api.vk_api.VkApiMethod;
-        threads_count - количество запускаемых потоков.
+        turn - очередь ShardedQueue;
+        vk - объект vk_api.vk_api.VkApiMethod для напоминаний (с
+            приоритетом rate_limit.PRIORITY_REMINDER);
+        min_threads, max_threads - границы числа потоков
+            UserHandler (равные границы - пул постоянного размера).
 
     Return:
-        кортеж из двух значений (threads, rem):
-            threads - список объектов запущенных потоков,
-                обрабатывающих задачи от пользователя;
+        кортеж из двух значений (pool, rem):
+            pool - объект UserHandlerPool, потоки которого
+                обрабатывают задачи от пользователя;
             rem - объект потока для отправки напоминаний пользователю.
 
     """
@@ -297,100 +774,396 @@ def start_threads(turn, vk, threads_count=4):
     logger = logging.getLogger('bot.main.start_threads')
 
     logger.debug('Start threads.')
-    threads = []
-    for _ in range(threads_count):
-        thr = UserHandler(turn)
-        thr.start()
-        threads.append(thr)
-
-        logger.debug('%s started.', thr.name)
-
-    rem = Reminder(vk, turn)
+    pool = UserHandlerPool(turn, min_threads, max_threads,
+                           settings.pool_config['interval'],
+                           settings.pool_config['drain_time'])
+    pool.name = 'ThreadPool'
+    pool.start()
+    metrics.POOL_SIZE.set_function(pool.size)
+    logger.debug('%s started with %i threads.', pool.name, pool.size())
+
+    rem = Reminder(vk, turn,
+                   settings.backpressure_config['reminder_water'],
+                   settings.backpressure_config['reminder_defer'])
     rem.name = 'ThreadReminder'
     rem.start()
     logger.debug('%s started.', rem.name)
 
-    return threads, rem
+    return pool, rem
 
 
-def config_logging():
+def config_logging(suffix=''):
     """
     Настройка логирования:
         - в файл logs/bot.log записывает стандартные логи уровнем
             не выше logging.INFO;
-        - в файл logs/bot.log записывает логи ошибок уровнем от
-            logging.WARNING и выше.
+        - в файл logs/err_bot.log записывает логи ошибок уровнем от
+            logging.WARNING и выше;
+        - оба файла ротируются (settings.logging_config['handlers']);
+        - от логгеров из settings.log_config['sample'] оставляет
+            заданную долю записей DEBUG/INFO;
+        - с settings.log_config['json'] пишет записи строками JSON;
+        - с settings.log_config['queue'] потоки бота только кладут
+            записи в очередь, а в файлы их записывает поток
+            QueueListener (stop_logging дописывает очередь).
+
+    Args:
+        suffix - добавляется к именам файлов логов перед
+            расширением ('logs/bot.0-of-2.log'): каждый процесс
+            режима cluster пишет и ротирует свои файлы, потому что
+            ротация одного файла несколькими процессами теряет
+            записи.
 
     """
 
+    global _log_listener
+
     fullpath = os.path.abspath('logs')
     if not os.path.exists(fullpath):
         os.mkdir(fullpath)
     # создает папку для хранения логов в директории с main-файлом.
 
-    logging.config.dictConfig(settings.logging_config)
+    logging_config = copy.deepcopy(settings.logging_config)
+    for handler in logging_config['handlers'].values():
+        if settings.log_config['json']:
+            handler['formatter'] = 'json_formatter'
+        if suffix and 'filename' in handler:
+            root, extension = os.path.splitext(handler['filename'])
+            handler['filename'] = root + suffix + extension
+
+    stop_logging()
+    logging.config.dictConfig(logging_config)
+
+    bot_logger = logging.getLogger('bot')
+    sample = settings.SampleFilter(settings.log_config['sample'])
+    if not settings.log_config['queue']:
+        for handler in bot_logger.handlers:
+            handler.addFilter(sample)
+        return
+
+    handlers = bot_logger.handlers[:]
+    records = queue.SimpleQueue()
+    front = logging.handlers.QueueHandler(records)
+    front.addFilter(sample)  # отброшенные записи не попадают в очередь
+    for handler in handlers:
+        bot_logger.removeHandler(handler)
+    bot_logger.addHandler(front)
+
+    _log_listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Записывает в файлы оставшиеся в очереди записи и останавливает
+    поток QueueListener (если логи пишутся через очередь).
 
+    """
 
-def main():
-    """Запускает бота.
+    global _log_listener
 
-    Функция создает очередь и запускает потоки для обработки
-    задач от пользователя.  Реализует процесс авторизации в VK API с
-    указанным токеном сообщества и прослушивает события на предмет
-    появления сообщений от пользователей.  Обрабатывает появившееся
-    сообщение и создает объект задачи для этого сообщения.
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
 
-    Исключения:
-        будут дополнены при тестировании.
 
+def config_storage(owns=None, suffix=''):
     """
+    Настройка хранилища: создает хранилище из
+    settings.storage_config, оборачивает его кэшем профилей
+    cache.ProfileCache и восстанавливает индекс напоминаний
+    (settings.reminders_config) и кэш из снимка состояния
+    (settings.snapshot_config).  Профили, изменившиеся после
+    создания снимка, перечитываются из хранилища, а пользователи
+    снимка и индекса, которых в хранилище больше нет (удалены, пока
+    бот не работал), убираются из кэша и индекса.  Если снимка или
+    индекса на диске нет, собирает их из профилей всех
+    пользователей хранилища (файлы TextStorage разбираются
+    параллельно в loader.load_text_users).
 
-    def start(vk):
-        """
-        Создает объекты user.User() для всех уже существующих в базе
-        пользователей.
+    Args:
+        owns - функция, возвращающая True для id пользователей,
+            которых обслуживает процесс (по умолчанию - все;
+            процессы режима cluster обслуживают свою часть);
+        suffix - окончание имен файлов индекса напоминаний и
+            снимка состояния процесса.
 
-        Args:
-            vk - объект vk_api.vk_api.VkApiMethod.
+    Return:
+        объект snapshot.StateSnapshot для последующих записей.
 
-        Return:
-            None
+    """
 
-        """
+    logger = logging.getLogger('bot.main.config_storage')
+
+    backend = storage.create_storage(settings.storage_config)
+    profiles = cache.ProfileCache(backend, **settings.cache_config)
+
+    reminders = reminder_index.ReminderIndex(
+        os.path.abspath(settings.reminders_config['path'] + suffix),
+        settings.reminders_config['log_limit']
+    )
+    state = snapshot.StateSnapshot(
+        os.path.abspath(settings.snapshot_config['path'] + suffix))
+
+    loaded = state.load()
+    if reminders.load() and loaded is not None:
+        created, cached = loaded
+
+        existing = set(backend.user_ids())
+        removed = [client_id for client_id
+                   in (set(cached) | reminders.user_ids()) - existing
+                   if owns is None or owns(client_id)]
+        for client_id in removed:
+            cached.pop(client_id, None)
+            reminders.remove_user(client_id)
+        profiles.prime(cached)
+
+        changed = [client_id for client_id
+                   in backend.changed_since(created)
+                   if owns is None or owns(client_id)]
+        for client_id in changed:
+            profile = backend.load_profile(client_id)
+            if profile is None:
+                reminders.remove_user(client_id)
+                continue
+            profiles.prime({client_id: profile})
+            reminders.set_user(client_id, [reminder_index.slot_of(t)
+                                           for t in profile[1]])
+
+        logger.info('State restored from snapshot: %i profiles, '
+                    '%i changed and %i removed since.', len(cached),
+                    len(changed), len(removed))
+
+    else:
+        logger.info('Snapshot not found, building state from storage.')
+        if isinstance(backend, storage.TextStorage):
+            cached, slots, corrupt = loader.load_text_users(
+                backend.catalog_path, owns=owns, **settings.loader_config)
+        else:
+            cached = {client_id: backend.load_profile(client_id)
+                      for client_id in backend.user_ids()
+                      if owns is None or owns(client_id)}
+            slots, corrupt = loader.slot_map(cached), 0
+
+        profiles.prime(cached)
+        reminders.rebuild(slots)
+        state.save(profiles, reminders)
+        logger.info('State built from storage: %i profiles, '
+                    '%i corrupted files skipped.', len(cached), corrupt)
+
+    user.User.storage = profiles
+    user.User.reminders = reminders
+    user.User.schedule.add([slot * SLOT_MINUTES
+                            for slot in reminders.active_slots()])
+
+    return state
+
+
+def start_cursor(suffix=''):
+    """
+    Читает позицию long poll из settings.cursor_config и запускает
+    поток CursorWriter, записывающий ее.
 
-        try:
-            for client in os.listdir(user.User.catalog_path):
-                if client.endswith('.txt'):
-                    client_id = int(client.split('.')[0])
-                    user.User(vk, client_id, (None, None))
-        except FileNotFoundError:
-            pass
+    Args:
+        suffix - окончание имени файла позиции.
 
-    config_logging()
-    logger = logging.getLogger('bot.main')
+    Return:
+        объект cursor.LongPollCursor.
+
+    """
+
+    position = cursor.LongPollCursor(
+        os.path.abspath(settings.cursor_config['path'] + suffix),
+        settings.cursor_config['window'])
+    position.load()
+
+    writer = cursor.CursorWriter(position, settings.cursor_config['interval'])
+    writer.name = 'ThreadCursor'
+    writer.start()
+
+    return position
+
+
+def start_handling(vk_session, threads_count=None):
+    """
+    Запускает очередь задач users_queue из
+    settings.pool_config['shards'] шардов, пул потоков UserHandler,
+    поток напоминаний Reminder, поток BusyReplier и буфер ответов
+    delivery.ReplyBuffer (settings.reply_config).
+
+    Args:
+        vk_session - сессия rate_limit.LimitedVkApi;
+        threads_count - постоянное число потоков UserHandler; по
+            умолчанию пул меняет размер между min_threads и
+            max_threads из settings.pool_config.
+
+    Return:
+        кортеж (accept, drain): функция accept(user_id, message,
+        date, done=None), которая разбирает сообщение пользователя
+        и ставит задачу в очередь, никогда не блокируя вызывающий
+        поток, и функция drain(timeout=None) для остановки; date -
+        время отправки сообщения (для метрики задержки long
+        polling), done - функция без аргументов, которая
+        вызывается, когда задача выполнена и ее ответы отправлены
+        или когда задача отклонена.  drain перестает принимать
+        задачи (accept их отбрасывает, не вызывая done), ждет не
+        дольше timeout секунд, пока принятые задачи выполнятся и их
+        ответы будут отправлены, и отправляет оставшиеся ответы.
+
+    """
+
+    logger = logging.getLogger('bot.main.accept')
 
-    logger.info('START BOT')
-    vk_session = vk_api.VkApi(token=config.group_token)
     vk = vk_session.get_api()
-    longpoll = BotLongPollTimeoutHandled(vk_session, config.group_id)
 
-    users_queue = queue.Queue(20)
-    start_threads(users_queue, vk)
-    start(vk)
+    users_queue = ShardedQueue(settings.pool_config['shards'],
+                               settings.backpressure_config['high_water'])
+    metrics.QUEUE_DEPTH.set_function(users_queue.depth)
+    start_threads(users_queue,
+                  vk_session.get_api(rate_limit.PRIORITY_REMINDER),
+                  threads_count or settings.pool_config['min_threads'],
+                  threads_count or settings.pool_config['max_threads'])
+
+    busy = BusyReplier(vk, settings.backpressure_config['busy_interval'])
+    busy.name = 'ThreadBusyReplier'
+    busy.start()
+
+    replies = delivery.ReplyBuffer(vk, **settings.reply_config)
+    replies.name = 'ThreadReplyBuffer'
+    replies.start()
+
+    outstanding = 0  # принятых задач, еще не выполненных или без ответа
+    stopped = False
+    condition = threading.Condition()
+
+    def finished(done):
+        nonlocal outstanding
+        if done is not None:
+            done()
+        with condition:
+            outstanding -= 1
+            condition.notify_all()
+
+    def accept(user_id, message, date, done=None):
+        nonlocal outstanding
+        with condition:
+            if stopped:
+                return  # событие останется необработанным
+            outstanding += 1
+
+        metrics.LONGPOLL_LAG_SECONDS.observe(max(time.time() - date, 0))
+        logger.info("New message '%s' from [%s].", message, user_id)
+
+        task = message_handler.task(message)  # (status, [v1, v2...])
+        logger.info("Create task: '%s' with data: %s.", task[0], task[1])
+
+        client = user.User(replies, user_id, task)
+        client.done = functools.partial(replies.after, user_id,
+                                        functools.partial(finished, done))
+        # поток UserHandler вызывает done после задачи, а буфер -
+        # после отправки ее ответов
+        if not users_queue.put(client):
+            metrics.TASKS_REJECTED.inc()
+            logger.warning('Queue is full, task from [%s] rejected.',
+                           user_id)
+            busy.put(user_id)
+            finished(done)
+
+    def drain(timeout=None):
+        nonlocal stopped
+        with condition:
+            stopped = True
+            if not condition.wait_for(lambda: not outstanding, timeout):
+                logger.error('%i tasks unfinished after %.0f s, stopping '
+                             'anyway.', outstanding, timeout)
+                # их события останутся необработанными
+        replies.flush()
+
+    return accept, drain
+
+
+def main(threads_count=None, vk_session=None):
+    """Запускает бота.
+
+    Функция запускает обработку задач (start_handling) и сервер
+    метрик (settings.metrics_config).  Реализует процесс
+    авторизации в VK API с указанным токеном сообщества (все
+    запросы проходят через общий ограничитель частоты
+    rate_limit.RateLimiter) и прослушивает события на предмет
+    появления сообщений от пользователей.  Каждое сообщение
+    передается функции accept, которая создает объект задачи.
+    Позиция long poll (settings.cursor_config) отмечает событие
+    обработанным после выполнения задачи и отправки ее ответов
+    (delivery.ReplyBuffer.after) и записывается на диск при
+    остановке, когда принятые задачи выполнены (но не дольше
+    settings.runtime_config['drain_timeout'] секунд), поэтому
+    после перезапуска бот получает сообщения, пришедшие без него,
+    и не выполняет повторно уже выполненные.
 
-    for event in longpoll.listen():
+    Args:
+        threads_count - постоянное число потоков UserHandler; по
+            умолчанию пул меняет размер между min_threads и
+            max_threads из settings.pool_config;
+        vk_session - сессия rate_limit.LimitedVkApi; по умолчанию
+            создается с токеном из config (нагрузочный тест
+            benchmarks/load_test.py передает сессию, подключенную к
+            поддельному VK API).
 
-        if event.type == VkBotEventType.MESSAGE_NEW:
-            user_id = event.obj.message['from_id']
-            message = event.obj.message['text']
-            logger.info("New message '%s' from [%s].", message, user_id)
+    Исключения:
+        будут дополнены при тестировании.
 
-            task = message_handler.task(message)  # (status, [v1, v2...])
-            logger.info(
-                "Create task: '%s' with data: %s.", task[0], str(task[1]))
+    """
 
-            users_queue.put(user.User(vk, user_id, task))
+    config_logging()
+    logger = logging.getLogger('bot.main')
+
+    logger.info('START BOT')
+    state = config_storage()
+    writer = snapshot.SnapshotWriter(state, user.User.storage,
+                                     user.User.reminders,
+                                     settings.snapshot_config['interval'])
+    writer.name = 'ThreadSnapshot'
+    writer.start()
+    metrics.start_server(settings.metrics_config)
+    if vk_session is None:
+        vk_session = rate_limit.LimitedVkApi(
+            token=config.group_token,
+            limiter=rate_limit.RateLimiter(**settings.rate_limit_config)
+        )
+    accept, drain = start_handling(vk_session, threads_count)
+    position = start_cursor()
+    longpoll = BotLongPollTimeoutHandled(vk_session, config.group_id,
+                                         cursor=position,
+                                         **settings.longpoll_config)
+
+    try:
+        for event in longpoll.listen():
+            event_id = event.raw.get('event_id')
+
+            if event.type == VkBotEventType.MESSAGE_NEW:
+                accept(event.obj.message['from_id'],
+                       event.obj.message['text'],
+                       event.obj.message['date'],
+                       functools.partial(position.done, event_id))
+            else:
+                position.done(event_id)
+    finally:
+        drain(settings.runtime_config['drain_timeout'])
+        # задача, выполненная после записи позиции, повторилась бы
+        # после перезапуска
+        state.save(user.User.storage, user.User.reminders)
+        # в том числе профили из кэша, еще не записанные в хранилище
+        position.save()
 
 
 if __name__ == '__main__':
-    main()
+    if settings.runtime_config['mode'] == 'asyncio':
+        from Work import async_bot
+        async_bot.main()
+    elif settings.runtime_config['mode'] == 'processes':
+        from Work import cluster
+        cluster.main()
+    else:
+        main(settings.runtime_config['threads_count'])
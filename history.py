@@ -0,0 +1,197 @@
+"""
+Модуль индекса истории калорий.
+
+Предоставляет класс DailyIndex - суммы калорий пользователя по
+дням, упорядоченные по порядковому номеру дня, с префиксными
+суммами и разреженными таблицами минимумов и максимумов.  Сумма,
+среднее, минимум и максимум за любой период находятся двумя
+двоичными поисками, поэтому запрос за несколько лет истории стоит
+столько же, сколько за неделю.
+
+Дни задаются порядковым номером datetime.date.toordinal().
+
+Функции:
+    day_ordinal - порядковый номер дня для даты 'DD.MM.YYYY';
+    format_day - дата 'DD.MM.YYYY' для порядкового номера дня;
+    infer_day - порядковый номер дня для даты 'DD.MM' без года.
+
+"""
+
+
+import array
+import bisect
+import datetime
+import collections
+
+
+Stats = collections.namedtuple('Stats', ['days', 'total', 'min', 'max'])
+# days - число дней с записями, total - сумма калорий за период,
+# min и max - наименьшая и наибольшая сумма за день
+
+
+def day_ordinal(date):
+    """
+    Возвращает порядковый номер дня для даты 'DD.MM.YYYY'.
+    Несуществующая дата вызывает ValueError.
+
+    """
+
+    day, month, year = date.split('.')
+    return datetime.date(int(year), int(month), int(day)).toordinal()
+
+
+def format_day(ordinal):
+    """Возвращает дату 'DD.MM.YYYY' для порядкового номера дня."""
+    return datetime.date.fromordinal(ordinal).strftime('%d.%m.%Y')
+
+
+def infer_day(date, anchor):
+    """
+    Возвращает порядковый номер последнего дня с датой 'DD.MM',
+    который не позже дня anchor.  Так восстанавливается год строк
+    истории старого формата: строки идут по порядку, поэтому год
+    строки определяется по следующей за ней строке.
+
+    """
+
+    day, month = (int(value) for value in date.split('.')[:2])
+    last_year = datetime.date.fromordinal(anchor).year
+
+    for year in range(last_year, last_year - 8, -1):
+        try:
+            ordinal = datetime.date(year, month, day).toordinal()
+        except ValueError:
+            continue  # 29.02 в невисокосном году
+        if ordinal <= anchor:
+            return ordinal
+
+    raise ValueError(f'invalid date: {date}')
+
+
+class DailyIndex:
+    """Индекс сумм калорий пользователя по дням.
+
+    Attributes:
+        days - массив порядковых номеров дней с записями по
+            возрастанию;
+        prefix - массив префиксных сумм: prefix[i] - сумма
+            калорий за дни days[:i].
+
+    Methods:
+        add - добавляет калории за день;
+        query - возвращает статистику за период.
+
+    """
+
+    def __init__(self, totals=None):
+        """
+        Args:
+            totals - словарь {day: total}.
+
+        """
+
+        pairs = sorted((totals or {}).items())
+        self.days = array.array('l', (day for day, _ in pairs))
+        self._build([total for _, total in pairs])
+
+    def _build(self, values):
+        """Строит префиксные суммы и таблицы по суммам за дни."""
+
+        self.prefix = array.array('q', [0])
+        for value in values:
+            self.prefix.append(self.prefix[-1] + value)
+
+        self._mins = [array.array('q', values)]
+        self._maxs = [array.array('q', values)]
+        # _mins[k][j] - минимум за дни с j по j + 2**k - 1
+
+        size = len(values)
+        for k in range(1, size.bit_length()):
+            half = 1 << (k - 1)
+            mins, maxs = self._mins[k - 1], self._maxs[k - 1]
+            self._mins.append(array.array(
+                'q', (min(mins[j], mins[j + half])
+                      for j in range(size - (1 << k) + 1))))
+            self._maxs.append(array.array(
+                'q', (max(maxs[j], maxs[j + half])
+                      for j in range(size - (1 << k) + 1))))
+
+    def _update_tail(self):
+        """
+        Пересчитывает в таблицах единственные отрезки каждого
+        уровня, которые содержат последний день.
+
+        """
+
+        size = len(self.days)
+        for k in range(1, size.bit_length()):
+            if k == len(self._mins):
+                self._mins.append(array.array('q'))
+                self._maxs.append(array.array('q'))
+
+            j = size - (1 << k)
+            half = 1 << (k - 1)
+            low = min(self._mins[k - 1][j], self._mins[k - 1][j + half])
+            high = max(self._maxs[k - 1][j], self._maxs[k - 1][j + half])
+
+            if j == len(self._mins[k]):
+                self._mins[k].append(low)
+                self._maxs[k].append(high)
+            else:
+                self._mins[k][j] = low
+                self._maxs[k][j] = high
+
+    def add(self, day, value):
+        """Добавляет value калорий к сумме за день day.
+
+        Изменение последнего дня или добавление дня после него
+        выполняется за O(log n); изменение более раннего дня
+        перестраивает индекс.
+
+        """
+
+        values = self._mins[0]
+
+        if self.days and day == self.days[-1]:
+            values[-1] += value
+            self._maxs[0][-1] += value
+            self.prefix[-1] += value
+            self._update_tail()
+
+        elif not self.days or day > self.days[-1]:
+            self.days.append(day)
+            values.append(value)
+            self._maxs[0].append(value)
+            self.prefix.append(self.prefix[-1] + value)
+            self._update_tail()
+
+        else:
+            values = list(values)
+            i = bisect.bisect_left(self.days, day)
+            if self.days[i] == day:
+                values[i] += value
+            else:
+                self.days.insert(i, day)
+                values.insert(i, value)
+            self._build(values)
+
+    def query(self, first, last):
+        """Возвращает статистику за период с first по last.
+
+        Args:
+            first, last - порядковые номера дней (включительно).
+
+        Return:
+            объект Stats или None, если за период нет записей.
+
+        """
+
+        i = bisect.bisect_left(self.days, first)
+        j = bisect.bisect_right(self.days, last)
+        if i >= j:
+            return None
+
+        k = (j - i).bit_length() - 1
+        return Stats(j - i, self.prefix[j] - self.prefix[i],
+                     min(self._mins[k][i], self._mins[k][j - (1 << k)]),
+                     max(self._maxs[k][i], self._maxs[k][j - (1 << k)]))
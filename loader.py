@@ -0,0 +1,131 @@
+"""
+Модуль параллельной загрузки пользователей при холодном запуске.
+
+Когда снимка состояния нет, профили всех пользователей нужно
+прочитать из файлов 'users/<user_id>.txt'.  Функция
+load_text_users делит файлы на пачки и разбирает их в пуле
+процессов; каждая пачка возвращает профили и свою карту ячеек
+напоминаний, которые затем объединяются.  Поврежденные файлы не
+останавливают запуск, а подсчитываются.
+
+Функции:
+    load_text_users - загружает профили и карту ячеек из файлов;
+    slot_map - собирает карту ячеек из профилей.
+
+"""
+
+
+import os
+import logging
+import concurrent.futures
+
+from Work.storage import TextStorage
+from Work.reminder_index import slot_of
+
+
+def slot_map(profiles):
+    """Собирает карту ячеек напоминаний из профилей.
+
+    Args:
+        profiles - словарь {user_id: (zone, times)}.
+
+    Return:
+        словарь {slot: [user_id, ...]}.
+
+    """
+
+    slots = {}
+    for user_id, (zone, times) in profiles.items():
+        for t in times:
+            slots.setdefault(slot_of(t), []).append(user_id)
+    return slots
+
+
+def _parse_chunk(catalog_path, user_ids):
+    """Разбирает пачку файлов пользователей в процессе пула.
+
+    Файл целиком проходит разбор формата TextStorage._load, чтобы
+    поврежденные строки калорий тоже были замечены.
+
+    Return:
+        кортеж (profiles, slots, corrupt): profiles - словарь
+        {user_id: (zone, times)}, slots - карта ячеек, corrupt -
+        список id пользователей с поврежденными файлами.
+
+    """
+
+    text = TextStorage(catalog_path)
+    profiles = {}
+    corrupt = []
+
+    for user_id in user_ids:
+        try:
+            data = text._load(user_id)
+            zone = None if data[0][0] == 'None' else int(data[0][0])
+            times = [t for t in data[0][1] if t != 'None']
+            for t in times:
+                slot_of(t)
+            for line in data[1:]:
+                [int(cal) for cal in line[1]]
+        except FileNotFoundError:
+            continue  # пользователь успел вызвать stop
+        except Exception:
+            corrupt.append(user_id)
+            continue
+
+        profiles[user_id] = (zone, times)
+
+    return profiles, slot_map(profiles), corrupt
+
+
+def load_text_users(catalog_path, workers=None, chunk_size=1000,
+                    owns=None):
+    """Загружает профили всех пользователей из папки в пуле процессов.
+
+    Args:
+        catalog_path - путь к папке с файлами пользователей;
+        workers - число процессов (по умолчанию - число ядер);
+        chunk_size - число файлов в одной пачке;
+        owns - функция, возвращающая True для id пользователей,
+            которых нужно загрузить (по умолчанию - все).
+
+    Return:
+        кортеж (profiles, slots, corrupt_count): profiles - словарь
+        {user_id: (zone, times)}, slots - карта ячеек
+        {slot: [user_id, ...]}, corrupt_count - число поврежденных
+        файлов.
+
+    """
+
+    logger = logging.getLogger('bot.loader')
+
+    user_ids = [user_id for user_id in TextStorage(catalog_path).user_ids()
+                if owns is None or owns(user_id)]
+    chunks = [user_ids[i:i+chunk_size]
+              for i in range(0, len(user_ids), chunk_size)]
+
+    profiles = {}
+    slots = {}
+    corrupt_count = 0
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers or os.cpu_count()) as pool:
+        futures = [pool.submit(_parse_chunk, catalog_path, chunk)
+                   for chunk in chunks]
+
+        for done, future in enumerate(
+                concurrent.futures.as_completed(futures), 1):
+            chunk_profiles, chunk_slots, corrupt = future.result()
+
+            profiles.update(chunk_profiles)
+            for slot, ids in chunk_slots.items():
+                slots.setdefault(slot, []).extend(ids)
+
+            corrupt_count += len(corrupt)
+            if corrupt:
+                logger.warning('Corrupted user files: %s', corrupt)
+
+            logger.info('Loaded %i/%i chunks: %i users, %i corrupted.',
+                        done, len(chunks), len(profiles), corrupt_count)
+
+    return profiles, slots, corrupt_count
@@ -8,228 +8,174 @@
     sub [value] - вычитание из общего количества калорий в этот день
 
     give [value, 'all', 'today'] - возвращает количество калорий
+    give [value-value, 'week', 'month'] - возвращает сумму, среднее,
+        минимум и максимум калорий за период
 
     set time [value] - устанавливает время пользователя в данный момент
     set eating [values] - устанавливает время опросов пользователя
     stop - удаляет данные о пользователе из бота
     start, /start - начальное сообщение
     help - информационное сообщение
+
+    Сообщение разбирается за один проход: первое слово выбирает
+    функцию разбора из таблицы _PARSERS, которая проверяет формат и
+    допустимость значений заранее скомпилированными регулярными
+    выражениями и сразу строит кортеж (status, data).
 """
 
+import re
+
 COMMANDS = {'add': None,
             'sub': None,
-            'give': ['all', 'today'],
+            'give': ['all', 'today', 'week', 'month'],
             'set': ['time', 'eating'],
             'stop': None,
             'start': None,
             '/start': None,
             'help': None}
 
+_NUMBER = re.compile(r'\d+')
+_DATE = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+_TIME = re.compile(r'(\d+):(\d+)(?::(\d+))?')
 
-def message_to_words(message: str):
-    """
-        Возвращает список слов из сообщения пользователя.
-    """
-    words = message.replace(',', ' ').split(' ')
-    words = [value.lower() for value in words if value]
-    return words
 
+def _error(text):
+    return 'error', [text]
 
-def words_check(words) -> '2-tuple (bool, error_message)':
-    """
-        Проверяет допустимость слов в сообщении.
-    """
 
-    def check_for_date(value_words):
-        """
-            Проверяет, указана ли дата в формате DD.MM.YY.
-        """
-        if not value_words:
-            return False, 'не указана дата'
-        elif len(value_words) != 1:
-            return False, 'неверное количество значений даты'
-
-        date = value_words[0]
-        list_date = date.split('.')
-        if not (len(list_date) in (2, 3)):
-            return False, 'неверный формат даты'
-
-        for value in list_date:
-            try:
-                int(value)
-            except ValueError:
-                return False, 'неверный формат даты'
-
-        return True, None
-
-    def check_for_time(value_words):
-        """
-            Проверяет, указано ли время в формате HH:MM или HH:MM:SS.
-        """
-        if not value_words:
-            return False, 'не указано время'
-
-        for word in value_words:
-            list_time = word.split(':')
-            if not (len(list_time) in (2, 3)):
-                return False, 'неверный формат времени'
-
-            for value in list_time:
-                try:
-                    int(value)
-                except ValueError:
-                    return False, 'неверный формат времени'
-
-        return True, None
-
-    def check_for_int(value_words):
-        """
-            Проверяет, целочисленные ли значения переданы.
-        """
-        if not value_words:
-            return False, 'не указано значение'
-
-        for value in value_words:
-            try:
-                if int('-' + value) > 0:
-                    raise ValueError
-            except ValueError:
-                return False, 'значение - не целое положительное число без знака'
-
-        return True, None
-
-    # Проверка, указана ли команда первым словом в сообщении
-    if not words or words[0] not in COMMANDS:
-        return False, 'указана неверная команда первым словом сообщения'
-
-    # Проверка, являются ли значения команд допустимыми
-    general_command = words[0]
-    if general_command == 'give' and words[1] not in COMMANDS['give']:
-        flag, error_text = check_for_date(words[1:])
-        if not flag:
-            return False, error_text
-
-    elif general_command == 'set':
-        if words[1] not in COMMANDS['set']:
-            return False, 'не указан тип команды set'
-        else:
-            flag, error_text = check_for_time(words[2:])
-            if not flag:
-                return False, error_text
-
-    elif general_command in ('add', 'sub'):
-        flag, error_text = check_for_int(words[1:])
-        if not flag:
-            return False, error_text
-
-    return True, None
-
-
-def what_doing(message_words) -> '2-tuple (status, data)':
+def _parse_calories(status, args):
     """
-        Возвращает кортеж из 2-ух значений (status, data):
-            status может быть ['add', 'sub', 'give', 'set time', 'set eating',
-                               'stop', 'start', 'help']
-            data - список значений
+        Разбирает значения команд add и sub.
+        Ошибка формата любого значения важнее ошибки допустимости,
+        поэтому первая ошибка допустимости запоминается до конца
+        прохода.
     """
-    general_command = message_words[0]
+    if not args:
+        return _error('не указано значение')
 
-    if general_command == 'add':
-        return 'add', message_words[1:]
+    values = []
+    bad_value = None
+    for value in args:
+        if not _NUMBER.fullmatch(value):
+            return _error('значение - не целое положительное число без знака')
 
-    elif general_command == 'sub':
-        return 'sub', ['-'+value for value in message_words[1:]]
+        number = int(value)
+        if bad_value is None:
+            if number > 9999:
+                bad_value = 'значение больше 9999'
+            elif number < 50:
+                bad_value = 'значение меньше 50'
 
-    elif general_command == 'give':
-        return 'give', message_words[1:]
+        values.append(value if status == 'add' else '-' + value)
 
-    elif general_command == 'set':
-        return ' '.join(('set', message_words[1])), message_words[2:]
+    if bad_value is not None:
+        return _error(bad_value)
+    return status, values
 
-    elif general_command == 'stop':
-        return 'stop', [None]
 
-    elif general_command in ('start', '/start'):
-        return 'start', [None]
+def _parse_add(words):
+    return _parse_calories('add', words[1:])
 
-    elif general_command == 'help':
-        return 'help', [None]
 
+def _parse_sub(words):
+    return _parse_calories('sub', words[1:])
 
-def check_values(status, data):
+
+def _check_date(match):
     """
-        Проверяет валидность введенных значений.
-        Возвращает те же объекты, если все в порядке,
-        иначе возвращает ('error', [error_text]),
-        error_text - текст ошибки.
+        Проверяет дату на валидность.
+        Возвращает дату в виде строки (год дополняется до четырех
+        цифр) или None, если дата невалидна.
     """
-
-    def check_date(dates):
-        """
-            Проверка даты на валидность
-        """
-        # Если указан год:
-        if len(dates) > 2:
-            # Если дата указана без указания тысячелетия
-            if len(dates[2]) <= 2:
-                dates[2] = '20'+dates[2]
-
-            list_date = [int(d) for d in dates]
-
-            # Если год указан больше 2038 или месяц больше 12
-            if list_date[2] > 2038 or list_date[1] > 12:
-                return 'error', ['невалидная дата']
-            # Если год високосный, месяц - февраль и число больше 29
-            elif (list_date[2] % 4 == 0 and list_date[1] == 2 and
-                  list_date[0] > 29):
-                return 'error', ['невалидная дата']
-            # Если месяц нечетный и дата больше 31
-            elif list_date[1] % 2 == 1 and list_date[0] > 31:
-                return 'error', ['невалидная дата']
-            # Если месяц четный и дата больше 30
-            elif list_date[1] % 2 == 0 and list_date[0] > 30:
-                return 'error', ['невалидная дата']
-            return 'give', ['.'.join(dates)]
-        elif len(dates) <= 2:
-            list_date = [int(d) for d in dates]
-
-            # Если год указан больше 2038 или месяц больше 12
-            if list_date[1] > 12:
-                return 'error', ['невалидная дата']
-            # Если месяц - февраль и число больше 29
-            elif list_date[1] == 2 and list_date[0] > 29:
-                return 'error', ['невалидная дата']
-            # Если месяц нечетный и дата больше 30
-            elif list_date[1] % 2 == 1 and list_date[0] > 31:
-                return 'error', ['невалидная дата']
-            # Если месяц четный и дата больше 30
-            elif list_date[1] % 2 == 0 and list_date[0] > 30:
-                return 'error', ['невалидная дата']
-            return 'give', ['.'.join(dates)]
-
-    if status in ('add', 'sub'):
-        for value in data:
-            if abs(int(value)) > 9999:
-                return 'error', ['значение больше 9999']
-            elif abs(int(value)) < 50:
-                return 'error', ['значение меньше 50']
-
-    elif status in ('set time', 'set eating'):
-        for date in data:
-            list_time = [int(value) for value in date.split(':')]
-            if list_time[0] >= 24 or list_time[1] >= 60:
-                return 'error', ['неправильный формат времени']
-            if len(list_time) > 2:
-                if list_time[2] >= 60:
-                    return 'error', ['неправильный формат времени']
-
-    elif status == 'give':
-        list_date = data[0].split('.')
-        if list_date[0] in ('all', 'today'):
-            return status, data
-        return check_date(list_date)
-
-    return status, data
+    day_text, month_text, year_text = match.groups()
+    day, month = int(day_text), int(month_text)
+
+    if year_text is not None:
+        # Если дата указана без указания тысячелетия
+        if len(year_text) <= 2:
+            year_text = '20' + year_text
+        year = int(year_text)
+
+        # Если год указан больше 2038 или месяц больше 12
+        if year > 2038 or month > 12:
+            return None
+        # Если год високосный, месяц - февраль и число больше 29
+        if year % 4 == 0 and month == 2 and day > 29:
+            return None
+        date = f'{day_text}.{month_text}.{year_text}'
+    else:
+        if month > 12:
+            return None
+        # Если месяц - февраль и число больше 29
+        if month == 2 and day > 29:
+            return None
+        date = f'{day_text}.{month_text}'
+
+    # Если месяц нечетный и дата больше 31, четный - больше 30
+    if day > (31 if month % 2 == 1 else 30):
+        return None
+    return date
+
+
+def _parse_give(words):
+    if len(words) < 2:
+        return _error('не указана дата')
+    if words[1] in COMMANDS['give']:
+        return 'give', words[1:]
+    if len(words) != 2:
+        return _error('неверное количество значений даты')
+
+    parts = words[1].split('-')
+    if len(parts) > 2:
+        return _error('неверный формат периода')
+    # период вида DD.MM-DD.MM
+
+    matches = []
+    for part in parts:
+        match = _DATE.fullmatch(part)
+        if match is None:
+            return _error('неверный формат даты')
+        matches.append(match)
+
+    dates = []
+    for match in matches:
+        date = _check_date(match)
+        if date is None:
+            return _error('невалидная дата')
+        dates.append(date)
+    return 'give', ['-'.join(dates)]
+
+
+def _parse_set(words):
+    if len(words) < 2 or words[1] not in COMMANDS['set']:
+        return _error('не указан тип команды set')
+    if len(words) < 3:
+        return _error('не указано время')
+
+    bad_time = False
+    for word in words[2:]:
+        match = _TIME.fullmatch(word)
+        if match is None:
+            return _error('неверный формат времени')
+
+        hours, minutes, seconds = match.groups()
+        if (int(hours) >= 24 or int(minutes) >= 60 or
+                seconds is not None and int(seconds) >= 60):
+            bad_time = True
+
+    if bad_time:
+        return _error('неправильный формат времени')
+    return 'set ' + words[1], words[2:]
+
+
+_PARSERS = {'add': _parse_add,
+            'sub': _parse_sub,
+            'give': _parse_give,
+            'set': _parse_set,
+            'stop': lambda words: ('stop', [None]),
+            'start': lambda words: ('start', [None]),
+            '/start': lambda words: ('start', [None]),
+            'help': lambda words: ('help', [None])}
 
 
 def task(message: str):
@@ -240,17 +186,19 @@ def task(message: str):
         переданных пользователем, либо список с элементом
         None (для команды 'stop').
     """
-    message_words = message_to_words(message)
-    is_good, error_text = words_check(message_words)
-    if not is_good:
-        return 'error', [error_text]
+    words = [word.strip() for word in message.replace(',', ' ').lower()
+             .split(' ') if word.strip()]
+    # пробельные символы вокруг слова ('500\n') прежний разбор
+    # принимал в числах (int() их отбрасывает)
 
-    status, answer_message = what_doing(message_words)
-    return check_values(status, answer_message)
+    parser = _PARSERS.get(words[0]) if words else None
+    if parser is None:
+        return _error('указана неверная команда первым словом сообщения')
+    return parser(words)
 
 
 """
-    Задача: сделать сообщения об ошибках более информативными. 
-    Добавить сообщения о рекомендациях к правильному выполнению 
+    Задача: сделать сообщения об ошибках более информативными.
+    Добавить сообщения о рекомендациях к правильному выполнению
     команды.
 """
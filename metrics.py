@@ -0,0 +1,307 @@
+"""
+Модуль метрик бота.
+
+Содержит счетчики, показатели и гистограммы, которые заполняют
+остальные модули, и HTTP-сервер, отдающий их в текстовом формате
+Prometheus (GET /metrics) на локальном порту из
+settings.metrics_config.
+
+Классы:
+    Counter - монотонный счетчик;
+    Gauge - текущее значение (в том числе вычисляемое при чтении);
+    Histogram - распределение значений по корзинам;
+    MetricsServer - поток HTTP-сервера метрик.
+
+Функции:
+    render - возвращает все метрики в формате Prometheus;
+    start_server - запускает MetricsServer по словарю настроек.
+
+"""
+
+
+import time
+import bisect
+import threading
+import http.server
+import logging
+
+
+REGISTRY = []  # все созданные метрики в порядке создания
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+FANOUT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+def _labels_text(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание и метки.
+
+    Attributes:
+        name - имя метрики;
+        documentation - описание (строка # HELP);
+        labelnames - кортеж имен меток.
+
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {кортеж значений меток: значение}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """Возвращает строки значений без # HELP и # TYPE."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Монотонный счетчик."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_labels_text(self.labelnames, key)} {value}'
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """Текущее значение.
+
+    Значение без меток можно вычислять при каждом чтении:
+    set_function(функция без аргументов).
+
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self, **labels):
+        if self._function is not None and not labels:
+            return self._function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            values[()] = self._function()
+        return [f'{self.name}{_labels_text(self.labelnames, key)} {value}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам.
+
+    Attributes:
+        buckets - верхние границы корзин по возрастанию.
+
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+                # [число в каждой корзине, ..., +Inf, сумма]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Контекстный менеджер, измеряющий время выполнения блока."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(counts)
+                      for key, counts in self._values.items()}
+
+        lines = []
+        for key, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                labels = _labels_text(self.labelnames, key,
+                                      f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = _labels_text(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started,
+                               **self.labels)
+
+
+TASKS = Counter('bot_tasks_total',
+                'Tasks handled by status and result.', ['status', 'result'])
+TASK_SECONDS = Histogram('bot_task_seconds',
+                         'Task handling time by status.', ['status'])
+QUEUE_WAIT_SECONDS = Histogram('bot_queue_wait_seconds',
+                               'Time from task creation to handling.')
+QUEUE_DEPTH = Gauge('bot_queue_depth', 'Tasks waiting in users_queue.')
+POOL_SIZE = Gauge('bot_user_handlers', 'Running UserHandler threads.')
+REPLY_SENDERS = Gauge('bot_reply_senders',
+                      'Running ReplyBuffer sender threads.')
+WORKER_RESTARTS = Counter('bot_worker_restarts_total',
+                          'Cluster worker processes restarted after dying.')
+TASKS_REJECTED = Counter('bot_tasks_rejected_total',
+                         'Messages answered as busy instead of queued.')
+API_SECONDS = Histogram('bot_vk_api_seconds',
+                        'VK API request time by method.', ['method'])
+API_ERRORS = Counter('bot_vk_api_errors_total',
+                     'Failed VK API requests by method.', ['method'])
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'bot_rate_limit_wait_seconds',
+    'Time waiting for a rate limiter token by priority.', ['priority'])
+DELIVERY_FAILED = Counter('bot_delivery_failed_total',
+                          'Messages failed inside execute batches or '
+                          'reply sends.')
+REPLIES_COALESCED = Counter('bot_replies_coalesced_total',
+                            'Replies merged into another message to the '
+                            'same user (messages.send calls saved).')
+REMINDERS_SHED = Counter('bot_reminders_shed_total',
+                         'Reminder times deferred or dropped under load.',
+                         ['action'])
+REMINDER_FANOUT = Histogram('bot_reminder_fanout',
+                            'Users reminded per reminder slot.',
+                            buckets=FANOUT_BUCKETS)
+LONGPOLL_ERRORS = Counter('bot_longpoll_errors_total',
+                          'Long poll failures by kind.', ['kind'])
+LONGPOLL_OUTAGE_SECONDS = Histogram(
+    'bot_longpoll_outage_seconds',
+    'Time from the first long poll failure to the next response.',
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0))
+LONGPOLL_RECOVERED_EVENTS = Counter(
+    'bot_longpoll_recovered_events_total',
+    'Events in the first long poll response after an outage.')
+LONGPOLL_LAG_SECONDS = Histogram(
+    'bot_longpoll_lag_seconds',
+    'Delay between a message date (1 s resolution) and its arrival '
+    'from long poll.')
+
+
+def render():
+    """Возвращает все метрики в текстовом формате Prometheus."""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """Поток HTTP-сервера, отдающего метрики по GET /metrics.
+
+    Attributes:
+        server - объект http.server.ThreadingHTTPServer.
+
+    """
+
+    _logger = logging.getLogger('bot.metrics')
+
+    def __init__(self, host, port):
+        super().__init__()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.daemon = True
+
+    def run(self):
+        self._logger.info('Metrics on http://%s:%i/metrics.',
+                          *self.server.server_address[:2])
+        self.server.serve_forever()
+
+
+def start_server(config):
+    """Запускает MetricsServer, если config['enabled'].
+
+    Args:
+        config - словарь вида {'enabled': bool, 'host': str,
+            'port': int}.
+
+    Return:
+        объект MetricsServer или None.
+
+    """
+
+    if not config['enabled']:
+        return None
+
+    server = MetricsServer(config['host'], config['port'])
+    server.name = 'ThreadMetrics'
+    server.start()
+    return server
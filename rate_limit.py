@@ -0,0 +1,244 @@
+"""
+Модуль ограничения частоты запросов к VK API.
+
+VK API разрешает сообществу ограниченное число запросов в секунду;
+при превышении запросы получают ошибку 6 (too many requests).
+Все запросы бота проходят через общее «ведро токенов»: запрос
+ждет свободный токен, а ожидающие запросы обслуживаются по
+приоритету - ответы на команды пользователя раньше напоминаний и
+рассылок.
+
+Классы:
+    RateLimiter - ведро токенов для потоков;
+    AsyncRateLimiter - ведро токенов для asyncio;
+    LimitedVkApi - vk_api.VkApi, каждый запрос которого проходит
+        через RateLimiter.
+
+"""
+
+
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextlib
+
+import vk_api
+
+from Work import metrics
+
+
+PRIORITY_REPLY = 0  # ответы на команды и long polling
+PRIORITY_REMINDER = 1  # напоминания
+PRIORITY_BROADCAST = 2  # рассылки
+
+PRIORITY_NAMES = {PRIORITY_REPLY: 'reply',
+                  PRIORITY_REMINDER: 'reminder',
+                  PRIORITY_BROADCAST: 'broadcast'}
+
+
+class _Bucket:
+    """Общая часть ограничителей: токены, очередь и статистика.
+
+    Attributes:
+        rate - число токенов, добавляемых в секунду;
+        burst - наибольшее число накопленных токенов.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiters = []  # куча [(priority, number), ]
+        self._numbers = itertools.count()
+        self._stats = {priority: {'requests': 0, 'waiting': 0,
+                                  'wait_total': 0.0, 'wait_max': 0.0}
+                       for priority in PRIORITY_NAMES}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _enter(self, priority):
+        ticket = (priority, next(self._numbers))
+        heapq.heappush(self._waiters, ticket)
+        self._stats[priority]['waiting'] += 1
+        return ticket
+
+    def _try_take(self, ticket):
+        """
+        Забирает токен, если ticket первый в очереди и токен есть.
+
+        Return:
+            None, если токен получен, иначе время ожидания в
+            секундах (бесконечность, если ticket не первый и нужно
+            ждать сигнала).
+
+        """
+
+        self._refill()
+        if self._waiters[0] != ticket:
+            return float('inf')
+        if self._tokens >= 1:
+            self._tokens -= 1
+            heapq.heappop(self._waiters)
+            return None
+        return (1 - self._tokens) / self.rate
+
+    def _leave(self, priority, started):
+        waited = time.monotonic() - started
+        stats = self._stats[priority]
+        stats['requests'] += 1
+        stats['waiting'] -= 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+        metrics.RATE_LIMIT_WAIT_SECONDS.observe(
+            waited, priority=PRIORITY_NAMES[priority])
+
+    def stats(self):
+        """Возвращает статистику ожидания по приоритетам.
+
+        Return:
+            словарь {'reply': {'requests': int, 'waiting': int,
+            'wait_total': float, 'wait_max': float}, ...}, где
+            waiting - сколько запросов ждут сейчас, wait_total и
+            wait_max - суммарное и наибольшее ожидание в секундах.
+
+        """
+
+        return {PRIORITY_NAMES[priority]: dict(stats)
+                for priority, stats in self._stats.items()}
+
+
+class RateLimiter(_Bucket):
+    """Ведро токенов с приоритетами для потоков.
+
+    Methods:
+        acquire - ждет токен для запроса;
+        stats - возвращает статистику ожидания.
+
+    """
+
+    def __init__(self, rate=20, burst=20):
+        super().__init__(rate, burst)
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_REPLY):
+        """Блокирует поток, пока запросу не достанется токен."""
+
+        started = time.monotonic()
+
+        with self._condition:
+            ticket = self._enter(priority)
+            self._condition.notify_all()
+            # новый запрос может оказаться первым в очереди
+
+            while True:
+                delay = self._try_take(ticket)
+                if delay is None:
+                    break
+                self._condition.wait(None if delay == float('inf')
+                                     else delay)
+
+            self._condition.notify_all()
+            self._leave(priority, started)
+
+
+class AsyncRateLimiter(_Bucket):
+    """Ведро токенов с приоритетами для asyncio.
+
+    Methods:
+        acquire - ждет токен для запроса (корутина);
+        stats - возвращает статистику ожидания.
+
+    """
+
+    def __init__(self, rate=20, burst=20):
+        super().__init__(rate, burst)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, priority=PRIORITY_REPLY):
+        started = time.monotonic()
+
+        async with self._condition:
+            ticket = self._enter(priority)
+            self._condition.notify_all()
+
+            while True:
+                delay = self._try_take(ticket)
+                if delay is None:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait(),
+                        None if delay == float('inf') else delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._condition.notify_all()
+            self._leave(priority, started)
+
+
+class _PriorityMethod:
+    """Передает вызовы method в LimitedVkApi с заданным приоритетом."""
+
+    def __init__(self, api, priority):
+        self.api = api
+        self.priority = priority
+
+    def method(self, method, values=None, **kwargs):
+        return self.api.method(method, values, priority=self.priority,
+                               **kwargs)
+
+
+class LimitedVkApi(vk_api.VkApi):
+    """vk_api.VkApi с общим ограничителем частоты запросов.
+
+    Встроенная задержка vk_api (3 запроса в секунду) и общая
+    блокировка, под которой vk_api выполняет запросы по одному,
+    отключаются: частоту определяет limiter, а запросы разных
+    потоков UserHandler ожидают ответа VK одновременно.
+
+    Attributes:
+        limiter - объект RateLimiter.
+
+    Methods:
+        get_api - возвращает VkApiMethod с заданным приоритетом.
+
+    """
+
+    RPS_DELAY = 0
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or RateLimiter()
+        self.lock = contextlib.nullcontext()
+
+    def method(self, method, values=None, priority=PRIORITY_REPLY,
+               **kwargs):
+        self.limiter.acquire(priority)
+
+        started = time.monotonic()
+        try:
+            return super().method(method, values, **kwargs)
+        except Exception:
+            metrics.API_ERRORS.inc(method=method)
+            raise
+        finally:
+            metrics.API_SECONDS.observe(time.monotonic() - started,
+                                        method=method)
+
+    def get_api(self, priority=PRIORITY_REPLY):
+        """
+        Возвращает объект vk_api.vk_api.VkApiMethod, все запросы
+        которого выполняются с приоритетом priority.
+
+        """
+
+        return vk_api.vk_api.VkApiMethod(_PriorityMethod(self, priority))
@@ -0,0 +1,224 @@
+"""
+Модуль индекса напоминаний.
+
+Предоставляет класс ReminderIndex - 288 ячеек (по одной на каждые
+5 минут суток по времени сервера), в каждой из которых лежит
+массив array('q') id пользователей, которым нужно напоминание в
+это время.  Индекс хранится на диске и меняется по одной записи,
+поэтому при запуске бота его не нужно собирать из файлов
+пользователей.
+
+Формат на диске:
+    <path> - снимок: для каждой ячейки число id (uint32) и сами
+        id (int64);
+    <path>.log - журнал изменений после снимка: записи
+        (операция int8, ячейка uint16, id int64).
+
+"""
+
+
+import os
+import array
+import struct
+import threading
+import logging
+
+
+SLOTS_COUNT = 24 * 60 // 5  # 288 ячеек по 5 минут
+SLOT_MINUTES = 5
+
+
+def slot_of(clock):
+    """Возвращает номер ячейки для времени 'HH:MM'."""
+    return (int(clock[:2]) * 60 + int(clock[3:])) // SLOT_MINUTES
+
+
+class ReminderIndex:
+    """Индекс пользователей по времени напоминания.
+
+    Attributes:
+        path - путь к файлу снимка или None для индекса только в
+            памяти;
+        log_limit - число записей журнала, после которого снимок
+            перезаписывается, а журнал очищается.
+
+    Methods:
+        load - загружает индекс с диска;
+        save - записывает снимок и очищает журнал;
+        add - добавляет пользователя в ячейки;
+        set_user - заменяет ячейки пользователя;
+        remove_user - удаляет пользователя из всех ячеек;
+        rebuild - заменяет весь индекс картой ячеек;
+        get - возвращает id пользователей ячейки;
+        is_active - проверяет, есть ли пользователи в ячейке;
+        active_slots - возвращает номера непустых ячеек;
+        user_ids - возвращает id всех пользователей индекса.
+
+    """
+
+    _COUNT = struct.Struct('<I')
+    _OPERATION = struct.Struct('<bHq')
+    _ADD, _REMOVE = 1, -1
+
+    _logger = logging.getLogger('bot.reminder_index')
+
+    def __init__(self, path=None, log_limit=10000):
+        self.path = path
+        self.log_limit = log_limit
+
+        self.slots = [array.array('q') for _ in range(SLOTS_COUNT)]
+        self._log = None
+        self._log_size = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Загружает снимок и применяет журнал.
+
+        Return:
+            True, если индекс был на диске, иначе False.
+
+        """
+
+        if not os.path.isfile(self.path):
+            return False
+
+        with self._lock:
+            with open(self.path, 'rb') as file:
+                for slot in self.slots:
+                    count, = self._COUNT.unpack(file.read(self._COUNT.size))
+                    slot.fromfile(file, count)
+
+            self._log_size = 0
+            log_path = self.path + '.log'
+            if os.path.isfile(log_path):
+                with open(log_path, 'rb') as file:
+                    data = file.read()
+                size = len(data) - len(data) % self._OPERATION.size
+                # запись, оборванная при падении, отбрасывается
+                for operation, slot, user_id in self._OPERATION.iter_unpack(
+                        data[:size]):
+                    self._apply(operation, slot, user_id)
+                    self._log_size += 1
+
+        self._logger.info('Reminder index loaded: %i users in slots, '
+                          '%i log records.', sum(map(len, self.slots)),
+                          self._log_size)
+        return True
+
+    def save(self):
+        """Записывает снимок индекса и очищает журнал."""
+
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            for slot in self.slots:
+                file.write(self._COUNT.pack(len(slot)))
+                slot.tofile(file)
+        os.replace(temp_path, self.path)
+
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.path + '.log', 'wb')
+        self._log_size = 0
+
+    def _apply(self, operation, slot, user_id):
+        """
+        Применяет изменение к ячейке.  Возвращает True, если ячейка
+        изменилась.
+
+        """
+
+        ids = self.slots[slot]
+        if operation == self._ADD:
+            if user_id in ids:
+                return False
+            ids.append(user_id)
+        else:
+            if user_id not in ids:
+                return False
+            ids.remove(user_id)
+        return True
+
+    def _write(self, operation, slot, user_id):
+        """Применяет изменение и дописывает его в журнал.
+
+        Вызывается под self._lock.
+
+        """
+
+        if not self._apply(operation, slot, user_id) or self.path is None:
+            return
+
+        if self._log is None:
+            self._log = open(self.path + '.log', 'ab')
+        self._log.write(self._OPERATION.pack(operation, slot, user_id))
+        self._log.flush()
+        self._log_size += 1
+
+        if self._log_size >= self.log_limit:
+            self._save()
+
+    def add(self, user_id, slots):
+        """Добавляет пользователя в ячейки slots."""
+
+        with self._lock:
+            for slot in slots:
+                self._write(self._ADD, slot, user_id)
+
+    def set_user(self, user_id, slots):
+        """
+        Приводит ячейки пользователя к slots: записывает в журнал
+        только отличия от текущего состояния.
+
+        """
+
+        slots = set(slots)
+        with self._lock:
+            for slot, ids in enumerate(self.slots):
+                if slot in slots:
+                    self._write(self._ADD, slot, user_id)
+                elif user_id in ids:
+                    self._write(self._REMOVE, slot, user_id)
+
+    def remove_user(self, user_id):
+        """Удаляет пользователя из всех ячеек."""
+
+        with self._lock:
+            for slot, ids in enumerate(self.slots):
+                if user_id in ids:
+                    self._write(self._REMOVE, slot, user_id)
+
+    def rebuild(self, slots):
+        """Заменяет весь индекс и записывает снимок.
+
+        Args:
+            slots - словарь {slot: [user_id, ...]}.
+
+        """
+
+        with self._lock:
+            self.slots = [array.array('q', slots.get(slot, ()))
+                          for slot in range(SLOTS_COUNT)]
+            self._save()
+
+    def get(self, slot):
+        """Возвращает копию массива id пользователей ячейки."""
+
+        with self._lock:
+            return array.array('q', self.slots[slot])
+
+    def is_active(self, slot):
+        return len(self.slots[slot]) > 0
+
+    def active_slots(self):
+        return [slot for slot, ids in enumerate(self.slots) if ids]
+
+    def user_ids(self):
+        with self._lock:
+            return {user_id for ids in self.slots for user_id in ids}
@@ -0,0 +1,141 @@
+"""
+Модуль расписания напоминаний.
+
+Предоставляет класс ReminderSchedule - кучу ближайших моментов
+срабатывания времен напоминаний.  Поток eat_bot.Reminder (и
+корутина async_bot.AsyncBot.remind) спит ровно до ближайшего
+времени, у которого есть пользователи, а не просыпается каждые
+5 секунд.
+
+"""
+
+
+import time
+import heapq
+import threading
+
+
+class ReminderSchedule:
+    """Расписание срабатываний времен напоминаний.
+
+    Время напоминания задается целым числом минут от полуночи по
+    локальному времени сервера.  В куче хранится ближайший момент
+    (time.time()) его срабатывания, поэтому переход через полночь
+    и переход на летнее время учитываются сами.  Время без
+    пользователей после срабатывания из кучи удаляется и
+    возвращается в нее только через add.
+
+    Attributes:
+        late_limit - на сколько секунд срабатывание может опоздать
+            (например, при переводе часов вперед); более поздние
+            пропускаются;
+        max_sleep - наибольшее время сна в секундах, чтобы
+            перевод системных часов был замечен;
+        on_add - функция без аргументов, которая вызывается при
+            появлении нового времени (будит спящий поток).
+
+    Methods:
+        add - добавляет времена напоминаний;
+        delay - возвращает время до ближайшего срабатывания;
+        pop_due - возвращает наступившие времена.
+
+    """
+
+    late_limit = 5 * 60
+    max_sleep = 60
+
+    def __init__(self):
+        self.on_add = None
+
+        self._heap = []  # [(timestamp, minutes), ]
+        self._scheduled = set()  # minutes, которые уже есть в куче
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def next_time(minutes, after):
+        """
+        Возвращает ближайший после after момент времени, когда
+        локальное время сервера равно minutes минут от полуночи.
+
+        """
+
+        now = time.localtime(after)
+        for day in (0, 1, 2):
+            moment = time.mktime((now.tm_year, now.tm_mon,
+                                  now.tm_mday + day, minutes // 60,
+                                  minutes % 60, 0, 0, 0, -1))
+            if moment > after:
+                return moment
+
+    def add(self, minutes_list, now=None):
+        """Добавляет времена напоминаний, которых еще нет в куче.
+
+        Args:
+            minutes_list - список времен в минутах от полуночи;
+            now - текущее время time.time().
+
+        """
+
+        now = time.time() if now is None else now
+        added = False
+
+        with self._lock:
+            for minutes in minutes_list:
+                if minutes in self._scheduled:
+                    continue
+                heapq.heappush(self._heap, (self.next_time(minutes, now),
+                                            minutes))
+                self._scheduled.add(minutes)
+                added = True
+
+        if added and self.on_add is not None:
+            self.on_add()
+
+    def delay(self, now=None):
+        """
+        Возвращает число секунд до ближайшего срабатывания (не
+        больше max_sleep), 0, если оно уже наступило, или max_sleep,
+        если расписание пусто.
+
+        """
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if not self._heap:
+                return self.max_sleep
+            return min(max(self._heap[0][0] - now, 0), self.max_sleep)
+
+    def pop_due(self, is_active, now=None):
+        """Возвращает наступившие времена напоминаний.
+
+        Args:
+            is_active - функция, возвращающая True, если у времени
+                (в минутах) есть пользователи;
+            now - текущее время time.time().
+
+        Return:
+            список времен в минутах, для которых пора отправить
+            напоминания.  Опоздавшие больше чем на late_limit и
+            времена без пользователей не возвращаются.
+
+        """
+
+        now = time.time() if now is None else now
+        due = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                moment, minutes = heapq.heappop(self._heap)
+
+                if not is_active(minutes):
+                    self._scheduled.discard(minutes)
+                    continue
+
+                if now - moment <= self.late_limit:
+                    due.append(minutes)
+
+                heapq.heappush(self._heap,
+                               (self.next_time(minutes, now), minutes))
+
+        return due
@@ -1,3 +1,5 @@
+import json
+import random
 import logging
 
 
@@ -8,6 +10,57 @@ class WarnFilter(logging.Filter):
         return record.levelno < logging.WARNING
 
 
+class SampleFilter(logging.Filter):
+    """
+    Пропускает долю записей ниже WARNING от логгеров из rates.
+
+    Attributes:
+        rates - словарь {имя логгера: доля записей от 0 до 1}; доля
+            действует и для дочерних логгеров, если для них не задана
+            своя.
+
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+        self._cache = {}  # {имя логгера записи: доля}
+
+    def _rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            parent = name
+            while parent not in self.rates and '.' in parent:
+                parent = parent.rsplit('.', 1)[0]
+            rate = self._cache[name] = self.rates.get(parent, 1.0)
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Записывает каждую запись одной строкой JSON."""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'file': record.filename,
+            'func': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
 logging_config = {
     'version': 1,
     'formatters': {
@@ -23,6 +76,9 @@ logging_config = {
                 "%(threadName)-14s %(levelname)-5s [line%(lineno)d] "
                 "%(message)s"
             )
+        },
+        'json_formatter': {
+            '()': JsonFormatter
         }
     },
     'filters': {
@@ -33,16 +89,20 @@ logging_config = {
     },
     'handlers': {
         'std_handler': {
-            'class': 'logging.FileHandler',
+            'class': 'logging.handlers.RotatingFileHandler',
             'level': logging.DEBUG,
             'filename': 'logs/bot.log',  # 'Work/logs/bot.log'
+            'maxBytes': 50 * 1024 * 1024,  # новый файл после 50 МБ
+            'backupCount': 5,  # bot.log.1 ... bot.log.5
             'formatter': 'std_formatter',
             'filters': ['WarnFilter']
         },
         'err_handler': {
-            'class': 'logging.FileHandler',
+            'class': 'logging.handlers.TimedRotatingFileHandler',
             'level': logging.WARNING,
             'filename': 'logs/err_bot.log',  # 'Work/logs/err_bot.log'
+            'when': 'midnight',  # новый файл каждые сутки
+            'backupCount': 30,
             'formatter': 'err_formatter'
         }
     },
@@ -53,10 +113,140 @@ logging_config = {
             'handlers': ['std_handler', 'err_handler']
         },
         'bot.main': {},
+        'bot.main.accept': {},
         'bot.main.start_threads': {},
         'bot.main.Reminder': {},
+        'bot.main.BusyReplier': {},
         'bot.main.UserHandler': {},
+        'bot.main.UserHandlerPool': {},
         'bot.main.longPolling': {},
-        'bot.user': {}
+        'bot.user': {},
+        'bot.storage': {},
+        'bot.storage.JournalCompactor': {},
+        'bot.cache': {},
+        'bot.cache.CacheFlusher': {},
+        'bot.async': {},
+        'bot.async.longPolling': {},
+        'bot.cluster': {},
+        'bot.cursor': {},
+        'bot.cursor.CursorWriter': {},
+        'bot.delivery': {},
+        'bot.delivery.ReplyBuffer': {},
+        'bot.reminder_index': {},
+        'bot.main.config_storage': {},
+        'bot.snapshot': {},
+        'bot.snapshot.SnapshotWriter': {},
+        'bot.loader': {},
+        'bot.metrics': {}
     }
 }
+
+
+log_config = {
+    'queue': True,  # файлы логов пишет поток QueueListener, а не потоки бота
+    'json': False,  # записи строками JSON (json_formatter) вместо текста
+    'sample': {  # доля записей DEBUG/INFO, попадающих в лог
+        'bot.main.accept': 1.0,  # новые сообщения и задачи
+        'bot.main.UserHandler': 1.0,  # взятые задачи
+        'bot.user': 1.0,  # профили пользователей
+    },
+}
+
+
+storage_config = {
+    'backend': 'text',  # 'text' - файлы users/<id>.txt, 'sqlite' - база,
+    # 'binary' - двоичные файлы users/<id>.prof, .days, .entries
+    'path': 'users',  # папка для 'text'/'binary' или файл базы ('users.db')
+    'compact_threshold': 50,  # строк журнала до свертки файла ('text')
+}
+
+
+cache_config = {
+    'max_entries': 10000,  # профилей в памяти
+    'flush_interval': 1.0,  # секунд между записями измененных профилей
+    'batch_size': 100,  # измененных профилей для досрочной записи
+}
+
+
+runtime_config = {
+    'mode': 'threads',  # 'threads' - потоки eat_bot, 'asyncio' - async_bot,
+    # 'processes' - диспетчер и процессы-обработчики cluster
+    'threads_count': None,  # постоянное число потоков UserHandler в
+    # режиме 'threads' (None - по нагрузке, см. pool_config)
+    'max_concurrent_sends': 1000,  # одновременных запросов в 'asyncio'
+    'processes': None,  # процессов-обработчиков в 'processes' (None - ядра)
+    'drain_timeout': 30.0,  # секунд на выполнение принятых задач при
+    # остановке; события невыполненных остаются необработанными
+}
+
+
+longpoll_config = {
+    'wait': 25,  # секунд ожидания событий в одном запросе long poll
+    'backoff_base': 1.0,  # секунд задержки после первой ошибки соединения
+    'backoff_max': 60.0,  # наибольшая задержка между попытками
+}
+
+
+cursor_config = {
+    'path': 'longpoll.cursor',  # позиция long poll для перезапуска
+    'window': 1000,  # id обработанных событий для пропуска повторов
+    'interval': 1.0,  # секунд между записями позиции
+}
+
+
+pool_config = {
+    'shards': 64,  # шардов очереди задач (наибольшая параллельность)
+    'min_threads': 2,  # потоков UserHandler ночью
+    'max_threads': 32,  # потоков UserHandler в часы пик
+    'interval': 5.0,  # секунд между пересчетами размера пула
+    'drain_time': 2.0,  # за сколько секунд пул должен разобрать очередь
+}
+
+
+backpressure_config = {
+    'high_water': 1000,  # задач в очереди, после которых - ответ «занят»
+    'reminder_water': 200,  # задач в очереди, при которых напоминания ждут
+    'reminder_defer': 300,  # секунд отсрочки напоминаний до пропуска
+    'busy_interval': 60,  # секунд между ответами «занят» одному человеку
+}
+
+
+reply_config = {
+    'window': 0.1,  # секунд накопления ответов одному пользователю
+    'limit': 4096,  # символов в объединенном сообщении (лимит VK)
+    'max_senders': 32,  # потоков отправки ответов в часы пик
+    'idle_time': 5.0,  # секунд простоя до завершения потока отправки
+    'attempts': 3,  # попыток отправить ответ после ошибок сети
+    'retry_delay': 1.0,  # секунд до первого повтора (далее вдвое больше)
+}
+
+
+reminders_config = {
+    'path': 'reminders.idx',  # снимок индекса напоминаний (+ '.log')
+    'log_limit': 10000,  # записей журнала индекса до нового снимка
+}
+
+
+rate_limit_config = {
+    'rate': 20,  # запросов к VK API в секунду (лимит для сообщества)
+    'burst': 20,  # наибольшая пачка запросов без ожидания
+}
+
+
+snapshot_config = {
+    'path': 'state.snapshot',  # снимок состояния для быстрого запуска
+    'interval': 300,  # секунд между периодическими снимками
+}
+
+
+loader_config = {
+    'workers': None,  # процессов для холодного запуска (None - по ядрам)
+    'chunk_size': 1000,  # файлов пользователей в одной пачке
+}
+
+
+metrics_config = {
+    'enabled': True,  # сервер метрик Prometheus (GET /metrics)
+    'host': '127.0.0.1',  # только локальные подключения
+    'port': 9108,
+}
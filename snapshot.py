@@ -0,0 +1,125 @@
+"""
+Модуль снимков состояния бота.
+
+Снимок содержит момент своего создания и профили (часовой пояс и
+время напоминаний) из кэша cache.ProfileCache; вместе со снимком
+записывается индекс напоминаний reminder_index.ReminderIndex.
+При запуске бот загружает снимок за миллисекунды и перечитывает
+только профили, изменившиеся после его создания, вместо того чтобы
+открывать файлы всех пользователей.
+
+Классы:
+    StateSnapshot - чтение и запись снимка;
+    SnapshotWriter - поток, периодически записывающий снимок.
+
+"""
+
+
+import os
+import time
+import pickle
+import threading
+import logging
+
+
+class StateSnapshot:
+    """Снимок состояния бота в файле.
+
+    Attributes:
+        path - путь к файлу снимка.
+
+    Methods:
+        load - читает снимок;
+        save - записывает снимок.
+
+    """
+
+    VERSION = 1
+
+    _logger = logging.getLogger('bot.snapshot')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Читает снимок.
+
+        Return:
+            кортеж (created, profiles), где created - момент
+            создания снимка (time.time()), profiles - словарь
+            {user_id: (zone, times)}, или None, если снимка нет или
+            он поврежден.
+
+        """
+
+        try:
+            with open(self.path, 'rb') as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._logger.exception('Snapshot is corrupted, ignoring it.')
+            return None
+
+        if state.get('version') != self.VERSION:
+            return None
+        return state['created'], state['profiles']
+
+    def save(self, cache, reminders):
+        """Записывает снимок.
+
+        Args:
+            cache - объект cache.ProfileCache;
+            reminders - объект reminder_index.ReminderIndex.
+
+        """
+
+        with self._lock:
+            created = time.time()
+            # профили, измененные после этого момента, будут
+            # перечитаны при следующем запуске
+            cache.flush()
+            reminders.save()
+
+            state = {'version': self.VERSION,
+                     'created': created,
+                     'profiles': cache.profiles()}
+
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as file:
+                pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+
+        self._logger.info('Snapshot saved: %i profiles.',
+                          len(state['profiles']))
+
+
+class SnapshotWriter(threading.Thread):
+    """Поток, записывающий снимок раз в interval секунд.
+
+    Attributes:
+        snapshot - объект StateSnapshot;
+        cache - объект cache.ProfileCache;
+        reminders - объект reminder_index.ReminderIndex;
+        interval - период записи в секундах.
+
+    """
+
+    _logger = logging.getLogger('bot.snapshot.SnapshotWriter')
+
+    def __init__(self, snapshot, cache, reminders, interval):
+        super().__init__()
+        self.snapshot = snapshot
+        self.cache = cache
+        self.reminders = reminders
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.snapshot.save(self.cache, self.reminders)
+            except Exception:
+                self._logger.exception('Some exception in SnapshotWriter.')
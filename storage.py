@@ -0,0 +1,1000 @@
+"""
+Модуль хранилищ данных пользователей.
+
+Предоставляет общий интерфейс Storage, через который класс
+user.User читает и записывает часовой пояс, время напоминаний и
+калории пользователя, и его реализации:
+    TextStorage - файлы 'users/<user_id>.txt' (исходный формат),
+        калории дописываются в конец файла как в журнал;
+    SQLiteStorage - база SQLite в режиме WAL;
+    BinaryStorage - двоичные файлы фиксированной ширины, суммы
+        калорий читаются через mmap.
+
+Функции:
+    create_storage - создает хранилище по словарю настроек;
+    migrate - переносит всех пользователей из одного хранилища в
+        другое (например, из текстовых файлов в SQLite).
+
+"""
+
+
+import os
+import mmap
+import time
+import array
+import queue
+import struct
+import bisect
+import datetime
+import sqlite3
+import threading
+import collections
+import logging
+
+from Work.history import DailyIndex, format_day, infer_day
+
+
+class Storage:
+    """Интерфейс хранилища данных пользователей.
+
+    Профиль пользователя - кортеж (zone, times), где zone -
+    целочисленное смещение времени в минутах или None, times -
+    список времен напоминаний в формате 'HH:MM' (время сервера).
+    Калории хранятся списками целых чисел по дням day - порядковым
+    номерам дня datetime.date.toordinal(), упорядоченным по
+    возрастанию; рядом с ними хранится сумма калорий за каждый
+    день, которая обновляется при каждом добавлении.
+
+    Methods:
+        load_profile - возвращает профиль пользователя или None;
+        create - создает пустой профиль пользователя;
+        save_zone - сохраняет часовой пояс;
+        add_times - добавляет времена напоминаний;
+        save_profiles - сохраняет пачку профилей целиком;
+        add_calories - добавляет калории за день;
+        get_calories - возвращает калории за день или за все дни;
+        get_total - возвращает сумму калорий за день;
+        get_totals - возвращает суммы калорий по дням;
+        get_stats - возвращает статистику калорий за период;
+        delete - удаляет все данные пользователя;
+        user_ids - возвращает id всех пользователей в хранилище;
+        changed_since - возвращает id пользователей, профили которых
+            менялись после указанного момента;
+        flush - записывает на диск отложенные изменения.
+
+    """
+
+    def load_profile(self, user_id):
+        raise NotImplementedError
+
+    def create(self, user_id):
+        raise NotImplementedError
+
+    def save_zone(self, user_id, zone):
+        raise NotImplementedError
+
+    def add_times(self, user_id, times):
+        raise NotImplementedError
+
+    def save_profiles(self, profiles):
+        """
+        Сохраняет профили из словаря {user_id: (zone, times)},
+        полностью заменяя сохраненные ранее.
+
+        """
+        raise NotImplementedError
+
+    def add_calories(self, user_id, day, values):
+        raise NotImplementedError
+
+    def get_calories(self, user_id, day=None):
+        """
+        Возвращает словарь {day: [v1, v2, ...]} за день day или за
+        все дни по возрастанию, если day равен None.  Словарь может
+        быть пустым.
+
+        """
+        raise NotImplementedError
+
+    def get_total(self, user_id, day):
+        """
+        Возвращает сумму калорий за день day или None, если
+        за этот день нет записей.
+
+        """
+
+        return self.get_totals(user_id, day).get(day)
+
+    def get_totals(self, user_id, day=None):
+        """
+        Возвращает словарь {day: total} за день day или за все
+        дни, если day равен None.  Словарь может быть пустым.
+
+        """
+
+        return {key: sum(values) for key, values
+                in self.get_calories(user_id, day).items()}
+
+    def get_stats(self, user_id, first, last):
+        """
+        Возвращает статистику калорий (history.Stats) за период с
+        дня first по день last включительно или None, если за
+        период нет записей.
+
+        """
+
+        return self.history(user_id).query(first, last)
+
+    def history(self, user_id):
+        """Строит индекс history.DailyIndex сумм калорий по дням."""
+        return DailyIndex(self.get_totals(user_id))
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def user_ids(self):
+        raise NotImplementedError
+
+    def changed_since(self, timestamp):
+        """
+        Возвращает id пользователей, профили которых могли
+        измениться после момента timestamp (time.time()).
+
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class JournalCompactor(threading.Thread):
+    """Фоновый поток, сворачивающий журналы TextStorage.
+
+    Забирает id пользователей из очереди и переписывает их файлы
+    так, чтобы на каждую дату осталась одна строка.
+
+    Attributes:
+        storage - объект TextStorage;
+        q - очередь queue.Queue из id пользователей.
+
+    """
+
+    _logger = logging.getLogger('bot.storage.JournalCompactor')
+
+    def __init__(self, storage):
+        super().__init__()
+        self.storage = storage
+        self.q = queue.Queue()
+        self.daemon = True
+
+    def run(self):
+        while True:
+            user_id = self.q.get()
+            try:
+                self.storage.compact(user_id)
+            except FileNotFoundError:
+                pass  # пользователь успел вызвать stop
+            except Exception:
+                self._logger.exception('Some exception in JournalCompactor.')
+            finally:
+                self.q.task_done()
+
+
+class TextStorage(Storage):
+    """Хранилище в текстовых файлах 'users/<user_id>.txt'.
+
+    Формат файла:
+        zone=<zone> times_to_eat=<HH:MM,HH:MM,...>
+        day=<day> calories=<v1,v2,...> total=<сумма>
+        day=<day> calories=<v1,v2,...> total=<сумма>
+
+    Файл работает как журнал: add_calories дописывает в конец одну
+    строку, даже если строка с этим днем уже есть, поэтому запись
+    не зависит от длины истории.  Строки с одним днем при чтении
+    объединяются.  total - сумма калорий за день с учетом
+    предыдущих строк этого дня, поэтому сумма за день последней
+    строки читается с конца файла без разбора истории.  День
+    может идти раньше уже записанных (set time сдвинул местную
+    дату назад), поэтому сумма нового дня считается нулевой без
+    чтения истории, только если он позже наибольшего дня в файле;
+    этот день запоминается при первом чтении истории.
+
+    Строки старого формата 'date=<DD.MM> calories=<...>' не
+    содержат года (и total); год восстанавливается по порядку
+    строк (history.infer_day), начиная с даты изменения файла.
+    Перед первой дописанной строкой такой файл переписывается в
+    новом формате, пока дата его изменения еще относится к старым
+    строкам.
+    Когда число дописанных строк
+    пользователя достигает compact_threshold, поток
+    JournalCompactor сворачивает их в одну строку на дату.
+
+    Attributes:
+        catalog_path - путь к папке с файлами пользователей;
+        compact_threshold - число дописанных строк, после
+            которого файл пользователя сворачивается.
+
+    """
+
+    _LOCKS_COUNT = 64
+
+    def __init__(self, catalog_path, compact_threshold=50):
+        self.catalog_path = catalog_path
+        self.compact_threshold = compact_threshold
+
+        self._appended = collections.Counter()
+        # {user_id: число строк, дописанных после последней свертки}
+        self._last_days = {}  # {user_id: наибольший день в файле}
+        self._locks = [threading.Lock() for _ in range(self._LOCKS_COUNT)]
+        # запись в файл и его свертка не должны пересекаться
+        self._compactor = None
+        self._compactor_lock = threading.Lock()  # запуск JournalCompactor
+
+    def _filename(self, user_id):
+        return self.catalog_path + f'/{user_id}.txt'
+
+    def _lock(self, user_id):
+        return self._locks[user_id % self._LOCKS_COUNT]
+
+    def _load(self, user_id):
+        """Читает данные из файла пользователя.
+
+        Возвращает список формата:
+        [
+         [zone: str, [*eatstimes: str]],
+         [day: int, [*calories: str], total: int],
+         [day: int, [*calories: str], total: int],
+        ]
+        , в котором дни идут по возрастанию и не повторяются.
+
+        """
+
+        with open(self._filename(user_id), 'r') as file:
+
+            first_line = file.readline().strip().split(' ')
+            zone = first_line[0].split('=')[1]
+            # 'None' или смещение времени в минутах в виде str
+            times_to_eat = first_line[1].split('=')[1].split(',')
+            # ['None'] or ['HH:MM', 'HH:MM', ...]
+
+            records = []
+            for line in file.readlines():
+                string = line.strip().split(' ')
+                key, day = string[0].split('=')
+                calories = string[1].split('=')[1].split(',')
+                total = (int(string[2].split('=')[1]) if len(string) > 2
+                         else None)
+                records.append([int(day) if key == 'day' else day,
+                                calories, total])
+
+            modified = os.fstat(file.fileno()).st_mtime
+
+        anchor = datetime.date.fromtimestamp(modified).toordinal()
+        for record in reversed(records):
+            if isinstance(record[0], str):
+                record[0] = anchor = infer_day(record[0], anchor)
+                # строка старого формата 'DD.MM' без года; строки
+                # нового формата дописаны позже и год не определяют
+
+        days = {}
+        for day, calories, total in records:
+            entry = days.setdefault(day, [[], None])
+            entry[0].extend(calories)
+            entry[1] = total
+            # несвернутые записи журнала за тот же день
+
+        lines = [[zone, times_to_eat]]
+        for day in sorted(days):
+            calories, total = days[day]
+            if total is None:
+                total = sum(int(cal) for cal in calories)
+                # строка старого формата без total
+            lines.append([day, calories, total])
+
+        return lines
+
+    def _save_with_data(self, user_id, data):
+        """
+        Сохраняет данные в формате метода _load, полностью
+        перезаписывая файл пользователя.  Файл заменяется целиком
+        (os.replace), поэтому читатели без блокировки никогда не
+        видят его обрезанным.
+
+        """
+
+        text = f"zone={data[0][0]} times_to_eat={','.join(data[0][1])}"
+        if len(data) > 1:
+            for day, calories, total in data[1:]:
+                text += (f"\nday={day} calories={','.join(calories)} "
+                         f"total={total}")
+
+        filename = self._filename(user_id)
+        with open(filename + '.tmp', 'w') as file:
+            file.write(text)
+        os.replace(filename + '.tmp', filename)
+
+        self._appended.pop(user_id, None)
+        if len(data) > 1:
+            self._last_days[user_id] = data[-1][0]
+        else:
+            self._last_days.pop(user_id, None)
+
+    def compact(self, user_id):
+        """Сворачивает журнал пользователя: одна строка на дату."""
+
+        with self._lock(user_id):
+            self._save_with_data(user_id, self._load(user_id))
+
+    def _last_line(self, user_id):
+        """
+        Читает последнюю строку файла пользователя с конца файла.
+        Возвращает кортеж (day, total), None, если строк с калориями
+        нет, или (None, None), если последняя строка старого формата.
+
+        """
+
+        with open(self._filename(user_id), 'rb') as file:
+            end = file.seek(0, os.SEEK_END)
+            tail = b''
+            position = end
+            while position > 0 and b'\n' not in tail:
+                position = max(position - 512, 0)
+                file.seek(position)
+                tail = file.read(end - position)
+
+        if b'\n' not in tail:
+            return None  # в файле только профиль
+
+        string = tail.rsplit(b'\n', 1)[1].decode().strip().split(' ')
+        if len(string) < 3 or not string[0].startswith('day='):
+            return None, None
+        return int(string[0].split('=')[1]), int(string[2].split('=')[1])
+
+    def _schedule_compaction(self, user_id):
+        """Передает пользователя потоку JournalCompactor."""
+
+        with self._compactor_lock:
+            if self._compactor is None:
+                self._compactor = JournalCompactor(self)
+                self._compactor.name = 'ThreadCompactor'
+                self._compactor.start()
+
+        self._compactor.q.put(user_id)
+
+    def load_profile(self, user_id):
+        try:
+            with open(self._filename(user_id), 'r') as file:
+                first_line = file.readline().strip().split(' ')
+        except FileNotFoundError:
+            return None
+        # журнал калорий для профиля читать не нужно
+
+        zone = first_line[0].split('=')[1]
+        times = first_line[1].split('=')[1].split(',')
+
+        return (None if zone == 'None' else int(zone),
+                [t for t in times if t != 'None'])
+
+    def create(self, user_id):
+        os.makedirs(self.catalog_path, exist_ok=True)
+        # шарды создают первых пользователей параллельно
+
+        with open(self._filename(user_id), 'w') as file:
+            file.write("zone=None eating_times=None")
+        self._last_days.pop(user_id, None)
+
+    def save_zone(self, user_id, zone):
+        with self._lock(user_id):
+            data = self._load(user_id)
+            data[0][0] = str(zone)
+
+            self._save_with_data(user_id, data)
+
+    def add_times(self, user_id, times):
+        with self._lock(user_id):
+            data = self._load(user_id)
+
+            if data[0][1] == ['None']:
+                data[0][1] = list(times)
+            else:
+                data[0][1].extend(times)
+
+            self._save_with_data(user_id, data)
+
+    def save_profiles(self, profiles):
+        for user_id, (zone, times) in profiles.items():
+            with self._lock(user_id):
+                try:
+                    data = self._load(user_id)
+                except FileNotFoundError:
+                    data = [None]
+                data[0] = [str(zone), list(times) or ['None']]
+
+                self._save_with_data(user_id, data)
+
+    def add_calories(self, user_id, day, values):
+        with self._lock(user_id):
+            last = self._last_line(user_id)
+            if last == (None, None):
+                self._save_with_data(user_id, self._load(user_id))
+                last = self._last_line(user_id)
+                # дописанная строка изменит дату изменения файла, по
+                # которой восстанавливается год строк старого формата
+            total = self._day_total(user_id, day, last)
+            line = (f"\nday={day} "
+                    f"calories={','.join(str(v) for v in values)} "
+                    f"total={(total or 0) + sum(values)}")
+
+            with open(self._filename(user_id), 'a') as file:
+                file.write(line)
+            if last is None:
+                self._last_days[user_id] = day
+            elif user_id in self._last_days:
+                self._last_days[user_id] = max(self._last_days[user_id],
+                                               day)
+            self._appended[user_id] += 1
+            appended = self._appended[user_id]
+
+        if appended == self.compact_threshold:
+            self._schedule_compaction(user_id)
+
+    def _lines(self, user_id, day):
+        """
+        Возвращает строки калорий формата _load за день day или
+        все строки, если day равен None.
+
+        """
+
+        lines = self._load(user_id)[1:]
+        if day is None:
+            return lines
+
+        i = bisect.bisect_left(lines, [day])
+        return lines[i:i+1] if i < len(lines) and lines[i][0] == day else []
+
+    def get_calories(self, user_id, day=None):
+        return {line[0]: [int(cal) for cal in line[1]]
+                for line in self._lines(user_id, day)}
+
+    def _total(self, user_id, day):
+        return self._day_total(user_id, day, self._last_line(user_id))
+
+    def _day_total(self, user_id, day, last):
+        """
+        Возвращает сумму калорий за день day по последней строке
+        last (результат _last_line), читая историю, только если день
+        не совпадает с днем последней строки и не позже наибольшего
+        известного дня файла.
+
+        """
+
+        if last is None:
+            return None  # записей калорий нет
+        last_day, total = last
+        if last_day == day:
+            return total
+        if day > self._last_days.get(user_id, day):
+            return None  # первая запись за день позже всех в файле
+
+        totals = self.get_totals(user_id)
+        self._last_days[user_id] = max(totals)
+        return totals.get(day)
+
+    def get_total(self, user_id, day):
+        with self._lock(user_id):
+            return self._total(user_id, day)
+
+    def get_totals(self, user_id, day=None):
+        return {line[0]: line[2] for line in self._lines(user_id, day)}
+
+    def delete(self, user_id):
+        with self._lock(user_id):
+            os.remove(self._filename(user_id))
+            self._appended.pop(user_id, None)
+            self._last_days.pop(user_id, None)
+
+    def user_ids(self):
+        try:
+            return [int(name.split('.')[0])
+                    for name in os.listdir(self.catalog_path)
+                    if name.endswith('.txt')]
+        except FileNotFoundError:
+            return []
+
+    def changed_since(self, timestamp):
+        # файлы не открываются: достаточно времени изменения
+        try:
+            with os.scandir(self.catalog_path) as entries:
+                return [int(entry.name.split('.')[0]) for entry in entries
+                        if entry.name.endswith('.txt') and
+                        entry.stat().st_mtime >= timestamp]
+        except FileNotFoundError:
+            return []
+
+
+def _infer_calories_days(conn):
+    """
+    Заполняет столбец day таблицы calories старой базы, в которой
+    были только даты 'DD.MM': год восстанавливается по порядку
+    строк каждого пользователя, начиная с сегодняшнего дня.
+
+    """
+
+    today = datetime.date.today().toordinal()
+    updates = []
+    user = anchor = None
+
+    for rowid, user_id, date in conn.execute(
+            'SELECT rowid, user_id, date FROM calories '
+            'ORDER BY user_id, rowid DESC'):
+        if user_id != user:
+            user, anchor = user_id, today
+        anchor = infer_day(date, anchor)
+        updates.append((anchor, rowid))
+
+    conn.executemany('UPDATE calories SET day = ? WHERE rowid = ?', updates)
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в базе SQLite.
+
+    База работает в режиме WAL, поэтому чтения из потоков
+    UserHandler не блокируются записью.  Каждый поток использует
+    собственное соединение.
+
+    Таблицы:
+        profiles (user_id, zone, times, updated) - times хранится
+            строкой 'HH:MM,HH:MM' или пустой строкой, updated -
+            время последнего изменения профиля (time.time());
+        calories (user_id, date, day, value) - по строке на каждое
+            введенное значение, индекс по (user_id, day); date -
+            дата 'DD.MM.YYYY' (в старых базах 'DD.MM');
+        totals (user_id, day, total) - сумма калорий за день,
+            обновляется вместе с calories.
+
+    Attributes:
+        path - путь к файлу базы.
+
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS profiles ("
+        " user_id INTEGER PRIMARY KEY,"
+        " zone INTEGER,"
+        " times TEXT NOT NULL DEFAULT '')",
+        "CREATE TABLE IF NOT EXISTS calories ("
+        " user_id INTEGER NOT NULL,"
+        " date TEXT NOT NULL,"
+        " value INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS calories_user_date "
+        "ON calories (user_id, date)",
+    )
+    _MIGRATIONS = {
+        ('profiles', 'updated'): (
+            "ALTER TABLE profiles "
+            "ADD COLUMN updated REAL NOT NULL DEFAULT 0",
+            "CREATE INDEX IF NOT EXISTS profiles_updated "
+            "ON profiles (updated)",
+        ),
+        ('totals', 'total'): (
+            "CREATE TABLE totals ("
+            " user_id INTEGER NOT NULL,"
+            " date TEXT NOT NULL,"
+            " total INTEGER NOT NULL,"
+            " PRIMARY KEY (user_id, date))",
+            "INSERT INTO totals (user_id, date, total) "
+            "SELECT user_id, date, SUM(value) FROM calories "
+            "GROUP BY user_id, date",
+        ),
+        ('calories', 'day'): (
+            "ALTER TABLE calories ADD COLUMN day INTEGER",
+            _infer_calories_days,
+            "CREATE INDEX IF NOT EXISTS calories_user_day "
+            "ON calories (user_id, day)",
+        ),
+        ('totals', 'day'): (
+            "DROP TABLE totals",
+            "CREATE TABLE totals ("
+            " user_id INTEGER NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " total INTEGER NOT NULL,"
+            " PRIMARY KEY (user_id, day))",
+            "INSERT INTO totals (user_id, day, total) "
+            "SELECT user_id, day, SUM(value) FROM calories "
+            "GROUP BY user_id, day",
+        ),
+    }
+    # {(таблица, столбец): запросы (или функции от соединения),
+    # добавляющие столбец в старую базу}
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._connection() as conn:
+            for statement in self._SCHEMA:
+                conn.execute(statement)
+
+            for (table, column), statements in self._MIGRATIONS.items():
+                columns = [row[1] for row in
+                           conn.execute(f'PRAGMA table_info({table})')]
+                if column not in columns:
+                    for statement in statements:
+                        if callable(statement):
+                            statement(conn)
+                        else:
+                            conn.execute(statement)
+
+    def _connection(self):
+        """Возвращает соединение с базой для текущего потока."""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def load_profile(self, user_id):
+        row = self._connection().execute(
+            'SELECT zone, times FROM profiles WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+
+        if row is None:
+            return None
+        return row[0], row[1].split(',') if row[1] else []
+
+    def create(self, user_id):
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO profiles (user_id, updated) '
+                'VALUES (?, ?)', (user_id, time.time())
+            )
+
+    def save_zone(self, user_id, zone):
+        with self._connection() as conn:
+            conn.execute(
+                'UPDATE profiles SET zone = ?, updated = ? WHERE user_id = ?',
+                (zone, time.time(), user_id)
+            )
+
+    def add_times(self, user_id, times):
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT times FROM profiles WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            old = row[0].split(',') if row and row[0] else []
+            conn.execute(
+                'UPDATE profiles SET times = ?, updated = ? WHERE user_id = ?',
+                (','.join(old + list(times)), time.time(), user_id)
+            )
+
+    def save_profiles(self, profiles):
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT INTO profiles (user_id, zone, times, updated) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE '
+                'SET zone = excluded.zone, times = excluded.times, '
+                'updated = excluded.updated',
+                [(user_id, zone, ','.join(times), time.time())
+                 for user_id, (zone, times) in profiles.items()]
+            )
+
+    def add_calories(self, user_id, day, values):
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT INTO calories (user_id, date, day, value) '
+                'VALUES (?, ?, ?, ?)',
+                [(user_id, format_day(day), day, int(v)) for v in values]
+            )
+            conn.execute(
+                'INSERT INTO totals (user_id, day, total) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id, day) DO UPDATE '
+                'SET total = total + excluded.total',
+                (user_id, day, sum(int(v) for v in values))
+            )
+
+    def get_calories(self, user_id, day=None):
+        if day is None:
+            rows = self._connection().execute(
+                'SELECT day, value FROM calories WHERE user_id = ? '
+                'ORDER BY day, rowid', (user_id,)
+            )
+        else:
+            rows = self._connection().execute(
+                'SELECT day, value FROM calories '
+                'WHERE user_id = ? AND day = ? ORDER BY rowid',
+                (user_id, day)
+            )
+
+        calories = {}
+        for key, value in rows:
+            calories.setdefault(key, []).append(value)
+        return calories
+
+    def get_totals(self, user_id, day=None):
+        if day is None:
+            rows = self._connection().execute(
+                'SELECT day, total FROM totals WHERE user_id = ? '
+                'ORDER BY day', (user_id,)
+            )
+        else:
+            rows = self._connection().execute(
+                'SELECT day, total FROM totals '
+                'WHERE user_id = ? AND day = ?', (user_id, day)
+            )
+        return dict(rows)
+
+    def delete(self, user_id):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM calories WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM totals WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM profiles WHERE user_id = ?', (user_id,))
+
+    def user_ids(self):
+        return [row[0] for row in self._connection().execute(
+            'SELECT user_id FROM profiles')]
+
+    def changed_since(self, timestamp):
+        return [row[0] for row in self._connection().execute(
+            'SELECT user_id FROM profiles WHERE updated >= ?', (timestamp,))]
+
+
+class BinaryStorage(Storage):
+    """Хранилище в двоичных файлах фиксированной ширины.
+
+    Для каждого пользователя в папке catalog_path лежат три файла:
+        <user_id>.prof - профиль: смещение zone (int32, ZONE_NONE,
+            если не задано) и времена напоминаний в минутах от
+            полуночи (uint16);
+        <user_id>.days - пары array('i') (day, total) по
+            возрастанию day: сумма калорий за каждый день;
+        <user_id>.entries - пары array('i') (day, value) в порядке
+            ввода: каждое введенное значение.
+
+    Суммы читаются через mmap без копирования и разбора строк:
+    день ищется двоичным поиском по срезу дней.  Добавление
+    калорий за последний день перезаписывает последнюю пару на
+    месте, за новый день - дописывает пару в конец.
+
+    Attributes:
+        catalog_path - путь к папке с файлами пользователей.
+
+    """
+
+    ZONE_NONE = -2 ** 31
+
+    _PROFILE = struct.Struct('=i')
+    _PAIR = struct.Struct('=ii')
+    _LOCKS_COUNT = 64
+
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        self._locks = [threading.Lock() for _ in range(self._LOCKS_COUNT)]
+
+    def _filename(self, user_id, kind):
+        return os.path.join(self.catalog_path, f'{user_id}.{kind}')
+
+    def _lock(self, user_id):
+        return self._locks[user_id % self._LOCKS_COUNT]
+
+    def _read_pairs(self, user_id, kind, reader):
+        """
+        Отображает файл kind в память и вызывает reader с
+        memoryview целых чисел 'i' (пустым, если файл пуст).
+
+        """
+
+        with open(self._filename(user_id, kind), 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                return reader(memoryview(array.array('i')))
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view, view.cast('i') as ints:
+                    return reader(ints)
+                # view должен быть освобожден до закрытия mmap
+
+    def _write_profile(self, user_id, zone, times):
+        """
+        Записывает профиль.  Файл заменяется целиком (os.replace),
+        поэтому load_profile без блокировки никогда не видит его
+        обрезанным.
+
+        """
+
+        data = array.array('H', [int(t[:2]) * 60 + int(t[3:])
+                                 for t in times])
+        filename = self._filename(user_id, 'prof')
+        with open(filename + '.tmp', 'wb') as file:
+            file.write(self._PROFILE.pack(
+                self.ZONE_NONE if zone is None else zone))
+            data.tofile(file)
+        os.replace(filename + '.tmp', filename)
+
+    def load_profile(self, user_id):
+        try:
+            with open(self._filename(user_id, 'prof'), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+
+        zone, = self._PROFILE.unpack_from(data)
+        minutes = array.array('H', data[self._PROFILE.size:])
+
+        return (None if zone == self.ZONE_NONE else zone,
+                [f'{m // 60:02}:{m % 60:02}' for m in minutes])
+
+    def create(self, user_id):
+        os.makedirs(self.catalog_path, exist_ok=True)
+
+        with self._lock(user_id):
+            for kind in ('days', 'entries'):
+                open(self._filename(user_id, kind), 'wb').close()
+            self._write_profile(user_id, None, [])
+
+    def save_zone(self, user_id, zone):
+        with self._lock(user_id):
+            times = self.load_profile(user_id)[1]
+            self._write_profile(user_id, zone, times)
+
+    def add_times(self, user_id, times):
+        with self._lock(user_id):
+            zone, old = self.load_profile(user_id)
+            self._write_profile(user_id, zone, old + list(times))
+
+    def save_profiles(self, profiles):
+        for user_id, (zone, times) in profiles.items():
+            with self._lock(user_id):
+                self._write_profile(user_id, zone, times)
+
+    def add_calories(self, user_id, day, values):
+        entries = array.array('i')
+        for value in values:
+            entries.extend((day, int(value)))
+        added = sum(int(value) for value in values)
+
+        with self._lock(user_id):
+            with open(self._filename(user_id, 'entries'), 'ab') as file:
+                entries.tofile(file)
+
+            with open(self._filename(user_id, 'days'), 'r+b') as file:
+                size = file.seek(0, os.SEEK_END)
+                last = None
+                if size:
+                    file.seek(size - self._PAIR.size)
+                    last, total = self._PAIR.unpack(file.read())
+
+                if last == day:
+                    file.seek(size - self._PAIR.size)
+                    file.write(self._PAIR.pack(day, total + added))
+                elif last is None or day > last:
+                    file.write(self._PAIR.pack(day, added))
+                else:
+                    # день раньше последнего - файл переписывается
+                    file.seek(0)
+                    pairs = array.array('i', file.read())
+                    days = pairs[0::2]
+                    i = bisect.bisect_left(days, day)
+                    if i < len(days) and days[i] == day:
+                        pairs[2 * i + 1] += added
+                    else:
+                        pairs[2 * i:2 * i] = array.array('i', (day, added))
+                    file.seek(0)
+                    pairs.tofile(file)
+
+    def get_calories(self, user_id, day=None):
+        def reader(ints):
+            calories = {}
+            for key, value in zip(ints[0::2], ints[1::2]):
+                if day is None or key == day:
+                    calories.setdefault(key, []).append(value)
+            return calories
+
+        calories = self._read_pairs(user_id, 'entries', reader)
+        return dict(sorted(calories.items()))
+
+    def get_totals(self, user_id, day=None):
+        def reader(ints):
+            days = ints[0::2]
+            if day is None:
+                return dict(zip(days.tolist(), ints[1::2].tolist()))
+
+            i = bisect.bisect_left(days, day)
+            if i < len(days) and days[i] == day:
+                return {day: ints[2 * i + 1]}
+            return {}
+
+        return self._read_pairs(user_id, 'days', reader)
+
+    def delete(self, user_id):
+        with self._lock(user_id):
+            for kind in ('prof', 'days', 'entries'):
+                os.remove(self._filename(user_id, kind))
+
+    def user_ids(self):
+        try:
+            return [int(name.split('.')[0])
+                    for name in os.listdir(self.catalog_path)
+                    if name.endswith('.prof')]
+        except FileNotFoundError:
+            return []
+
+    def changed_since(self, timestamp):
+        try:
+            with os.scandir(self.catalog_path) as entries:
+                return [int(entry.name.split('.')[0]) for entry in entries
+                        if entry.name.endswith('.prof') and
+                        entry.stat().st_mtime >= timestamp]
+        except FileNotFoundError:
+            return []
+
+
+def create_storage(config):
+    """Создает хранилище по словарю настроек.
+
+    Args:
+        config - словарь вида {'backend': 'text', 'sqlite' или
+            'binary', 'path': путь к папке или файлу базы,
+            'compact_threshold': порог свертки журнала для 'text'}.
+
+    Return:
+        объект подкласса Storage.
+
+    """
+
+    path = os.path.abspath(config['path'])
+
+    if config['backend'] == 'text':
+        return TextStorage(path, config.get('compact_threshold', 50))
+    elif config['backend'] == 'sqlite':
+        return SQLiteStorage(path)
+    elif config['backend'] == 'binary':
+        return BinaryStorage(path)
+
+    raise ValueError(f"unknown storage backend: {config['backend']}")
+
+
+def migrate(source, target):
+    """Переносит всех пользователей из source в target.
+
+    Args:
+        source, target - объекты подклассов Storage.
+
+    Return:
+        количество перенесенных пользователей.
+
+    """
+
+    logger = logging.getLogger('bot.storage')
+
+    count = 0
+    for user_id in source.user_ids():
+        zone, times = source.load_profile(user_id)
+
+        target.create(user_id)
+        if zone is not None:
+            target.save_zone(user_id, zone)
+        if times:
+            target.add_times(user_id, times)
+        for date, values in source.get_calories(user_id).items():
+            target.add_calories(user_id, date, values)
+
+        count += 1
+
+    logger.info('Migrated %i users.', count)
+    return count
+
+
+if __name__ == '__main__':
+    # Перенос файлов 'users/*.txt' в базу SQLite или в двоичные
+    # файлы:
+    # python storage.py users users.db
+    # python storage.py users users_bin binary
+    import sys
+
+    migrate(TextStorage(os.path.abspath(sys.argv[1])),
+            create_storage({'backend': (sys.argv[3] if len(sys.argv) > 3
+                                        else 'sqlite'),
+                            'path': sys.argv[2]}))
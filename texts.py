@@ -39,6 +39,10 @@ help_text = (f"Общение с ботом происходит посредс
              f"сообщение с суммой калорий за этот день. Если после команды"
              f" give указать слово all, то бот пришлет сумму калорий за"
              f" все дни, которые хранит у себя в базе.\n\n"
+             f"<give> week/month/ДД.ММ-ДД.ММ - присылает сумму калорий "
+             f"за период, среднее за день, а также наименьшую и "
+             f"наибольшую сумму за день. week - последние 7 дней, "
+             f"month - с начала текущего месяца.\n\n"
              f"<set time> 19:38 - таким образом вы указываете боту свой "
              f"часовой пояс, написав после команды set time ваше текущее "
              f"локальное время в формате ЧЧ:ММ, где ЧЧ - текущий час в "
@@ -54,3 +58,6 @@ help_text = (f"Общение с ботом происходит посредс
              f"будут удалены.")
 
 goodbye_text = "Все данные удалены. Всего доброго ;)"
+
+busy_text = ("Бот сейчас перегружен и не успел принять команду. "
+             "Повторите ее через минуту.")
@@ -7,13 +7,17 @@
 
 import os
 import time
-import collections
+import datetime
 import logging
 
 import vk_api
 from vk_api.utils import get_random_id
 
-from Work import texts
+from Work import texts, metrics
+from Work.history import day_ordinal, format_day, infer_day
+from Work.storage import TextStorage
+from Work.schedule import ReminderSchedule
+from Work.reminder_index import ReminderIndex, slot_of, SLOT_MINUTES
 
 
 class User:
@@ -21,16 +25,19 @@ class User:
 
     Attributes:
         user_id - целочисленный id пользователя;
-        vk - объект vk_api.vk_api.VkApiMethod;
+        vk - объект vk_api.vk_api.VkApiMethod или
+            delivery.ReplyBuffer;
         status - строка, представляющая поступившую задачу;
         values - список значений, поступивших с задачей;
         zone - целочисленное значение, представляющее разницу
             между временем сервера и временем пользователя в
             минутах;
-        users - словарь вида {'HH:MM': {12441, 15238}, }, в
-            котором ключами является строка с временем напоминания
-            (в локальном времени сервера), а значением - множество
-            id пользователей, которым нужно напоминание.
+        reminders - индекс reminder_index.ReminderIndex, в ячейках
+            которого (по 5 минут локального времени сервера) лежат
+            id пользователей, которым нужно напоминание;
+        schedule - расписание срабатываний ячеек reminders
+            (schedule.ReminderSchedule);
+        storage - хранилище данных пользователей (storage.Storage).
 
     Methods:
         task_handler - для поступившей задачи и значений запускет
@@ -38,10 +45,14 @@ class User:
 
     """
 
-    users = collections.defaultdict(set)
-    catalog_path = os.path.abspath('users')  # 'Work/users'
-    # вернет путь для папки users в той же папке, где находится
-    # вызывающая программа (eat_bot.py).
+    reminders = ReminderIndex()
+    # индекс только в памяти; заменяется в eat_bot.config_storage
+    # индексом с файлом из settings.reminders_config.
+    schedule = ReminderSchedule()
+    storage = TextStorage(os.path.abspath('users'))  # 'Work/users'
+    # по умолчанию - папка users в той же папке, где находится
+    # вызывающая программа (eat_bot.py); заменяется в eat_bot.main
+    # хранилищем из settings.storage_config.
 
     _logger = logging.getLogger('bot.user')
 
@@ -52,7 +63,9 @@ class User:
             user_id - целочисленный id пользователя;
             task - кортеж из задачи и списка значений для задачи.
 
-        Вызывает метод _start() для подготовки данных о клиенте.
+        Данные о клиенте готовит метод _start(), который вызывается
+        в task_handler - в потоке шарда пользователя, а не в потоке,
+        создавшем задачу.
 
         """
 
@@ -60,120 +73,52 @@ class User:
         self.vk = vk
         self.status = task[0]
         self.values = task[1]
+        self.created = time.monotonic()  # для метрики ожидания в очереди
+        self.done = None
+        # функция, которую поток вызывает после выполнения задачи
 
         self.zone = None
 
-        self._start()
-
     def _start(self):
         """
-        Вызывается при инициализации объекта класса.
-        Проверяет, существует ли папка users и есть ли в ней
-        файл с id пользователя.  Если нет - создает
-        'users/<user_id>.txt' и записывает туда первую строку.
-        Если есть - считывает часовой пояс и время напоминаний.
+        Вызывается перед выполнением задачи.
+        Запрашивает профиль пользователя в хранилище storage.  Если
+        профиля нет - создает пустой профиль.  Если есть - считывает
+        часовой пояс.  Время напоминаний хранится в индексе
+        reminders и здесь не регистрируется.
 
         """
 
-        self.user_filename = self.catalog_path + f'/{self.user_id}.txt'
-
-        if not os.path.exists(self.catalog_path):
-            os.mkdir(self.catalog_path)
+        profile = self.storage.load_profile(self.user_id)
 
-        if not os.path.isfile(self.user_filename):
-            text = f"zone=None eating_times=None"
-            with open(self.user_filename, 'w') as file:
-                file.write(text)
+        if profile is None:
+            self.storage.create(self.user_id)
 
         else:
-            data = self._load()
-
-            # Установка часового пояса из файла
-            try:
-                self.zone = int(data[0][0])
-            except ValueError:
-                self.zone = None
-
-            for t in data[0][1]:
-                if t != 'None':
-                    self.users[t].add(self.user_id)
-            # Установка времен напоминания из файла
+            self.zone, times = profile
 
             self._logger.debug(
                 '[Task: %s] [client ID: %i] [Timezone: %s] [EatTimes: %s]',
-                self.status, self.user_id, self.zone, data[0][1]
+                self.status, self.user_id, self.zone, times
             )
 
-    def _send(self, message):
-        """Отправляет сформированное сообщение пользователю."""
-        self.vk.messages.send(user_id=self.user_id, random_id=get_random_id(),
-                              message=message)
-
-    def _load(self):
-        """Читает данные из файла пользователя.
-
-        Возвращает список формата:
-        [
-         [zone: str, [*eatstimes: str]],
-         [date: str, [*calories: str]],
-         [date: str, [*calories: str]],
-        ]
-
+    def _add_reminders(self, times):
         """
+        Добавляет id пользователя в ячейки индекса reminders для
+        времен из times (формат 'HH:MM') и передает их расписанию
+        schedule.
 
-        with open(self.user_filename, 'r') as file:
-
-            first_line = file.readline().strip().split(' ')
-            zone = first_line[0].split('=')[1]
-            # 'None' или смещение времени в минутах в виде str
-            times_to_eat = first_line[1].split('=')[1].split(',')
-            # ['None'] or ['HH:MM', 'HH:MM', ...]
-
-            lines = [[zone, times_to_eat]]
-
-            for line in file.readlines():
-                string = line.strip().split(' ')
-                date = string[0].split('=')[1]
-                calories = string[1].split('=')[1].split(',')
-
-                lines.append([date, calories])
-                # ['DD.MM', [str, str, str]]
-
-        return lines
-
-    def _save(self, text):
         """
-        Сохраняет текст в файл пользователя, польностью
-        перезаписывая его.
 
-        """
-
-        with open(self.user_filename, 'w') as file:
-            file.write(text)
-
-    def _save_with_data(self, data):
-        """Сохраняет сформированные данные.
-
-        Args:
-            data - список в формате:
-            [
-             [zone: str, [*eatstimes: str]],
-             [date: str, [*calories: str]],
-             [date: str, [*calories: str]],
-            ]
-             , где первый элемент - первая строка файла
-             с часовым поясом и временем опроса пользователя,
-             последующие строки - дата и калории в эту дату
-             (могут отсутствовать).
-
-        """
+        slots = [slot_of(t) for t in times]
 
-        text = f"zone={data[0][0]} times_to_eat={','.join(data[0][1])}"
-        if len(data) > 1:
-            for date, calories in data[1:]:
-                text += f"\ndate={date} calories={','.join(calories)}"
+        self.reminders.add(self.user_id, slots)
+        self.schedule.add([slot * SLOT_MINUTES for slot in slots])
 
-        self._save(text)
+    def _send(self, message):
+        """Отправляет сформированное сообщение пользователю."""
+        self.vk.messages.send(user_id=self.user_id, random_id=get_random_id(),
+                              message=message)
 
     def _user_clock(self):
         """
@@ -187,26 +132,25 @@ class User:
 
         return time.localtime(user_time)
 
-    def _user_date(self):
-        """Возвращает дату пользователя в формате DD.MM ."""
+    def _user_today(self):
+        """Возвращает текущую дату пользователя (datetime.date)."""
+
+        clock = self._user_clock()
+        return datetime.date(clock.tm_year, clock.tm_mon, clock.tm_mday)
 
-        date_obj = self._user_clock()
-        day = str(date_obj.tm_mday)
-        month = str(date_obj.tm_mon)
-        date = (
-            f"{day if len(day) > 1 else '0' + day}."
-            f"{month if len(month) > 1 else '0' + month}"
-        )
+    def _user_day(self):
+        """
+        Возвращает порядковый номер текущего дня пользователя
+        (datetime.date.toordinal()).
+
+        """
 
-        return date
+        return self._user_today().toordinal()
 
     def _save_timezone(self):
         """Сохраняет установленное значение часового пояса."""
 
-        data = self._load()
-        data[0][0] = str(self.zone)
-
-        self._save_with_data(data)
+        self.storage.save_zone(self.user_id, self.zone)
 
     def set_timezone(self):
         """
@@ -248,27 +192,20 @@ class User:
 
         return True, None
 
-    def _save_calories(self, date, values):
+    def _save_calories(self, day, values):
         """
-        Записывает в файл введенные калории по текущей дате
+        Записывает в хранилище введенные калории по текущей дате
         пользователя.
 
         Args:
-            date - строка с датой формата DD.MM ;
+            day - порядковый номер дня;
             values - список из строк со значениями добавляемых
             калорий.
 
         """
 
-        data = self._load()
-        date_in_file = data[-1][0]
-
-        if date_in_file == date:
-            data[-1][1].extend(values)
-        else:
-            data.append([date, values])
-
-        self._save_with_data(data)
+        self.storage.add_calories(self.user_id, day,
+                                  [int(value) for value in values])
 
     def add_calories(self):
         """Добавляет введенные калории к списку за день.
@@ -281,7 +218,7 @@ class User:
         if self.zone is None:
             return False, 'не установлен часовой пояс'
 
-        self._save_calories(self._user_date(), self.values)
+        self._save_calories(self._user_day(), self.values)
 
         return True, None
 
@@ -297,8 +234,8 @@ class User:
 
         sub_sum = sum([int(values) for values in self.values])  # < 0
 
-        date = self._user_date()  # 'DD.MM'
-        eaten_sum = sum(int(cal) for cal in self._give(date)[date])
+        day = self._user_day()
+        eaten_sum = self.storage.get_total(self.user_id, day) or 0
 
         if eaten_sum + sub_sum < 0:
             return (
@@ -311,42 +248,99 @@ class User:
         return True, None
 
     def _give(self, date):
-        """Загружает из файла список калорий за указанную дату.
+        """Загружает из хранилища суммы калорий за указанную дату.
 
         Args:
-            date - это дата в формате 'DD.MM.YYYY' или 'DD.MM',
-            либо 'all', либо 'today'.
+            date - это дата в формате 'DD.MM.YYYY' или 'DD.MM'
+            (последняя такая дата, не позже текущей), либо 'all',
+            либо 'today'.
 
         Return:
             словарь вида:
             {
-             date: [v1, v2, v3],
-             date: [v1, v2, v3],
+             day: total,
+             day: total,
             }
-            , в котором date - дата в формате 'DD.MM',
-            а значения ключей - список из калорий (в str);
+            , в котором day - порядковый номер дня,
+            а значения ключей - сумма калорий за день (int);
             словарь может быть пустым.
 
         """
 
-        all_date = True if date == 'all' else False
+        if date == 'all':
+            return self.storage.get_totals(self.user_id)
 
         if date == 'today':
-            date = self._user_date()  # 'DD.MM'
+            day = self._user_day()
+        elif len(date.split('.')) > 2:
+            day = day_ordinal(date)
         else:
-            temp = date.split('.')
-            if len(temp) > 2:
-                date = '.'.join(temp[:2])
+            day = infer_day(date, self._user_day())
+
+        return self.storage.get_totals(self.user_id, day)
+
+    def _period(self, period):
+        """Возвращает границы периода.
+
+        Args:
+            period - 'week' (последние 7 дней), 'month' (с начала
+            текущего месяца) или 'DD.MM-DD.MM'; даты без года
+            относятся к текущему году, а если начало периода
+            оказывается позже конца - к предыдущему.
+
+        Return:
+            кортеж (first, last) из порядковых номеров дней.
+
+        """
 
-        data = self._load()
+        today = self._user_today()
 
-        if all_date:
-            calories = {line[0]: line[1] for line in data[1:]}
+        if period == 'week':
+            first = today - datetime.timedelta(days=6)
+        elif period == 'month':
+            first = today.replace(day=1)
         else:
-            calories = {line[0]: line[1] for line in data[1:] if
-                        date == line[0]}
+            first, last = period.split('-')
+            if len(last.split('.')) < 3:
+                last += f'.{today.year}'
+            last = day_ordinal(last)
+
+            year = datetime.date.fromordinal(last).year
+            if len(first.split('.')) > 2:
+                return day_ordinal(first), last
+            if day_ordinal(f'{first}.{year}') > last:
+                year -= 1
+            return day_ordinal(f'{first}.{year}'), last
+
+        return first.toordinal(), today.toordinal()
+
+    def send_stats(self):
+        """
+        Отправляет пользователю сумму, среднее за день, минимум и
+        максимум калорий за период.
+
+        Return:
+            кортеж (status: bool, err_message: str or None).
+
+        """
 
-        return calories
+        try:
+            first, last = self._period(self.values[0])
+        except ValueError:
+            return False, 'невалидная дата'
+        stats = self.storage.get_stats(self.user_id, first, last)
+
+        if stats is None:
+            return False, 'нет внесенных значений калорий за указанный период'
+
+        self._send(f"Период: {format_day(first)}-{format_day(last)}.\n"
+                   f"Сумма калорий: {stats.total}.\n"
+                   f"Дней с записями: {stats.days}.\n"
+                   f"В среднем за день: {round(stats.total / stats.days)}.\n"
+                   f"Меньше всего за день: {stats.min}.\n"
+                   f"Больше всего за день: {stats.max}.")
+
+        return True, None
 
     def send_calories(self):
         """
@@ -361,46 +355,44 @@ class User:
             return False, 'не установлен часовой пояс'
 
         date = self.values[0]
-        calories = self._give(date)
+        if date in ('week', 'month') or '-' in date:
+            return self.send_stats()
 
-        if not calories:
+        try:
+            totals = self._give(date)
+        except ValueError:
+            return False, 'невалидная дата'  # например, 29.02.2023
+
+        if not totals:
             return False, 'нет внесенных значений калорий за указанную дату'
 
         text = ''
-        for day, cals in calories.items():
-            text += (f"Дата: {day}. "
-                     f"Сумма калорий: {sum([int(cal) for cal in cals])}.\n")
+        for day, total in totals.items():
+            text += (f"Дата: {format_day(day)}. "
+                     f"Сумма калорий: {total}.\n")
 
         self._send(text)
 
         return True, None
 
     def _save_times_to_eat(self, times):
-        """Сохраняет в файл время напоминаний.
+        """Сохраняет в хранилище время напоминаний.
 
         Args:
             times - список времен в формате 'HH:MM'.
 
         """
 
-        data = self._load()
-
-        # Добавление в файл введенных калорий
-        if data[0][1] == ['None']:
-            data[0][1] = times
-        else:
-            data[0][1].extend(times)
-
-        self._save_with_data(data)
+        self.storage.add_times(self.user_id, times)
 
     def set_times_to_eat(self):
         """Устанавливает время для напоминаний.
 
         Переводит локальное время пользователя в локальное
-        время сервера. По ключу времени сервера добавляет
-        в множество словаря user.users id пользователя, которому
-        нужно прислать напоминание в это время.
-        Сохраняет это время в файл пользователя.
+        время сервера. В ячейку индекса reminders для времени
+        сервера добавляет id пользователя, которому нужно прислать
+        напоминание в это время.
+        Сохраняет это время в хранилище.
 
         Return:
             кортеж (status: bool, err_message: str or None).
@@ -419,7 +411,8 @@ class User:
                 return False, 'время не кратно 5'
             # Минуты во времени должны быть кратны 5
 
-            server_in_min = time_in_min + self.zone
+            server_in_min = (time_in_min + self.zone) % (24 * 60)
+            # время сервера может оказаться в других сутках
 
             hour = str(int(server_in_min/60))
             minute = str(server_in_min - int(hour)*60)
@@ -428,9 +421,7 @@ class User:
 
             server_times.append(clock)
 
-        for t in server_times:
-            self.users[t].add(self.user_id)
-
+        self._add_reminders(server_times)
         self._save_times_to_eat(server_times)
 
         return True, None
@@ -457,19 +448,15 @@ class User:
         """Завершает работу бота для пользователя.
 
         Удаляет id пользователя из списка для отправки напоминаний,
-        удаляет файл пользователя.
+        удаляет данные пользователя из хранилища.
 
         Return:
             кортеж (True, None) в соответствии с API модуля.
 
         """
 
-        data = self._load()
-        for t in data[0][1]:
-            if t != 'None':
-                self.users[t].remove(self.user_id)
-
-        os.remove(self.user_filename)
+        self.reminders.remove_user(self.user_id)
+        self.storage.delete(self.user_id)
         self._send(texts.goodbye_text)
 
         return True, None
@@ -525,21 +512,33 @@ class User:
 
         """
 
-        tasks = {'add': self.add_calories,
-                 'sub': self.sub_calories,
-                 'set time': self.set_timezone,
-                 'set eating': self.set_times_to_eat,
-                 'give': self.send_calories,
-                 'stop': self.stop,
-                 'error': self.error,
-                 'reminder': self.reminder,
-                 'start': self.start,
-                 'help': self.help}
-
-        is_good, err_text = tasks[self.status]()
-        if not is_good:
-            self.error(err_text)
-
-        if is_good and self.status in ('add', 'sub', 'set time',
-                                       'set eating'):
-            self._send('Принято.')
+        started = time.monotonic()
+        result = 'error'  # задача завершилась исключением
+
+        try:
+            self._start()
+
+            tasks = {'add': self.add_calories,
+                     'sub': self.sub_calories,
+                     'set time': self.set_timezone,
+                     'set eating': self.set_times_to_eat,
+                     'give': self.send_calories,
+                     'stop': self.stop,
+                     'error': self.error,
+                     'reminder': self.reminder,
+                     'start': self.start,
+                     'help': self.help}
+
+            is_good, err_text = tasks[self.status]()
+            if not is_good:
+                self.error(err_text)
+
+            if is_good and self.status in ('add', 'sub', 'set time',
+                                           'set eating'):
+                self._send('Принято.')
+
+            result = 'ok' if is_good else 'rejected'
+        finally:
+            metrics.TASKS.inc(status=self.status, result=result)
+            metrics.TASK_SECONDS.observe(time.monotonic() - started,
+                                         status=self.status)